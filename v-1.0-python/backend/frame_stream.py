@@ -0,0 +1,339 @@
+import io
+import struct
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from itertools import count
+
+import numpy as np
+from PIL import Image
+
+from metrics import RollingStats
+
+# Every streamed frame starts with this header:
+#   magic b'SIMF', version (uint32), iteration (uint32), rows (uint16), cols (uint16),
+#   channels (uint8), encoding (uint8), tile size (uint16), payload bytes (uint32)
+# followed by the payload: row-major RGB bytes, raw or zlib-compressed, or
+# for encoding 2 a zlib-compressed tile delta (see Frame.delta). The tile
+# size is 0 for full frames.
+FRAME_MAGIC = b'SIMF'
+FRAME_HEADER = struct.Struct('<4sIIHHBBHI')
+ENCODINGS = {'raw': 0, 'zlib': 1, 'delta': 2}
+STREAM_MIMETYPE = 'application/x-sim-frames'
+# Delta payloads start with the base version and the number of changed tiles,
+# then one (tile row, tile col) pair per changed tile, then the tiles' pixels.
+DELTA_HEADER = struct.Struct('<II')
+DELTA_TILE = np.dtype([('ty', '<u2'), ('tx', '<u2')])
+
+
+def changed_tiles(a, b, tile):
+    """(tile rows, tile cols) bool mask of the tiles where RGB images a and b differ"""
+    rows, cols = a.shape[:2]
+    ty, tx = -(-rows // tile), -(-cols // tile)
+    diff = np.zeros((ty * tile, tx * tile), dtype=bool)
+    np.any(a != b, axis=2, out=diff[:rows, :cols])
+    return diff.reshape(ty, tile, tx, tile).any(axis=(1, 3))
+
+
+class Frame:
+    """One published RGB frame; each encoding is produced at most once and shared by every client"""
+
+    # PhaseTimer the encodings are timed into, by encoding name; None (the default) skips timing.
+    encode_timer = None
+
+    def __init__(self, iteration, rgb, version=0):
+        self.iteration = int(iteration)
+        self.version = int(version)
+        # The iteration alone repeats after restart() and does not change on vaccinate().
+        self.etag = f'{self.version}-{self.iteration}'
+        self.rgb = np.ascontiguousarray(rgb, dtype=np.uint8)
+        self.rows, self.cols, self.channels = self.rgb.shape
+        self.published_at = time.monotonic()
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    def payload(self, encoding):
+        """Frame pixels in the given encoding ('raw', 'zlib' or 'png')"""
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = self._timed(encoding, self._encode, encoding)
+            return self._encoded[encoding]
+
+    @property
+    def encodings(self):
+        """Whole-frame encodings produced so far (deltas excluded)"""
+        return [key for key in self._encoded if isinstance(key, str)]
+
+    def _timed(self, name, encode, *args):
+        timer = Frame.encode_timer
+        if timer is None:
+            return encode(*args)
+        with timer.time(name):
+            return encode(*args)
+
+    def _encode(self, encoding):
+        if encoding == 'raw':
+            return self.rgb.tobytes()
+        if encoding == 'zlib':
+            # Level 1: the grids are mostly flat colour, so fast levels already compress well.
+            return zlib.compress(self.rgb.tobytes(), 1)
+        if encoding == 'png':
+            buf = io.BytesIO()
+            Image.fromarray(self.rgb, 'RGB').save(buf, 'PNG')
+            return buf.getvalue()
+        raise ValueError(f"Unknown frame encoding '{encoding}'")
+
+    def delta(self, base, tile):
+        """zlib-compressed tiles that changed since frame `base`; shared by every client on that base"""
+        key = ('delta', base.version, tile)
+        with self._lock:
+            if key not in self._encoded:
+                self._encoded[key] = self._timed('delta', self._encode_delta, base, tile)
+            return self._encoded[key]
+
+    def _encode_delta(self, base, tile):
+        mask = changed_tiles(self.rgb, base.rgb, tile)
+        coords = np.zeros(int(mask.sum()), dtype=DELTA_TILE)
+        coords['ty'], coords['tx'] = np.nonzero(mask)
+        parts = [DELTA_HEADER.pack(base.version, len(coords)), coords.tobytes()]
+        for ty, tx in zip(coords['ty'], coords['tx']):
+            parts.append(self.rgb[ty * tile:(ty + 1) * tile, tx * tile:(tx + 1) * tile].tobytes())
+        return zlib.compress(b''.join(parts), 1)
+
+    def packet(self, encoding, base=None, tile=0):
+        """Header plus payload, as sent on the binary stream; 'delta' needs a base frame and tile size"""
+        if encoding == 'delta':
+            payload = self.delta(base, tile)
+        else:
+            payload = self.payload(encoding)
+            tile = 0
+        header = FRAME_HEADER.pack(
+            FRAME_MAGIC, self.version & 0xFFFFFFFF, self.iteration & 0xFFFFFFFF, self.rows, self.cols,
+            self.channels, ENCODINGS[encoding], tile, len(payload),
+        )
+        return header + payload
+
+
+class FrameBroadcaster:
+    """Holds the latest frame and wakes streaming clients when a new one is published.
+
+    Clients never queue frames: each one sends the newest frame once its own
+    interval has passed, so a slow client skips the frames it could not keep
+    up with instead of falling further behind.
+    """
+
+    def __init__(self, max_fps=30.0, max_clients=8, keepalive=15.0, tile=32, keyframe_interval=10.0,
+                 history=64):
+        self.max_fps = float(max_fps)
+        self.max_clients = int(max_clients)
+        self.keepalive = float(keepalive)
+        self.latest = None
+        self.clients = 0
+        self._versions = count(1)
+        self._cond = threading.Condition()
+
+        # Delta streams: tile size, seconds between forced keyframes, and how
+        # many recent frames are kept as possible delta bases.
+        self.tile = int(tile)
+        self.keyframe_interval = float(keyframe_interval)
+        self._history = OrderedDict()
+        self._history_size = int(history)
+        # Last frame version each delta client acknowledged.
+        self.acks = {}
+
+    def publish(self, iteration, rgb):
+        frame = Frame(iteration, rgb, next(self._versions))
+        with self._cond:
+            self.latest = frame
+            self._history[frame.version] = frame
+            while len(self._history) > self._history_size:
+                self._history.popitem(last=False)
+            self._cond.notify_all()
+        return frame
+
+    def frame(self, version):
+        """A recently published frame by version, or None once it has aged out"""
+        with self._cond:
+            return self._history.get(version)
+
+    def new_client_id(self):
+        return uuid.uuid4().hex
+
+    def ack(self, client, version):
+        """Record that a delta client holds frame `version`; later deltas are computed against it"""
+        with self._cond:
+            if client not in self.acks:
+                return False
+            current = self.acks[client]
+            if current is None or version > current:
+                self.acks[client] = int(version)
+            return True
+
+    def wait_latest(self, timeout):
+        """Latest frame, waiting up to timeout seconds for the first one to be published"""
+        return self._wait_newer(None, timeout)
+
+    def negotiate_fps(self, requested):
+        """Clamp a client's requested frame rate to what the server allows"""
+        try:
+            fps = float(requested)
+        except (TypeError, ValueError):
+            fps = self.max_fps
+        return max(0.5, min(fps, self.max_fps))
+
+    def acquire_client(self):
+        with self._cond:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def release_client(self, client=None):
+        with self._cond:
+            self.clients = max(0, self.clients - 1)
+            self.acks.pop(client, None)
+
+    def _wait_newer(self, after, timeout):
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.latest is not None and self.latest is not after,
+                timeout=timeout,
+            )
+            return self.latest
+
+    def stream(self, fps, encoding='zlib', client=None):
+        """Generator of frame packets for one client.
+
+        Call acquire_client first and release_client once the response closes.
+        With encoding 'delta' the client id must be given: each packet then
+        carries only the tiles that changed since the client's last ack, or a
+        zlib keyframe when there is no usable ack or a keyframe is due.
+        """
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown stream encoding '{encoding}'. Options: {', '.join(ENCODINGS)}")
+        if encoding == 'delta':
+            with self._cond:
+                self.acks[client] = None
+        interval = 1.0 / fps
+        sent = None
+        next_due = 0.0
+        next_keyframe = 0.0
+        while True:
+            frame = self._wait_newer(sent, self.keepalive)
+            if frame is None:
+                continue
+            if frame is sent and encoding != 'delta':
+                # Nothing new (paused): resend so dead connections get noticed.
+                yield frame.packet(encoding)
+                continue
+
+            if frame is not sent:
+                delay = next_due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                    # Frames published while sleeping replace this one.
+                    frame = self.latest
+                next_due = time.monotonic() + interval
+            sent = frame
+            if encoding != 'delta':
+                yield frame.packet(encoding)
+                continue
+
+            base = self.frame(self.acks.get(client))
+            if base is None or base.rgb.shape != frame.rgb.shape or time.monotonic() >= next_keyframe:
+                next_keyframe = time.monotonic() + self.keyframe_interval
+                yield frame.packet('zlib')
+            else:
+                # An up-to-date client gets an empty delta, which doubles as the keepalive.
+                yield frame.packet('delta', base, self.tile)
+
+
+class FrameRenderer:
+    """Renders frames on its own thread from snapshots taken under the simulation lock.
+
+    capture() only copies the three rendered compartments into one of two
+    recycled snapshot buffers, so the lock is held for a memcpy. The render
+    thread turns the newest snapshot into RGB, pre-encodes whatever the
+    previous frame was requested in, and publishes it. A snapshot that is
+    replaced before the render thread reaches it is simply dropped.
+    """
+
+    def __init__(self, broadcaster, render, inline=False):
+        self.broadcaster = broadcaster
+        self.render = render
+        # Render under the caller's lock instead, as before; kept for comparison.
+        self.inline = inline
+        self.capture_ms = RollingStats()
+        self.render_ms = RollingStats()
+        self.last_capture_iteration = None
+        self.last_capture_at = 0.0
+
+        self._buffers = [None, None]
+        self._pending = None
+        self._rendering = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def due(self, iteration):
+        """Whether the stream is owed a frame for this iteration"""
+        if iteration == self.last_capture_iteration:
+            return False
+        return time.monotonic() - self.last_capture_at >= 1.0 / self.broadcaster.max_fps
+
+    def capture(self, sim_obj):
+        """Snapshot sim_obj's r/g/b for rendering; call with the simulation lock held"""
+        self.last_capture_iteration = sim_obj.iter
+        self.last_capture_at = time.monotonic()
+        if self.inline:
+            with self.render_ms.time():
+                self._publish(sim_obj.iter, sim_obj.r, sim_obj.g, sim_obj.b)
+            return
+
+        with self.capture_ms.time():
+            with self._cond:
+                # A pending snapshot that was never rendered is overwritten.
+                self._pending = None
+                slot = 1 if self._rendering == 0 else 0
+            shape = (3,) + sim_obj.r.shape
+            buf = self._buffers[slot]
+            if buf is None or buf.shape != shape or buf.dtype != sim_obj.r.dtype:
+                buf = self._buffers[slot] = np.empty(shape, dtype=sim_obj.r.dtype)
+            np.copyto(buf[0], sim_obj.r)
+            np.copyto(buf[1], sim_obj.g)
+            np.copyto(buf[2], sim_obj.b)
+            with self._cond:
+                self._pending = (sim_obj.iter, slot)
+                self._cond.notify()
+        self._ensure_thread()
+
+    def _publish(self, iteration, r, g, b):
+        previous = self.broadcaster.latest
+        frame = self.broadcaster.publish(iteration, self.render(r, g, b))
+        # Clients will ask for the same encodings as last time; do the work here, off their path.
+        for encoding in previous.encodings if previous is not None else ():
+            frame.payload(encoding)
+        return frame
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='sim-render', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None)
+                iteration, slot = self._pending
+                self._pending = None
+                self._rendering = slot
+            try:
+                buf = self._buffers[slot]
+                with self.render_ms.time():
+                    self._publish(iteration, buf[0], buf[1], buf[2])
+            except Exception as exc:
+                print(f'Error rendering frame: {exc}')
+            finally:
+                with self._cond:
+                    self._rendering = None
@@ -0,0 +1,167 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+FINISHED = ('done', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """Progress, result and cancellation flag of one background job"""
+
+    def __init__(self, kind, total, params=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.total = int(total)
+        self.params = params or {}
+        self.status = 'queued'
+        self.done = 0
+        self.info = {}
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_requested = False
+        # Bumped on every change so subscribers can wait for the next one.
+        self.version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    def progress(self, done, **info):
+        """Record progress from the worker; raises JobCancelled once cancel() was called"""
+        with self._cond:
+            self.done = int(done)
+            self.info.update(info)
+            self.version += 1
+            self._cond.notify_all()
+            if self.cancel_requested:
+                raise JobCancelled()
+
+    def cancel(self):
+        with self._cond:
+            if self.finished:
+                return False
+            self.cancel_requested = True
+            if self.status == 'queued':
+                self._finish('cancelled')
+            return True
+
+    def wait(self, after_version=None, timeout=None):
+        """Block until the job changes after `after_version` (or finishes); returns describe()"""
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.finished or (after_version is not None and self.version > after_version),
+                timeout=timeout,
+            )
+            return self._describe()
+
+    def describe(self):
+        with self._cond:
+            return self._describe()
+
+    def _describe(self):
+        info = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'done': self.done,
+            'total': self.total,
+            'progress': self.done / self.total if self.total else 1.0,
+            'version': self.version,
+            'params': self.params,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+        info.update(self.info)
+        if self.result is not None:
+            info['result'] = self.result
+        if self.error is not None:
+            info['error'] = self.error
+        return info
+
+    def _start(self):
+        with self._cond:
+            if self.finished:
+                return False
+            self.status = 'running'
+            self.started_at = time.time()
+            self.version += 1
+            self._cond.notify_all()
+            return True
+
+    def _finish(self, status, result=None, error=None):
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.version += 1
+        self._cond.notify_all()
+
+
+class JobManager:
+    """Runs jobs on a bounded thread pool and keeps the most recent ones for polling.
+
+    A job's work function receives the Job and reports through
+    job.progress(), which raises JobCancelled when the job was cancelled;
+    its return value becomes the job result.
+    """
+
+    def __init__(self, workers=1, history=100):
+        self.workers = max(1, int(workers))
+        self.history = int(history)
+        self.jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sim-job')
+
+    def submit(self, kind, total, work, params=None):
+        job = Job(kind, total, params)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._prune()
+        self._pool.submit(self._run, job, work)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        return [job.describe() for job in reversed(jobs)]
+
+    def active(self):
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def _run(self, job, work):
+        if not job._start():
+            return
+        try:
+            result = work(job)
+        except JobCancelled:
+            with job._cond:
+                job._finish('cancelled')
+        except Exception as exc:
+            print(f'Job {job.id} failed: {exc}')
+            with job._cond:
+                job._finish('failed', error=str(exc))
+        else:
+            with job._cond:
+                job._finish('cancelled' if job.cancel_requested else 'done', result=result)
+
+    def _prune(self):
+        # Finished jobs beyond the history size are forgotten, oldest first.
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from profiling import Histogram
+
+
+class RollingStats:
+    """Last `size` samples of a measurement (milliseconds by convention) with summary statistics"""
+
+    def __init__(self, size=1000):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        with self._lock:
+            self._samples.append(float(value))
+
+    def time(self):
+        """Context manager adding the elapsed milliseconds of its block"""
+        return _Timer(self)
+
+    def summary(self):
+        with self._lock:
+            samples = np.array(self._samples, dtype=np.float64)
+        if samples.size == 0:
+            return {'count': 0}
+        return {
+            'count': int(samples.size),
+            'mean': float(samples.mean()),
+            'std': float(samples.std()),
+            'p50': float(np.percentile(samples, 50)),
+            'p99': float(np.percentile(samples, 99)),
+            'max': float(samples.max()),
+        }
+
+
+class _Timer:
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add((time.perf_counter() - self.start) * 1000)
+        return False
+
+
+def lock_role():
+    """Who is taking a lock, by thread name: the simulation loop, a batch job or a request"""
+    name = threading.current_thread().name
+    if name == 'sim-loop':
+        return 'loop'
+    if name.startswith('sim-job'):
+        return 'job'
+    return 'request'
+
+
+class TimedLock:
+    """A lock that records how long each role waits for it and holds it, in seconds.
+
+    A drop-in for threading.Lock in `with` blocks and acquire()/release().
+    Only the holder writes the hold start, so the lock itself guards it.
+    """
+
+    def __init__(self, lock=None):
+        self._lock = lock if lock is not None else threading.Lock()
+        self.wait = {}
+        self.hold = {}
+        self._held_since = 0.0
+        self._held_role = None
+
+    def _histogram(self, table, role):
+        histogram = table.get(role)
+        if histogram is None:
+            histogram = table.setdefault(role, Histogram())
+        return histogram
+
+    def acquire(self, blocking=True, timeout=-1):
+        role = lock_role()
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            now = time.perf_counter()
+            self._histogram(self.wait, role).observe(now - start)
+            self._held_since, self._held_role = now, role
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self._held_since
+        role = self._held_role
+        self._lock.release()
+        self._histogram(self.hold, role).observe(held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    if value is None:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class PrometheusText:
+    """Builds a /metrics page in the Prometheus text exposition format (version 0.0.4)"""
+
+    def __init__(self, prefix='sim_'):
+        self.prefix = prefix
+        self._lines = []
+        self._declared = set()
+
+    def _declare(self, name, kind, help_text):
+        if name not in self._declared:
+            self._declared.add(name)
+            self._lines.append(f'# HELP {name} {help_text}')
+            self._lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, kind, name, value, help_text, **labels):
+        name = self.prefix + name
+        self._declare(name, kind, help_text)
+        self._lines.append(f'{name}{_label_text(labels)} {_number(value)}')
+
+    def gauge(self, name, value, help_text, **labels):
+        self.sample('gauge', name, value, help_text, **labels)
+
+    def counter(self, name, value, help_text, **labels):
+        self.sample('counter', name, value, help_text, **labels)
+
+    def histogram(self, name, snapshot, help_text, **labels):
+        """One series of a Histogram.snapshot(): cumulative buckets, sum and count"""
+        name = self.prefix + name
+        self._declare(name, 'histogram', help_text)
+        buckets, total, count = snapshot
+        for bound, running in buckets:
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            self._lines.append(f'{name}_bucket{_label_text(dict(labels, le=le))} {running}')
+        self._lines.append(f'{name}_sum{_label_text(labels)} {_number(total)}')
+        self._lines.append(f'{name}_count{_label_text(labels)} {count}')
+
+    def render(self):
+        return '\n'.join(self._lines) + '\n'
@@ -1,4 +1,5 @@
-from flask import Flask, send_file, jsonify, request
+from flask import Flask, Response, send_file, jsonify, request
+import json
 from flask_cors import CORS
 import os
 import sys
@@ -10,13 +11,23 @@ BASE_DIR = Path(__file__).resolve().parent
 PROJECT_DIR = BASE_DIR.parent
 FRONTEND_DIST_DIR = PROJECT_DIR / 'my-react-app' / 'dist'
 FRONTEND_INDEX_PATH = FRONTEND_DIST_DIR / 'index.html'
-SIM_FRAME_PATH = BASE_DIR / 'sim_frame.png'
 GEOTIFF_PATH = PROJECT_DIR / 'gpw_v4_population_density_rev11_2020_15_min.tif'
 
 if str(PROJECT_DIR) not in sys.path:
     sys.path.append(str(PROJECT_DIR))
 
-from sim import VirusSimulation
+from sim import VirusSimulation, rgb_frame
+from history import HistoryRecorder
+from region_stats import load_labels
+from interventions import make_mask
+from mobility import make_network
+import snapshot
+from frame_stream import STREAM_MIMETYPE, Frame, FrameBroadcaster, FrameRenderer
+from metrics import PrometheusText, RollingStats, TimedLock
+from profiling import PhaseTimer, SamplingProfiler
+from tiles import TilePyramid
+from sessions import SessionLimitError, SessionRegistry, session_nbytes
+from jobs import JobManager
 
 app = Flask(__name__)
 CORS(app)
@@ -29,56 +40,203 @@ sim_speed = 1.0
 tick_budget = 0.0
 last_loop_time = None
 BASE_TPS = 30.0
-
-sim_lock = threading.Lock()
+# Ticks the loop owed but skipped because a pass came later than the 0.25 s catch-up cap.
+dropped_ticks = 0.0
+
+# Frames are rendered in memory at most this often and pushed to /api/frames/stream.
+# Each streaming client holds one server thread, hence the client cap.
+frames = FrameBroadcaster(
+    max_fps=float(os.getenv('SIM_STREAM_MAX_FPS', '20')),
+    max_clients=int(os.getenv('SIM_STREAM_MAX_CLIENTS', '8')),
+    tile=int(os.getenv('SIM_STREAM_TILE', '32')),
+    keyframe_interval=float(os.getenv('SIM_STREAM_KEYFRAME_SECONDS', '10')),
+)
+# Frames are rendered on a separate thread from r/g/b snapshots taken under sim_lock.
+# SIM_RENDER_INLINE=1 renders under the lock instead, for comparing the two.
+renderer = FrameRenderer(frames, rgb_frame, inline=os.getenv('SIM_RENDER_INLINE', '0') == '1')
+
+# Zoomable map tiles, built lazily from r/g/b snapshots taken at most at the stream frame rate.
+tile_pyramid = TilePyramid(
+    tile_size=int(os.getenv('SIM_TILE_SIZE', '256')),
+    cache_size=int(os.getenv('SIM_TILE_CACHE', '1024')),
+    min_interval=1.0 / frames.max_fps,
+)
+
+# Snapshots are captured under sim_lock and written by a background thread.
+# SIM_AUTOSAVE_SECONDS > 0 autosaves periodically (keeping SIM_AUTOSAVE_KEEP),
+# and SIM_RESUME=1 restores the newest autosave when the simulation starts.
+snapshots = snapshot.SnapshotWriter(
+    os.getenv('SIM_SNAPSHOT_DIR') or PROJECT_DIR / 'snapshots',
+    compress=os.getenv('SIM_SNAPSHOT_COMPRESS', '1') == '1',
+    keep=int(os.getenv('SIM_AUTOSAVE_KEEP', '3')),
+)
+AUTOSAVE_SECONDS = float(os.getenv('SIM_AUTOSAVE_SECONDS', '0'))
+last_autosave = time.monotonic()
+
+# Simulation loop timings: how long each pass holds sim_lock, and the pass-to-pass period.
+lock_hold_ms = RollingStats()
+loop_period_ms = RollingStats()
+snapshot_capture_ms = RollingStats(size=100)
+
+# /api/run jobs step the simulation in chunks of SIM_RUN_CHUNK ticks and release
+# sim_lock between chunks, so reads wait at most one chunk. The live loop stops
+# ticking while a run job is active, so a job runs exactly the steps it asked for.
+jobs = JobManager(workers=int(os.getenv('SIM_JOB_WORKERS', '1')))
+RUN_CHUNK = max(1, int(os.getenv('SIM_RUN_CHUNK', '10')))
+MAX_RUN_STEPS = int(os.getenv('SIM_MAX_RUN_STEPS', '100000'))
+active_runs = 0
+
+# SIM_METRICS=0 turns off the /metrics histograms: phase timings in run_tick,
+# frame encode timings and sim_lock wait/hold timings all cost nothing then.
+METRICS = os.getenv('SIM_METRICS', '1') == '1'
+sim_lock = TimedLock(threading.Lock()) if METRICS else threading.Lock()
 thread_lock = threading.Lock()
+if METRICS:
+    Frame.encode_timer = PhaseTimer()
+
+# Sampling profiler for /api/profiler; SIM_PROFILE=1 starts it with the server.
+profiler = SamplingProfiler(
+    interval=float(os.getenv('SIM_PROFILE_INTERVAL_MS', '5')) / 1000,
+    thread_names=[name for name in os.getenv('SIM_PROFILE_THREADS', 'sim-loop,sim-job').split(',') if name],
+)
+if os.getenv('SIM_PROFILE', '0') == '1':
+    profiler.start()
 
 
-def _state_summary(sim_obj):
+def _state_summary(sim_obj, speed=None):
+    """Status from the summary the simulation publishes each tick; needs no lock"""
+    summary = sim_obj.summary
     return {
-        'iteration': sim_obj.iter,
+        'iteration': summary.iteration,
         'paused': sim_obj.paused,
-        'speed': sim_speed,
+        'speed': sim_speed if speed is None else speed,
+        'tps': round(summary.tps, 2),
+        'incidence': summary.incidence,
+        'published_at': summary.published_at,
+        'grid': {
+            'rows': sim_obj.ROWS,
+            'cols': sim_obj.COLS,
+            'region': sim_obj.region,
+            'bounds': [round(v, 6) for v in sim_obj.bounds],
+        },
+        'stochastic': sim_obj.stochastic.describe() if sim_obj.stochastic is not None else None,
         'totals': {
-            'susceptible': float(sim_obj.g.sum()),
-            'exposed': float(sim_obj.e.sum()),
-            'infected': float(sim_obj.r.sum()),
-            'recovered': float(sim_obj.b.sum()),
-            'dead': float(sim_obj.d.sum()),
+            'susceptible': summary.totals[1],
+            'exposed': summary.totals[3],
+            'infected': summary.totals[0],
+            'recovered': summary.totals[2],
+            'dead': summary.totals[4],
         },
     }
 
 
-def init_simulation(force=False):
+def _timings():
+    return {
+        'lock_hold': lock_hold_ms.summary(),
+        'loop_period': loop_period_ms.summary(),
+        'frame_capture': renderer.capture_ms.summary(),
+        'frame_render': renderer.render_ms.summary(),
+        'render_inline': renderer.inline,
+        'snapshot_capture': snapshot_capture_ms.summary(),
+    }
+
+
+def _save_snapshot(name=None, autosave=False):
+    """Capture the state and queue it for writing (call with sim_lock held)"""
+    with snapshot_capture_ms.time():
+        state = sim.snapshot()
+    return snapshots.submit(state, name, autosave=autosave)
+
+
+def _geotiff_path():
+    geotiff_override = os.getenv('POPULATION_TIF_PATH')
+    geotiff_path = Path(geotiff_override) if geotiff_override else GEOTIFF_PATH
+    if not geotiff_path.exists():
+        raise FileNotFoundError(f'GeoTIFF not found at {geotiff_path}')
+    return geotiff_path
+
+
+def _new_session_simulation(region=None, bbox=None):
+    return VirusSimulation(geotiff_path=str(_geotiff_path()), region=region, bbox=bbox)
+
+
+# Independent per-client simulations under /api/sessions. They share the
+# population grids; past SIM_SESSION_MEMORY_MB the least recently used ones
+# are hibernated to snapshot files. The global simulation above is separate.
+sessions = SessionRegistry(
+    _new_session_simulation,
+    os.getenv('SIM_SESSION_DIR') or snapshots.directory / 'sessions',
+    memory_budget=int(float(os.getenv('SIM_SESSION_MEMORY_MB', '2048')) * 2**20) or None,
+    max_sessions=int(os.getenv('SIM_MAX_SESSIONS', '64')),
+    idle_seconds=float(os.getenv('SIM_SESSION_IDLE_SECONDS', '300')),
+    workers=int(os.getenv('SIM_SESSION_WORKERS', '2')),
+    base_tps=BASE_TPS,
+)
+
+
+def init_simulation(force=False, region=None, bbox=None):
+    """Create the global simulation; region/bbox (else SIM_REGION/SIM_BBOX) restrict it to a window"""
     global sim
+    if sim is not None and not force:
+        return sim
     with sim_lock:
         if sim is not None and not force:
             return sim
 
-        geotiff_override = os.getenv('POPULATION_TIF_PATH')
-        geotiff_path = Path(geotiff_override) if geotiff_override else GEOTIFF_PATH
-        if not geotiff_path.exists():
-            raise FileNotFoundError(f'GeoTIFF not found at {geotiff_path}')
-
+        geotiff_path = _geotiff_path()
         print(f'Initializing simulation with GeoTIFF: {geotiff_path}')
-        sim = VirusSimulation(geotiff_path=str(geotiff_path))
-        sim.play()
+        new_sim = VirusSimulation(geotiff_path=str(geotiff_path), region=region, bbox=bbox)
+        new_sim.play()
+        if METRICS:
+            new_sim.set_phase_timer(True)
+        # Per-tick totals for /api/history; full chunks spill to SIM_HISTORY_DIR (default: a temp dir).
+        if sim is not None and sim.recorder is not None:
+            sim.recorder.close()
+        new_sim.recorder = HistoryRecorder(os.getenv('SIM_HISTORY_DIR') or None)
+        new_sim.publish_summary()
+        # Per-region totals for /api/regions: SIM_REGION_LABELS is 'continents', a label
+        # .npy/.tif or a shapefile (SIM_REGION_LABEL_FIELD names its regions).
+        label_path = os.getenv('SIM_REGION_LABELS')
+        if label_path:
+            try:
+                labels, names = load_labels(label_path, new_sim, os.getenv('SIM_REGION_LABEL_FIELD') or None)
+                new_sim.set_region_labels(labels, names)
+                print(f'Tracking {new_sim.region_index.K} regions from {label_path}')
+            except (OSError, ImportError, ValueError) as exc:
+                print(f'Unable to load region labels {label_path}: {exc}')
+
+        resume = snapshots.latest(autosave_only=True) if os.getenv('SIM_RESUME', '0') == '1' else None
+        if resume is not None:
+            try:
+                new_sim.restore(snapshots.path(resume))
+                new_sim.play()
+                print(f'Resumed from snapshot {resume} at iteration {new_sim.iter}')
+            except (OSError, ValueError) as exc:
+                print(f'Unable to resume from snapshot {resume}: {exc}')
+        tile_pyramid.invalidate()
 
         try:
-            sim.save_frame(str(SIM_FRAME_PATH))
+            renderer.capture(new_sim)
         except Exception as exc:
-            print(f'Unable to save initial frame: {exc}')
+            print(f'Unable to render initial frame: {exc}')
 
+        # Published last, so lock-free readers never see a half-initialized simulation.
+        sim = new_sim
         print('Simulation initialized!')
         return sim
 
 
 def simulation_loop():
-    global tick_budget, last_loop_time
+    global tick_budget, last_loop_time, last_autosave, dropped_ticks
+    last_pass = None
     while running:
+        pass_start = time.perf_counter()
+        if last_pass is not None:
+            loop_period_ms.add((pass_start - last_pass) * 1000)
+        last_pass = pass_start
         try:
-            with sim_lock:
-                if sim and not sim.paused:
+            with sim_lock, lock_hold_ms.time():
+                if sim and not sim.paused and not active_runs:
                     now = time.time()
                     if last_loop_time is None:
                         last_loop_time = now
@@ -87,9 +245,11 @@ def simulation_loop():
                     last_loop_time = now
 
                     # Avoid a huge catch-up burst after pauses or debugger stops.
+                    speed_now = max(0.1, float(sim_speed))
+                    if dt > 0.25:
+                        dropped_ticks += (dt - 0.25) * BASE_TPS * speed_now
                     dt = max(0.0, min(dt, 0.25))
 
-                    speed_now = max(0.1, float(sim_speed))
                     tick_budget += dt * BASE_TPS * speed_now
 
                     # Cap work per loop to keep rendering responsive.
@@ -98,9 +258,13 @@ def simulation_loop():
                         sim.run_tick()
                     tick_budget -= ticks_to_run
 
-                    # Save frame every 5 iterations for frontend polling.
-                    if sim.iter % 5 == 0:
-                        sim.save_frame(str(SIM_FRAME_PATH))
+                    # Publish a frame when the state moved on and the stream is due one.
+                    if renderer.due(sim.iter):
+                        renderer.capture(sim)
+
+                    if AUTOSAVE_SECONDS > 0 and time.monotonic() - last_autosave >= AUTOSAVE_SECONDS:
+                        last_autosave = time.monotonic()
+                        _save_snapshot(autosave=True)
                 else:
                     last_loop_time = time.time()
         except Exception as exc:
@@ -118,7 +282,7 @@ def ensure_simulation_thread():
             return
 
         running = True
-        sim_thread = threading.Thread(target=simulation_loop, daemon=True)
+        sim_thread = threading.Thread(target=simulation_loop, name='sim-loop', daemon=True)
         sim_thread.start()
         print('Simulation thread started.')
 
@@ -126,39 +290,397 @@ def ensure_simulation_thread():
 @app.route('/health')
 def health():
     ensure_simulation_thread()
-    with sim_lock:
-        return jsonify({
-            'status': 'ok',
-            'service': 'epidemic-simulation-backend',
-            'frontendBuilt': FRONTEND_INDEX_PATH.exists(),
-            'simulation': _state_summary(sim),
-            'frame_path': str(SIM_FRAME_PATH.name),
-        })
+    return jsonify({
+        'status': 'ok',
+        'service': 'epidemic-simulation-backend',
+        'frontendBuilt': FRONTEND_INDEX_PATH.exists(),
+        'simulation': _state_summary(sim),
+        'frame_url': '/sim_frame.png',
+        'frame_stream': '/api/frames/stream',
+        'timings_ms': _timings(),
+    })
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint; reads published values only, so it never starts or waits on the simulation"""
+    out = PrometheusText()
+    sim_obj = sim
+    out.gauge('up', int(sim_obj is not None), 'Whether the global simulation is initialized')
+    if sim_obj is not None:
+        summary = sim_obj.summary
+        out.gauge('iteration', summary.iteration, 'Ticks run since the simulation started')
+        out.gauge('paused', int(sim_obj.paused), 'Whether the simulation is paused')
+        out.gauge('speed', sim_speed, 'Speed multiplier of the live loop')
+        out.gauge('ticks_per_second', summary.tps, 'Achieved ticks per second')
+        out.gauge('target_ticks_per_second', 0 if sim_obj.paused else BASE_TPS * max(0.1, float(sim_speed)),
+                  'Ticks per second the live loop aims for')
+        out.gauge('tick_backlog', tick_budget, 'Ticks owed by the live loop but not yet run')
+        out.counter('dropped_ticks_total', dropped_ticks, 'Ticks skipped by the catch-up cap after late loop passes')
+        out.gauge('incidence', summary.incidence, 'New infections in the last tick')
+        for name, total in zip(('infected', 'susceptible', 'recovered', 'exposed', 'dead'), summary.totals):
+            out.gauge('compartment_total', total, 'Grid total of each compartment', compartment=name)
+        timer = sim_obj.phase_timer
+        if timer is not None:
+            for phase, snap in sorted(timer.snapshot().items()):
+                out.histogram('tick_phase_seconds', snap, 'Time spent in each phase of a tick', phase=phase)
+    if isinstance(sim_lock, TimedLock):
+        for role, histogram in sorted(sim_lock.wait.items()):
+            out.histogram('lock_wait_seconds', histogram.snapshot(), 'Time waited for sim_lock', role=role)
+        for role, histogram in sorted(sim_lock.hold.items()):
+            out.histogram('lock_hold_seconds', histogram.snapshot(), 'Time sim_lock was held', role=role)
+    if Frame.encode_timer is not None:
+        for encoding, snap in sorted(Frame.encode_timer.snapshot().items()):
+            out.histogram('frame_encode_seconds', snap, 'Time encoding stream frames', encoding=encoding)
+    out.gauge('stream_clients', frames.clients, 'Connected frame stream clients')
+    out.gauge('active_jobs', jobs.active(), 'Queued or running background jobs')
+    out.gauge('profiler_running', int(profiler.running), 'Whether the sampling profiler is running')
+    return Response(out.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/profiler')
+def profiler_status():
+    """Profiler state and its hottest functions; ?format=folded returns the collapsed stacks"""
+    if request.args.get('format') == 'folded':
+        return Response(profiler.folded(), mimetype='text/plain')
+    try:
+        limit = max(1, int(request.args.get('limit', '20')))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    return jsonify({'profiler': profiler.describe(), 'top': profiler.top(limit)})
+
+
+@app.route('/api/profiler', methods=['POST'])
+def set_profiler():
+    """{"enabled": bool, "interval_ms": n, "threads": [name prefix, ...]}; enabling clears the last profile"""
+    payload = request.get_json(silent=True) or {}
+    enabled = payload.get('enabled')
+    if not isinstance(enabled, bool):
+        return jsonify({'error': 'enabled must be true or false'}), 400
+    if enabled:
+        threads = payload.get('threads')
+        if threads is not None and not (isinstance(threads, list) and all(isinstance(t, str) for t in threads)):
+            return jsonify({'error': 'threads must be a list of thread name prefixes'}), 400
+        try:
+            interval = payload.get('interval_ms')
+            interval = None if interval is None else float(interval) / 1000
+        except (TypeError, ValueError):
+            return jsonify({'error': 'interval_ms must be a number'}), 400
+        profiler.start(interval, threads)
+    else:
+        profiler.stop()
+    return jsonify({'profiler': profiler.describe()})
 
 
 @app.route('/sim_frame.png')
 def get_frame():
     ensure_simulation_thread()
 
+    frame = frames.wait_latest(timeout=1.0)
+    if frame is None:
+        return jsonify({'error': 'Frame not yet generated'}), 404
+
+    # Pollers that already hold this frame get a 304 without the PNG being encoded.
+    if frame.etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(frame.payload('png'), mimetype='image/png')
+    response.set_etag(frame.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Sim-Iteration'] = str(frame.iteration)
+    return response
+
+
+@app.route('/api/frames/stream')
+def stream_frames():
+    """Push frames as a chunked binary stream.
+
+    Query parameters: fps (clamped to SIM_STREAM_MAX_FPS) and encoding
+    (raw, zlib or delta). Delta streams send only changed tiles relative to
+    the last frame the client acknowledged through /api/frames/ack, using
+    the id in X-Client-Id. See frame_stream.FRAME_HEADER for the packet layout.
+    """
+    ensure_simulation_thread()
+
+    encoding = request.args.get('encoding', 'zlib')
+    if encoding not in ('raw', 'zlib', 'delta'):
+        return jsonify({'error': 'encoding must be raw, zlib or delta'}), 400
+    fps = frames.negotiate_fps(request.args.get('fps', frames.max_fps))
+    client = frames.new_client_id()
+
+    if not frames.acquire_client():
+        return jsonify({'error': 'Too many stream clients, poll /sim_frame.png instead'}), 503
+
+    response = Response(frames.stream(fps, encoding, client), mimetype=STREAM_MIMETYPE)
+    response.call_on_close(lambda: frames.release_client(client))
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.headers['X-Frame-Rate'] = f'{fps:g}'
+    response.headers['X-Frame-Encoding'] = encoding
+    response.headers['X-Client-Id'] = client
+    response.headers['Access-Control-Expose-Headers'] = 'X-Client-Id, X-Frame-Rate, X-Frame-Encoding'
+    return response
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>')
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.png')
+def get_tile(z, x, y):
+    """One PNG tile of the zoomable map; see /api/tiles for the zoom levels"""
+    ensure_simulation_thread()
+
+    if tile_pyramid.needs_snapshot(sim):
+        with sim_lock:
+            if tile_pyramid.needs_snapshot(sim):
+                tile_pyramid.snapshot(sim)
+
+    entry = tile_pyramid.tile(z, x, y)
+    if entry is None:
+        return jsonify({'error': 'Tile out of range'}), 404
+
+    etag, png = entry
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route('/api/tiles')
+def tiles_info():
+    ensure_simulation_thread()
     with sim_lock:
-        if not SIM_FRAME_PATH.exists() and sim:
-            sim.save_frame(str(SIM_FRAME_PATH))
+        if tile_pyramid.needs_snapshot(sim):
+            tile_pyramid.snapshot(sim)
+        bounds = [round(v, 6) for v in sim.bounds]
+    return jsonify(dict(tile_pyramid.describe(), bounds=bounds))
 
-    if not SIM_FRAME_PATH.exists():
-        return jsonify({'error': 'Frame not yet generated'}), 404
 
-    return send_file(str(SIM_FRAME_PATH), mimetype='image/png', max_age=0)
+@app.route('/api/frames/ack', methods=['POST'])
+def ack_frame():
+    """Record the newest frame version a delta-stream client holds"""
+    payload = request.get_json(silent=True) or {}
+    try:
+        version = int(payload.get('version'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'version must be an integer'}), 400
+
+    if not frames.ack(str(payload.get('client', '')), version):
+        return jsonify({'error': 'Unknown stream client'}), 404
+    return jsonify({'status': 'acked', 'version': version})
 
 
 @app.route('/api/state')
 def state():
     ensure_simulation_thread()
+    return jsonify(_state_summary(sim))
+
+
+def _run_ticks(job, steps):
+    """Job body for /api/run: `steps` ticks in chunks, releasing sim_lock in between"""
+    global active_runs
     with sim_lock:
-        return jsonify(_state_summary(sim))
+        active_runs += 1
+    try:
+        done = 0
+        while done < steps:
+            chunk = min(RUN_CHUNK, steps - done)
+            with sim_lock, lock_hold_ms.time():
+                if sim.paused:
+                    sim.play()
+                for _ in range(chunk):
+                    sim.run_tick()
+                if renderer.due(sim.iter):
+                    renderer.capture(sim)
+                iteration = sim.iter
+            done += chunk
+            job.progress(done, iteration=iteration)
+            # Let waiting requests take the lock before the next chunk.
+            time.sleep(0.001)
+    finally:
+        with sim_lock:
+            active_runs -= 1
+            renderer.capture(sim)
+            summary = _state_summary(sim)
+    return summary
+
+
+@app.route('/api/history')
+def history():
+    """Per-tick totals, incidence and growth rate between ?start= and ?end= iterations,
+    min/max/mean decimated to ?points= buckets; ?columns= picks a comma-separated subset"""
+    ensure_simulation_thread()
+    try:
+        start = request.args.get('start', type=int)
+        end = request.args.get('end', type=int)
+        points = max(1, min(int(request.args.get('points', 1000)), 10000))
+        columns = [c for c in request.args.get('columns', '').split(',') if c] or None
+        result = sim.recorder.query(start, end, points, columns)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify(result)
+
+
+@app.route('/api/regions')
+def regions():
+    """Top ?top= regions by ?by= column (default infected), as totals or, with ?metric=share, per cell"""
+    ensure_simulation_thread()
+    index = sim.region_index
+    if index is None:
+        return jsonify({'error': 'No region labels configured (set SIM_REGION_LABELS)'}), 404
+    metric = request.args.get('metric', 'total')
+    if metric not in ('total', 'share'):
+        return jsonify({'error': "metric must be 'total' or 'share'"}), 400
+    try:
+        k = max(1, min(int(request.args.get('top', 10)), index.K or 1))
+        iteration, top = index.top(k, request.args.get('by', 'infected'), share=metric == 'share')
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'iteration': iteration, 'metric': metric, 'regions': top, 'index': index.describe()})
+
+
+@app.route('/api/regions/<region>')
+def region_series(region):
+    """Recorded totals of one region, by label code or name, decimated to ?points="""
+    ensure_simulation_thread()
+    index = sim.region_index
+    if index is None:
+        return jsonify({'error': 'No region labels configured (set SIM_REGION_LABELS)'}), 404
+    code = index.lookup(region)
+    if code is None:
+        return jsonify({'error': f"Unknown region '{region}'"}), 404
+    try:
+        points = max(1, min(int(request.args.get('points', 1000)), 10000))
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    try:
+        series = index.series(code, points)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 404
+    return jsonify(series)
+
+
+@app.route('/api/params', methods=['GET', 'POST'])
+def params():
+    """Current virus parameters; POST any of them ({"SPREAD_RATE": 1.2, "HEAL_RATE": 10, ...}).
+
+    Changes apply between ticks. The *_RATE delays are in ticks and resize
+    their delay queues, keeping the cohorts already queued; a delay that
+    crosses COMPACT_QUEUE_MIN_DELAY switches its queue to or from the
+    compact kind.
+    """
+    ensure_simulation_thread()
+    if request.method == 'GET':
+        return jsonify({'params': {name: getattr(sim, name) for name in snapshot.PARAMS}})
+    payload = request.get_json(silent=True) or {}
+    try:
+        start = time.perf_counter()
+        with sim_lock:
+            values = sim.update_params(**payload)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'status': 'params_updated', 'params': values, 'elapsed_ms': round(elapsed_ms, 3)})
+
+
+@app.route('/api/mobility', methods=['GET', 'POST'])
+def mobility():
+    """Travel network state; POST changes it.
+
+    Fields, all optional: "network" ('synthetic[:hubs[:edges]]', an .npz
+    path, or null to turn travel off), "scale" (overall flow factor),
+    "schedule" ([[iteration, factor], ...] steps), "nodes" ({"region" or
+    "bbox", "factor"}: 0 bans travel to and from that area) and "reset"
+    (true to reopen every node).
+    """
+    ensure_simulation_thread()
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            with sim_lock:
+                if 'network' in payload:
+                    spec = payload['network']
+                    sim.mobility = make_network(spec, sim) if spec else None
+                network = sim.mobility
+                if network is None:
+                    if set(payload) - {'network'}:
+                        return jsonify({'error': 'No mobility network loaded'}), 404
+                else:
+                    if payload.get('reset'):
+                        network.set_node_scale(1.0)
+                    if 'scale' in payload:
+                        scale = float(payload['scale'])
+                        if scale < 0:
+                            raise ValueError('scale must be non-negative')
+                        network.scale = scale
+                    if 'schedule' in payload:
+                        network.set_schedule(payload['schedule'])
+                    nodes = payload.get('nodes')
+                    if nodes:
+                        changed = network.scale_bbox(float(nodes.get('factor', 0.0)),
+                                                     nodes.get('region'), nodes.get('bbox'))
+                        print(f'Mobility factor {nodes.get("factor", 0.0)} on {changed} nodes')
+        except (OSError, TypeError, ValueError) as exc:
+            return jsonify({'error': str(exc)}), 400
+
+    network = sim.mobility
+    if network is None:
+        return jsonify({'enabled': False})
+    info = network.describe()
+    info['enabled'] = True
+    info['current_scale'] = network.scale_at(sim.iter)
+    return jsonify(info)
+
+
+@app.route('/api/interventions', methods=['GET', 'POST'])
+def interventions():
+    """Scheduled interventions; POST adds one.
+
+    {"kind": "seed" | "vaccinate" | "lockdown", the cells as "lat"/"lon"
+    (with "radius" in cells, e.g. from a map click), "region", "bbox" or
+    "label" (a region of SIM_REGION_LABELS), and optionally "start" (an
+    iteration, default the next tick) or "delay" (ticks from now), "end" or
+    "duration", "value" and "name"}.
+    """
+    ensure_simulation_thread()
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        try:
+            with sim_lock:
+                mask = make_mask(sim, payload)
+                start = int(payload['start']) if 'start' in payload else sim.iter + 1 + int(payload.get('delay', 0))
+                end = payload.get('end')
+                if end is None and payload.get('duration') is not None:
+                    end = start + int(payload['duration'])
+                intervention = sim.interventions.add(
+                    payload.get('kind', 'seed'), mask, start, end, payload.get('value'), payload.get('name'))
+        except (TypeError, ValueError) as exc:
+            return jsonify({'error': str(exc)}), 400
+        return jsonify({'status': 'scheduled', 'intervention': intervention.describe()}), 201
+    info = sim.interventions.describe()
+    info['iteration'] = sim.iter
+    info['list'] = sim.interventions.list()
+    return jsonify(info)
+
+
+@app.route('/api/interventions/<int:intervention_id>', methods=['DELETE'])
+def remove_intervention(intervention_id):
+    """Cancel an intervention; a lockdown's cells are restored on the next tick"""
+    ensure_simulation_thread()
+    if not sim.interventions.remove(intervention_id):
+        return jsonify({'error': f'No intervention {intervention_id}'}), 404
+    return jsonify({'status': 'removed', 'id': intervention_id})
 
 
 @app.route('/api/run', methods=['POST'])
 def run_steps():
+    """Start a background job of `steps` ticks and return its id right away.
+
+    Poll /api/jobs/<id> or subscribe to /api/jobs/<id>/events for progress.
+    With "wait": true the request blocks until the job finishes and answers
+    as the synchronous endpoint used to.
+    """
     ensure_simulation_thread()
 
     payload = request.get_json(silent=True) or {}
@@ -167,19 +689,80 @@ def run_steps():
     except (TypeError, ValueError):
         return jsonify({'error': 'steps must be an integer'}), 400
 
-    steps = max(1, min(steps, 1000))
+    steps = max(1, min(steps, MAX_RUN_STEPS))
+    job = jobs.submit('run', steps, lambda job: _run_ticks(job, steps), params={'steps': steps})
 
-    with sim_lock:
-        if sim.paused:
-            sim.play()
+    if payload.get('wait'):
+        info = job.wait()
+        if info['status'] != 'done':
+            return jsonify(info), 500 if info['status'] == 'failed' else 409
+        return jsonify({'status': 'ran', 'steps': steps, 'job': job.id, 'simulation': info['result']})
+
+    return jsonify({
+        'status': 'queued',
+        'job': job.id,
+        'steps': steps,
+        'status_url': f'/api/jobs/{job.id}',
+        'events_url': f'/api/jobs/{job.id}/events',
+    }), 202
 
-        for _ in range(steps):
-            sim.run_tick()
 
-        sim.save_frame(str(SIM_FRAME_PATH))
-        summary = _state_summary(sim)
+@app.route('/api/jobs')
+def list_jobs():
+    return jsonify({'jobs': jobs.list()})
 
-    return jsonify({'status': 'ran', 'steps': steps, 'simulation': summary})
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    """Job progress; ?wait=<seconds> long-polls until it changes after ?version=<n> or finishes"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30.0)
+        version = request.args.get('version', type=int)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number'}), 400
+    if wait > 0:
+        return jsonify(job.wait(version, timeout=wait))
+    return jsonify(job.describe())
+
+
+@app.route('/api/jobs/<job_id>/events')
+def job_events(job_id):
+    """Server-sent events with the job's progress until it finishes"""
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        version = -1
+        while True:
+            info = job.wait(version, timeout=15.0)
+            if info['version'] == version:
+                # Nothing changed: a comment line keeps the connection alive.
+                yield ': keepalive\n\n'
+                continue
+            version = info['version']
+            yield f"event: {info['status']}\ndata: {json.dumps(info)}\n\n"
+            if job.finished:
+                return
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    if not job.cancel():
+        return jsonify({'error': f'Job already {job.status}', 'job': job.describe()}), 409
+    return jsonify({'status': 'cancelling', 'job': job.describe()}), 202
 
 
 @app.route('/api/speed', methods=['POST'])
@@ -201,9 +784,8 @@ def set_speed():
     with sim_lock:
         sim_speed = new_speed
         tick_budget = 0.0
-        summary = _state_summary(sim)
 
-    return jsonify({'status': 'speed_updated', 'speed': new_speed, 'simulation': summary})
+    return jsonify({'status': 'speed_updated', 'speed': new_speed, 'simulation': _state_summary(sim)})
 
 
 @app.route('/pause', methods=['POST'])
@@ -227,7 +809,8 @@ def vaccinate():
     ensure_simulation_thread()
     with sim_lock:
         sim.vaccinate()
-        sim.save_frame(str(SIM_FRAME_PATH))
+        renderer.capture(sim)
+        tile_pyramid.invalidate()
     return jsonify({'status': 'vaccinated'})
 
 
@@ -237,10 +820,190 @@ def restart_sim():
     with sim_lock:
         sim.restart()
         sim.play()
-        sim.save_frame(str(SIM_FRAME_PATH))
+        renderer.capture(sim)
+        tile_pyramid.invalidate()
     return jsonify({'status': 'restarted'})
 
 
+@app.route('/api/snapshots')
+def list_snapshots():
+    return jsonify({'snapshots': snapshots.list()})
+
+
+@app.route('/api/snapshots', methods=['POST'])
+def save_snapshot():
+    """Snapshot the running simulation; only the in-memory copy pauses the tick loop"""
+    ensure_simulation_thread()
+    payload = request.get_json(silent=True) or {}
+    try:
+        with sim_lock:
+            name = _save_snapshot(payload.get('name'))
+            iteration = sim.iter
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'status': 'saving', 'name': name, 'iteration': iteration}), 202
+
+
+@app.route('/api/snapshots/<name>')
+def snapshot_info(name):
+    try:
+        path = snapshots.path(name)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    job = snapshots.status(name)
+    if not path.exists():
+        if job is None:
+            return jsonify({'error': 'Snapshot not found'}), 404
+        return jsonify(dict(job, name=path.stem))
+    meta = snapshot.read_index(path)['meta']
+    return jsonify(dict(job or {'status': 'done'}, name=path.stem, bytes=path.stat().st_size, meta=meta))
+
+
+@app.route('/api/snapshots/<name>/restore', methods=['POST'])
+def restore_snapshot(name):
+    """Resume from a snapshot; optional JSON params override the rates to branch a what-if run"""
+    ensure_simulation_thread()
+    payload = request.get_json(silent=True) or {}
+    try:
+        path = snapshots.path(name)
+        if not path.exists():
+            return jsonify({'error': 'Snapshot not found'}), 404
+        # Reading and decompressing happen before the lock is taken.
+        state = snapshot.load(path)
+        with sim_lock:
+            sim.restore(state, payload.get('params'))
+            if payload.get('play', True):
+                sim.play()
+            renderer.capture(sim)
+            tile_pyramid.invalidate()
+            summary = _state_summary(sim)
+    except OSError as exc:
+        return jsonify({'error': f'Snapshot could not be read: {exc}'}), 400
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'status': 'restored', 'name': path.stem, 'simulation': summary})
+
+
+@app.route('/api/snapshots/<name>', methods=['DELETE'])
+def delete_snapshot(name):
+    try:
+        deleted = snapshots.delete(name)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+    if not deleted:
+        return jsonify({'error': 'Snapshot not found'}), 404
+    return jsonify({'status': 'deleted'})
+
+
+@app.route('/api/sessions')
+def list_sessions():
+    return jsonify({'registry': sessions.describe(), 'sessions': sessions.list()})
+
+
+@app.route('/api/sessions', methods=['POST'])
+def create_session():
+    """Get or create a session: JSON id (generated if absent), region/bbox, and optionally a
+    snapshot name (plus params) to branch from"""
+    payload = request.get_json(silent=True) or {}
+    try:
+        session = sessions.create(payload.get('id'), region=payload.get('region'), bbox=payload.get('bbox'))
+        sessions.start()
+        with sessions.use(session.id) as session:
+            if payload.get('snapshot'):
+                path = snapshots.path(payload['snapshot'])
+                if not path.exists():
+                    return jsonify({'error': 'Snapshot not found'}), 404
+                session.sim.restore(path, payload.get('params'))
+                session.nbytes = session_nbytes(session.sim)
+                session.generation += 1
+            session.sim.play()
+            summary = _state_summary(session.sim, session.speed)
+    except SessionLimitError as exc:
+        return jsonify({'error': str(exc)}), 503
+    except OSError as exc:
+        return jsonify({'error': f'Snapshot could not be read: {exc}'}), 400
+    except (KeyError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'id': session.id, 'simulation': summary}), 201
+
+
+@app.route('/api/sessions/<session_id>')
+def session_state(session_id):
+    try:
+        with sessions.use(session_id) as session:
+            return jsonify({'id': session.id, 'simulation': _state_summary(session.sim, session.speed)})
+    except KeyError:
+        return jsonify({'error': 'Session not found'}), 404
+
+
+@app.route('/api/sessions/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    if not sessions.delete(session_id):
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify({'status': 'deleted'})
+
+
+@app.route('/api/sessions/<session_id>/frame.png')
+def session_frame(session_id):
+    try:
+        with sessions.use(session_id) as session:
+            etag, png = session.frame_png()
+            iteration = session.sim.iter
+    except KeyError:
+        return jsonify({'error': 'Session not found'}), 404
+
+    response = Response(status=304) if etag in request.if_none_match else Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Sim-Iteration'] = str(iteration)
+    return response
+
+
+@app.route('/api/sessions/<session_id>/<action>', methods=['POST'])
+def session_action(session_id, action):
+    """play, pause, vaccinate, restart, run ({steps}), speed ({speed}) or params ({NAME: value}) on one session"""
+    if action not in ('play', 'pause', 'vaccinate', 'restart', 'run', 'speed', 'params'):
+        return jsonify({'error': f"Unknown session action '{action}'"}), 404
+    payload = request.get_json(silent=True) or {}
+    try:
+        steps = max(1, min(int(payload.get('steps', 1)), 1000)) if action == 'run' else 1
+        speed = max(0.1, min(float(payload.get('speed', 1.0)), 5.0)) if action == 'speed' else 1.0
+    except (TypeError, ValueError):
+        return jsonify({'error': 'steps must be an integer and speed a number'}), 400
+
+    try:
+        with sessions.use(session_id) as session:
+            session_sim = session.sim
+            if action == 'play':
+                session_sim.play()
+            elif action == 'pause':
+                session_sim.pause()
+            elif action == 'vaccinate':
+                session_sim.vaccinate()
+                session.generation += 1
+            elif action == 'restart':
+                session_sim.restart()
+                session_sim.play()
+                session.generation += 1
+            elif action == 'run':
+                session_sim.play()
+                for _ in range(steps):
+                    session_sim.run_tick()
+            elif action == 'params':
+                session_sim.update_params(**payload)
+                # New delays resize (or rebuild) the queues.
+                session.nbytes = session_nbytes(session_sim)
+            else:
+                session.speed = speed
+                session.tick_budget = 0.0
+            summary = _state_summary(session_sim, session.speed)
+    except KeyError:
+        return jsonify({'error': 'Session not found'}), 404
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify({'status': action, 'id': session_id, 'simulation': summary})
+
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_frontend(path):
@@ -0,0 +1,310 @@
+import contextlib
+import io
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import snapshot
+from sim import rgb_frame
+
+SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class SessionLimitError(RuntimeError):
+    """No room for another session within the session count or memory budget"""
+
+
+def session_nbytes(sim):
+    """Bytes a simulation holds on its own; the shared population grids are not counted"""
+    shared = {id(sim.sizeGrid), id(sim.sizeGridPow)}
+    arrays = [v for v in vars(sim).values() if isinstance(v, np.ndarray) and id(v) not in shared]
+    total = sum(arr.nbytes for arr in arrays)
+    return total + sum(q.nbytes for q in (sim.e_history, sim.r_history, sim.b_history))
+
+
+class Session:
+    """One independent simulation with its own lock, speed and tick budget"""
+
+    def __init__(self, session_id, sim, options):
+        self.id = session_id
+        self.sim = sim
+        self.options = options
+        self.lock = threading.Lock()
+        self.speed = 1.0
+        # The speed and the scheduler's budget fields are only touched under lock.
+        self.tick_budget = 0.0
+        self.last_loop_time = None
+        self.created_at = time.time()
+        self.last_access = time.monotonic()
+        self.last_stepped = 0.0
+        self.nbytes = session_nbytes(sim)
+        # Hibernated sessions keep only this snapshot file.
+        self.snapshot_path = None
+        # Bumped whenever the state changes without the iteration moving.
+        self.generation = 0
+        self._frame = None
+
+    @property
+    def hibernated(self):
+        return self.sim is None
+
+    def touch(self):
+        self.last_access = time.monotonic()
+
+    def frame_png(self):
+        """(etag, png) of the current state, re-encoded only when it changed (call with the lock held)"""
+        etag = f'{self.generation}-{self.sim.iter}'
+        if self._frame is None or self._frame[0] != etag:
+            buf = io.BytesIO()
+            Image.fromarray(rgb_frame(self.sim.r, self.sim.g, self.sim.b), 'RGB').save(buf, 'PNG')
+            self._frame = (etag, buf.getvalue())
+        return self._frame
+
+    def describe(self):
+        info = {
+            'id': self.id,
+            'hibernated': self.hibernated,
+            'speed': self.speed,
+            'bytes': 0 if self.hibernated else self.nbytes,
+            'idle_seconds': round(time.monotonic() - self.last_access, 3),
+            'created_at': self.created_at,
+            'options': self.options,
+        }
+        if not self.hibernated:
+            info['iteration'] = self.sim.iter
+            info['paused'] = self.sim.paused
+        return info
+
+
+class SessionRegistry:
+    """Independent simulations keyed by client or scenario id.
+
+    Every session's simulation is built by `factory(**options)`; the
+    population grids come from raster_cache, which hands every simulation
+    on the same grid the same read-only arrays, so a session only costs its
+    state and delay queues. When those exceed memory_budget bytes the least
+    recently used sessions are hibernated to snapshot files and woken again
+    on their next request. Playing sessions are stepped by a round-robin
+    scheduler on a pool of `workers` threads.
+    """
+
+    def __init__(self, factory, directory, memory_budget=None, max_sessions=64, idle_seconds=300.0,
+                 workers=2, base_tps=30.0, quantum=10):
+        self.factory = factory
+        self.directory = Path(directory)
+        self.memory_budget = memory_budget
+        self.max_sessions = int(max_sessions)
+        # Sessions nobody has requested for this long stop being stepped.
+        self.idle_seconds = float(idle_seconds)
+        self.base_tps = float(base_tps)
+        # Most ticks one session runs per scheduler round.
+        self.quantum = int(quantum)
+        self.workers = max(1, int(workers))
+        self.sessions = {}
+        self.hibernations = 0
+        self.wakes = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+        self._running = False
+
+    # Lookup and lifecycle
+
+    def create(self, session_id=None, **options):
+        """Session for session_id, created (with factory options) if it does not exist yet"""
+        if session_id is None:
+            session_id = uuid.uuid4().hex[:12]
+        if not SESSION_ID.match(str(session_id)):
+            raise ValueError('Session ids are 1-64 letters, digits, - or _')
+        with self._lock:
+            if session_id in self.sessions:
+                session = self.sessions[session_id]
+                session.touch()
+                return session
+            if len(self.sessions) >= self.max_sessions:
+                raise SessionLimitError(f'Session limit of {self.max_sessions} reached')
+
+        sim = self.factory(**options)
+        sim.verbose = False
+        session = Session(session_id, sim, options)
+        with self._lock:
+            # Another request may have created the same id meanwhile; keep the first.
+            session = self.sessions.setdefault(session_id, session)
+        self._enforce_budget(keep=session)
+        return session
+
+    def get(self, session_id):
+        """Awake session by id (woken from its snapshot if hibernated), or None"""
+        with self._lock:
+            session = self.sessions.get(session_id)
+        if session is None:
+            return None
+        session.touch()
+        if session.hibernated:
+            self._wake(session)
+            self._enforce_budget(keep=session)
+        return session
+
+    @contextlib.contextmanager
+    def use(self, session_id):
+        """Hold an awake session's lock: `with registry.use(id) as session:`; KeyError if unknown"""
+        while True:
+            session = self.get(session_id)
+            if session is None:
+                raise KeyError(session_id)
+            session.lock.acquire()
+            # It may have been hibernated between waking and locking.
+            if not session.hibernated:
+                break
+            session.lock.release()
+        try:
+            yield session
+        finally:
+            session.lock.release()
+
+    def delete(self, session_id):
+        with self._lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
+            return False
+        with session.lock:
+            session.sim = None
+            if session.snapshot_path is not None:
+                session.snapshot_path.unlink(missing_ok=True)
+        return True
+
+    def list(self):
+        with self._lock:
+            sessions = list(self.sessions.values())
+        return [session.describe() for session in sessions]
+
+    def memory_in_use(self):
+        with self._lock:
+            return sum(s.nbytes for s in self.sessions.values() if not s.hibernated)
+
+    def describe(self):
+        return {
+            'sessions': len(self.sessions),
+            'max_sessions': self.max_sessions,
+            'memory_in_use': self.memory_in_use(),
+            'memory_budget': self.memory_budget,
+            'hibernations': self.hibernations,
+            'wakes': self.wakes,
+            'workers': self.workers,
+        }
+
+    # Hibernation
+
+    def hibernate(self, session):
+        """Write the session to a snapshot file and drop its arrays"""
+        with session.lock:
+            if session.hibernated:
+                return
+            path = self.directory / f'session-{session.id}{snapshot.SnapshotWriter.SUFFIX}'
+            snapshot.save(session.sim.snapshot(), path)
+            session.snapshot_path = path
+            session.sim = None
+            session._frame = None
+            self.hibernations += 1
+
+    def _wake(self, session):
+        with session.lock:
+            if not session.hibernated:
+                return
+            sim = self.factory(**session.options)
+            sim.verbose = False
+            sim.restore(session.snapshot_path)
+            session.sim = sim
+            session.nbytes = session_nbytes(sim)
+            session.last_loop_time = None
+            session.snapshot_path.unlink(missing_ok=True)
+            session.snapshot_path = None
+            self.wakes += 1
+
+    def _enforce_budget(self, keep=None):
+        """Hibernate least recently used sessions until the awake ones fit the memory budget"""
+        if not self.memory_budget:
+            return
+        while self.memory_in_use() > self.memory_budget:
+            with self._lock:
+                candidates = [s for s in self.sessions.values() if not s.hibernated and s is not keep]
+            if not candidates:
+                return
+            self.hibernate(min(candidates, key=lambda s: s.last_access))
+
+    # Scheduling
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._running = True
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sim-session')
+            self._thread = threading.Thread(target=self._schedule, name='sim-sessions', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def _schedule(self):
+        while self._running:
+            now = time.monotonic()
+            with self._lock:
+                sessions = [s for s in self.sessions.values() if not s.hibernated]
+            runnable = []
+            # Sessions that waited longest for a turn go first.
+            for session in sorted(sessions, key=lambda s: s.last_stepped):
+                ticks = self._ticks_due(session, now)
+                if ticks:
+                    runnable.append((session, ticks))
+
+            # Each round gives every playing session at most `quantum` ticks and
+            # waits for all of them, so no session can starve the others.
+            futures = [self._pool.submit(self._step, session, ticks) for session, ticks in runnable]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as exc:
+                    print(f'Error stepping session: {exc}')
+            time.sleep(0.005)
+
+    def _ticks_due(self, session, now):
+        """Ticks to run this round, taken from the session's budget under its lock"""
+        # A session busy with a request sits this round out rather than stalling the others.
+        if not session.lock.acquire(blocking=False):
+            return 0
+        try:
+            sim = session.sim
+            if sim is None or sim.paused or now - session.last_access > self.idle_seconds:
+                session.last_loop_time = None
+                return 0
+            if session.last_loop_time is None:
+                session.last_loop_time = now
+            # Avoid a huge catch-up burst after pauses.
+            dt = max(0.0, min(now - session.last_loop_time, 0.25))
+            session.last_loop_time = now
+            session.tick_budget += dt * self.base_tps * max(0.1, float(session.speed))
+            ticks = min(int(session.tick_budget), self.quantum)
+            session.tick_budget -= ticks
+            return ticks
+        finally:
+            session.lock.release()
+
+    def _step(self, session, ticks):
+        with session.lock:
+            sim = session.sim
+            if sim is None:
+                return
+            for _ in range(ticks):
+                sim.run_tick()
+            session.last_stepped = time.monotonic()
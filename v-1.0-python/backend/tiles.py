@@ -0,0 +1,157 @@
+import hashlib
+import io
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+def block_mean(levels):
+    """Halve the resolution of a (channels, rows, cols) stack by averaging 2x2 blocks"""
+    _, rows, cols = levels.shape
+    if rows % 2 or cols % 2:
+        # Odd edges are padded by repeating the last row/column.
+        levels = np.pad(levels, ((0, 0), (0, rows % 2), (0, cols % 2)), mode='edge')
+    channels, rows, cols = levels.shape
+    return levels.reshape(channels, rows // 2, 2, cols // 2, 2).mean(axis=(2, 4), dtype=np.float32)
+
+
+class TilePyramid:
+    """Lazily built multi-resolution RGB tiles of the r/g/b compartments.
+
+    Zoom level max_zoom is the simulation grid itself; each level below it
+    averages 2x2 blocks of the one above, down to level 0, which fits in a
+    single tile. Levels and tiles are only computed when a tile is asked for.
+    Encoded tiles live in an LRU cache keyed by (state, iteration, z, x, y),
+    and a tile whose pixels did not change since it was last encoded reuses
+    that PNG and its ETag, so clients get 304s for regions that are settled.
+    """
+
+    def __init__(self, tile_size=256, cache_size=1024, min_interval=0.1):
+        self.tile_size = int(tile_size)
+        self.cache_size = int(cache_size)
+        # Snapshots of the live simulation are taken at most this often.
+        self.min_interval = float(min_interval)
+        self.generation = 0
+        self.iteration = None
+        self.shape = None
+        self.max_zoom = 0
+
+        self._source = None
+        self._snapshot_generation = None
+        self._levels = {}
+        self._lo = 0.0
+        self._scale = 0.0
+        self._snapshot_at = 0.0
+        self._cache = OrderedDict()
+        # Last PNG per (z, x, y), LRU-bounded like the cache, for ETag reuse across iterations.
+        self._fresh = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """Mark the state as changed without the iteration moving (vaccinate, restart)"""
+        with self._lock:
+            self.generation += 1
+
+    def needs_snapshot(self, sim_obj):
+        if self._source is None or self._snapshot_generation != self.generation:
+            return True
+        if sim_obj.iter == self.iteration:
+            return False
+        return time.monotonic() - self._snapshot_at >= self.min_interval
+
+    def snapshot(self, sim_obj):
+        """Copy sim_obj's r/g/b as the new full-resolution level (call with the simulation lock held)"""
+        source = np.stack([sim_obj.r, sim_obj.g, sim_obj.b])
+        with self._lock:
+            self._source = source
+            self._snapshot_generation = self.generation
+            self.iteration = sim_obj.iter
+            self._snapshot_at = time.monotonic()
+            self.shape = source.shape[1:]
+            self.max_zoom = max(0, math.ceil(math.log2(max(self.shape) / self.tile_size)))
+            self._levels = {self.max_zoom: source}
+
+            # Same normalization as sim.rgb_frame, computed once on the full grid;
+            # block means stay inside [lo, hi], so every level shares it.
+            lo, hi = float(source.min()), float(source.max())
+            self._lo = lo
+            self._scale = 255.0 / (hi - lo) if hi > lo else 255.0
+
+    def _level(self, z):
+        if z not in self._levels:
+            self._levels[z] = block_mean(self._level(z + 1))
+        return self._levels[z]
+
+    def level_shape(self, z):
+        rows, cols = self.shape
+        factor = 2 ** (self.max_zoom - z)
+        return -(-rows // factor), -(-cols // factor)
+
+    def tile_counts(self, z):
+        rows, cols = self.level_shape(z)
+        return -(-cols // self.tile_size), -(-rows // self.tile_size)
+
+    def tile(self, z, x, y):
+        """(etag, png bytes) of one tile, or None if it lies outside the pyramid"""
+        with self._lock:
+            if self._source is None or not 0 <= z <= self.max_zoom:
+                return None
+            nx, ny = self.tile_counts(z)
+            if not (0 <= x < nx and 0 <= y < ny):
+                return None
+
+            key = (self._snapshot_generation, self.iteration, z, x, y)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            size = self.tile_size
+            # Levels are never modified once built, so the view stays valid after a new snapshot.
+            block = self._level(z)[:, y * size:(y + 1) * size, x * size:(x + 1) * size]
+            lo, scale = self._lo, self._scale
+
+        # Rendering and PNG encoding run without the lock, so tile requests
+        # overlap and snapshot() is never kept waiting.
+        pixels = np.zeros((size, size, 3), dtype=np.uint8)
+        rgb = (np.moveaxis(block, 0, -1) - lo) * scale
+        pixels[:block.shape[1], :block.shape[2]] = np.clip(np.nan_to_num(rgb), 0, 255).astype(np.uint8)
+
+        digest = hashlib.blake2b(pixels.tobytes(), digest_size=8).hexdigest()
+        with self._lock:
+            fresh = self._fresh.get((z, x, y))
+        if fresh is not None and fresh[0] == digest:
+            entry = fresh
+        else:
+            buf = io.BytesIO()
+            Image.fromarray(pixels, 'RGB').save(buf, 'PNG')
+            entry = (digest, buf.getvalue())
+
+        with self._lock:
+            self._remember(self._fresh, (z, x, y), entry)
+            self._remember(self._cache, key, entry)
+        return entry
+
+    def _remember(self, lru, key, entry):
+        lru[key] = entry
+        lru.move_to_end(key)
+        while len(lru) > self.cache_size:
+            lru.popitem(last=False)
+
+    def describe(self):
+        with self._lock:
+            if self._source is None:
+                return None
+            return {
+                'tile_size': self.tile_size,
+                'max_zoom': self.max_zoom,
+                'grid': list(self.shape),
+                'iteration': self.iteration,
+                'levels': [
+                    {'z': z, 'shape': list(self.level_shape(z)), 'tiles': list(self.tile_counts(z))}
+                    for z in range(self.max_zoom + 1)
+                ],
+            }
@@ -0,0 +1,228 @@
+import math
+import numpy as np
+
+from convolution import STENCIL_MAX_CELLS, _same_offsets
+from transitions import TICK_COLUMNS, advance_cells
+
+
+class ComputeBackend:
+    """The per-cell part of a serial tick: spread source, convolution, transitions, clamps and normalization.
+
+    advance() takes the tick's cohorts from the delay queues, writes the
+    new infection cohort into `infected` and returns (sickened, healed,
+    relapsed, infected), like the tiled steppers. Those replace the
+    backend while they are set (see VirusSimulation.run_tick).
+    """
+
+    name = 'base'
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None, timer=None):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NumpyBackend(ComputeBackend):
+    """In-place numpy passes with the simulation's convolution engine, kept as the reference backend"""
+
+    name = 'numpy'
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None, timer=None):
+        np.multiply(sim.r, sim.spread_weight, out=sim._spread_src)
+        neighbor_sum = sim.conv_engine.convolve(sim._spread_src, sim._neighbor_sum)
+        if timer is not None:
+            timer.mark('convolution')
+        advance_cells(
+            sim.g, sim.e, sim.r, sim.b, sim.d,
+            neighbor_sum, sickened, healed, relapsed, infected,
+            sim._dead, sim._work, sim._mask,
+            sim.SPREAD_RATE, sim.FATALITY_RATE, totals, timer,
+        )
+        return sickened, healed, relapsed, infected
+
+
+def kernel_taps(kernel):
+    """(row offsets, col offsets, weights) of the non-zero kernel weights, in 'same'-mode convolution order"""
+    kernel = np.asarray(kernel)
+    off_r, off_c = _same_offsets(kernel.shape)
+    rows, cols = np.nonzero(kernel)
+    return (
+        (off_r - rows).astype(np.int64),
+        (off_c - cols).astype(np.int64),
+        kernel[rows, cols].astype(np.float64),
+    )
+
+
+def build_fused_tick(jit=None, prange=range):
+    """The fused per-cell loop, compiled with `jit` (e.g. numba.njit) or left as plain Python.
+
+    Each row first sums the stencil taps over the spread source into a
+    row accumulator (or copies a precomputed neighbor sum when no taps are
+    given), then one loop over its cells does the transitions, the clamps
+    and the normalization and sums the row into row_totals. Rows read
+    their neighbours only from the spread source, so the compartments can
+    be updated in place, rows in parallel.
+    """
+
+    def fused_tick(src, neighbor, tap_dy, tap_dx, tap_w, g, e, r, b, d,
+                   sickened, healed, relapsed, infected, spread_rate, fatality_rate, max_sum, eps, row_totals):
+        rows, cols = g.shape
+        ntaps = len(tap_w)
+        for y in prange(rows):
+            acc = np.zeros(cols)
+            if ntaps:
+                for t in range(ntaps):
+                    yy = y + tap_dy[t]
+                    if 0 <= yy < rows:
+                        dx = tap_dx[t]
+                        w = tap_w[t]
+                        lo = max(0, -dx)
+                        hi = min(cols, cols - dx)
+                        # Views indexed from 0, so the loop vectorizes without wraparound checks.
+                        acc_part = acc[lo:hi]
+                        src_part = src[yy, lo + dx:hi + dx]
+                        for i in range(hi - lo):
+                            acc_part[i] += w * src_part[i]
+            else:
+                acc[:] = neighbor[y]
+            g_row, e_row, r_row, b_row, d_row = g[y], e[y], r[y], b[y], d[y]
+            sickened_row, healed_row, relapsed_row, infected_row = sickened[y], healed[y], relapsed[y], infected[y]
+
+            t_r = t_g = t_b = t_e = t_d = t_new = 0.0
+            for x in range(cols):
+                # NaN and -inf to 0, +inf to the largest float (sanitize in transitions.py)
+                ns = acc[x]
+                if math.isnan(ns) or ns < -max_sum:
+                    ns = 0.0
+                elif ns > max_sum:
+                    ns = max_sum
+                new = ns * spread_rate / (ns * 3.0 + 1.0) * g_row[x]
+                if math.isnan(new) or math.isinf(new):
+                    new = 0.0
+                h = healed_row[x]
+                dead = h * fatality_rate
+                if math.isnan(dead) or math.isinf(dead):
+                    dead = 0.0
+                s = sickened_row[x]
+                back = relapsed_row[x]
+
+                gv = min(max(g_row[x] - new + back, 0.0), 1.0)
+                ev = min(max(e_row[x] + new - s, 0.0), 1.0)
+                rv = min(max(r_row[x] + s - h, 0.0), 1.0)
+                bv = min(max(b_row[x] + h - dead - back, 0.0), 1.0)
+                dv = min(max(d_row[x] + dead, 0.0), 1.0)
+                total = max(gv + rv + bv + dv + ev, eps)
+
+                g_row[x] = gv / total
+                e_row[x] = ev / total
+                r_row[x] = rv / total
+                b_row[x] = bv / total
+                d_row[x] = dv / total
+                infected_row[x] = new
+                t_r += r_row[x]
+                t_g += g_row[x]
+                t_b += b_row[x]
+                t_e += e_row[x]
+                t_d += d_row[x]
+                t_new += infected_row[x]
+            row_totals[y, 0] = t_r
+            row_totals[y, 1] = t_g
+            row_totals[y, 2] = t_b
+            row_totals[y, 3] = t_e
+            row_totals[y, 4] = t_d
+            row_totals[y, 5] = t_new
+
+    return fused_tick if jit is None else jit(fused_tick)
+
+
+class FusedBackend(ComputeBackend):
+    """The whole per-cell update in one loop over the cells (build_fused_tick), plus the spread multiply.
+
+    Kernels with more than STENCIL_MAX_CELLS weights are still convolved by
+    the simulation's engine (FFT for wide ones), and only the rest is fused.
+    Without a jit the loop runs as plain Python, which is only useful to
+    check the loop itself on small grids.
+    """
+
+    name = 'python'
+
+    def __init__(self, fused_tick=None):
+        self.fused_tick = fused_tick or build_fused_tick()
+        self._taps_key = None
+        self._row_totals = None
+
+    def _taps(self, sim):
+        key = sim.SPREAD_KERNEL.tobytes()
+        if key != self._taps_key:
+            taps = kernel_taps(sim.SPREAD_KERNEL)
+            if len(taps[2]) > STENCIL_MAX_CELLS:
+                taps = tuple(np.zeros(0, dtype=tap.dtype) for tap in taps)
+            self.taps = taps
+            self._taps_key = key
+        return self.taps
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None, timer=None):
+        tap_dy, tap_dx, tap_w = self._taps(sim)
+        np.multiply(sim.r, sim.spread_weight, out=sim._spread_src)
+        neighbor = sim._neighbor_sum
+        if not len(tap_w):
+            neighbor = sim.conv_engine.convolve(sim._spread_src, neighbor)
+            if timer is not None:
+                timer.mark('convolution')
+        if self._row_totals is None or len(self._row_totals) != sim.ROWS:
+            self._row_totals = np.zeros((sim.ROWS, len(TICK_COLUMNS)))
+        dtype = sim.dtype
+        self.fused_tick(
+            sim._spread_src, neighbor, tap_dy, tap_dx, tap_w,
+            sim.g, sim.e, sim.r, sim.b, sim.d, sickened, healed, relapsed, infected,
+            float(sim.SPREAD_RATE), float(sim.FATALITY_RATE),
+            float(np.finfo(dtype).max), float(np.finfo(dtype).eps), self._row_totals,
+        )
+        if totals is not None:
+            self._row_totals.sum(axis=0, out=totals)
+        if timer is not None:
+            timer.mark('fused')
+        return sickened, healed, relapsed, infected
+
+
+_numba_tick = None
+
+
+class NumbaBackend(FusedBackend):
+    """FusedBackend compiled by numba, with rows spread over its threads (NUMBA_NUM_THREADS)"""
+
+    name = 'numba'
+
+    def __init__(self):
+        global _numba_tick
+        if _numba_tick is None:
+            try:
+                import numba
+            except ImportError:
+                raise ImportError("The 'numba' compute backend needs numba (pip install numba)") from None
+            # Reassociation lets the row sums vectorize; NaN and inf checks stay exact.
+            # The compiled loop is cached in __pycache__ for the next start.
+            jit = numba.njit(parallel=True, error_model='numpy', fastmath={'reassoc'}, cache=True)
+            _numba_tick = build_fused_tick(jit, numba.prange)
+        super().__init__(_numba_tick)
+
+
+BACKENDS = {backend.name: backend for backend in (NumpyBackend, NumbaBackend, FusedBackend)}
+
+
+def numba_available():
+    try:
+        import numba  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def make_backend(name='numpy'):
+    """Build a compute backend by name ('auto' takes numba when it is installed, else numpy)"""
+    if name == 'auto':
+        name = 'numba' if numba_available() else 'numpy'
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown compute backend '{name}'. Options: auto, {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
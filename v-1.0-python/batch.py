@@ -0,0 +1,328 @@
+"""Headless batch runner: fan a parameter grid out over a process pool.
+
+Usage:
+    python batch.py sweep.json --out runs/ --workers 64
+
+The grid file (JSON, or YAML if PyYAML is installed) looks like:
+
+    {
+        "geotiff": "gpw_v4_population_density_rev11_2020_15_min.tif",
+        "downsample_factor": 4,
+        "region": "europe",
+        "ticks": 2000,
+        "snapshot_every": 100,
+        "stop": {"infected_below": 1e-6, "min_ticks": 50},
+        "base": {"HEAL_RATE": 7},
+        "grid": {"SPREAD_RATE": [0.5, 1.0, 1.5], "seed": [[56, 215], [40, 100]]},
+        "stochastic": {"people": 1e6, "seed": 0, "replicates": 20}
+    }
+
+Every combination of the "grid" lists (merged over "base") is one
+scenario; an explicit "scenarios" list of parameter dicts is appended.
+Each scenario writes <out>/<scenario id>/ with one .npy column per
+per-tick total, optional RGB snapshot frames, and meta.json. A scenario
+whose meta.json says "complete" is skipped when the sweep is re-run.
+
+With "stochastic", every scenario runs "replicates" times in stochastic
+mode (see stochastic.py), each replicate on its own random streams, and
+--bands writes the replicates' quantiles per tick to <out>/bands/.
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+
+from transitions import TOTAL_COLUMNS
+
+# Parameters a scenario may set on VirusSimulation.
+SIM_PARAMS = ('SPREAD_RATE', 'FATALITY_RATE', 'SICKEN_RATE', 'HEAL_RATE', 'IMMUNITY_LOSS_RATE')
+DEFAULT_GEOTIFF = Path(__file__).resolve().parent / 'gpw_v4_population_density_rev11_2020_15_min.tif'
+
+
+def load_grid(path):
+    """Read a sweep definition from JSON or YAML"""
+    path = Path(path)
+    text = path.read_text()
+    if path.suffix.lower() in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit('PyYAML is required for YAML sweep files (pip install pyyaml)')
+        return yaml.safe_load(text)
+    return json.loads(text)
+
+
+def expand_scenarios(spec):
+    """Cartesian product of spec['grid'] over spec['base'], plus explicit spec['scenarios'], per replicate"""
+    base = dict(spec.get('base', {}))
+    grid = spec.get('grid', {})
+    keys = list(grid)
+
+    scenarios = []
+    for values in itertools.product(*(grid[key] for key in keys)):
+        scenarios.append({**base, **dict(zip(keys, values))})
+    for extra in spec.get('scenarios', []):
+        scenarios.append({**base, **extra})
+    if not scenarios:
+        scenarios.append(base)
+    replicates = int((spec.get('stochastic') or {}).get('replicates', 1))
+    if replicates > 1:
+        scenarios = [{**params, 'replicate': i} for params in scenarios for i in range(replicates)]
+
+    for params in scenarios:
+        unknown = set(params) - set(SIM_PARAMS) - {'seed', 'replicate'}
+        if unknown:
+            raise ValueError(f"Unknown scenario parameters: {', '.join(sorted(unknown))}")
+    return scenarios
+
+
+def scenario_id(params, settings):
+    """Stable id from the scenario parameters and the run settings that affect output"""
+    key = json.dumps({'params': params, 'settings': settings}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+# Per-process simulations and their default parameters, keyed by
+# (geotiff, downsample factor, delay queue, region, bbox).
+_sims = {}
+
+
+def _get_sim(geotiff, factor, delay_queue, region=None, bbox=None):
+    key = (geotiff, factor, delay_queue, region, bbox and tuple(bbox))
+    if key not in _sims:
+        from sim import VirusSimulation
+        with contextlib.redirect_stdout(io.StringIO()):
+            sim = VirusSimulation(geotiff_path=geotiff, downsample_factor=factor, delay_queue=delay_queue,
+                                  region=region, bbox=bbox)
+        sim.verbose = False
+        _sims[key] = (sim, {name: getattr(sim, name) for name in SIM_PARAMS})
+    return _sims[key]
+
+
+def _worker_init(geotiff, factor, delay_queue, region=None, bbox=None):
+    # Load the raster once per worker, before the first scenario arrives.
+    _get_sim(geotiff, factor, delay_queue, region, bbox)
+
+
+def run_scenario(params, settings, run_dir):
+    """Run one scenario to its tick limit or stop condition and write its outputs"""
+    sim, defaults = _get_sim(settings['geotiff'], settings['downsample_factor'], settings['delay_queue'],
+                             settings.get('region'), settings.get('bbox'))
+    for name in SIM_PARAMS:
+        setattr(sim, name, params.get(name, defaults[name]))
+
+    stochastic = settings.get('stochastic')
+    if stochastic:
+        # Replicates share the sweep's seed and differ in a second word of entropy.
+        sim.set_stochastic(float(stochastic['people']), [int(stochastic.get('seed', 0)), params.get('replicate', 0)],
+                           workers=1)
+    else:
+        sim.set_stochastic(None)
+    sim.restart()
+    sim.play()
+    if 'seed' in params:
+        sim.r.fill(0)
+        sim.seed_infection(*params['seed'])
+
+    run_dir = Path(run_dir)
+    run_dir.mkdir(parents=True, exist_ok=True)
+    ticks = int(settings['ticks'])
+    columns = {
+        name: np.lib.format.open_memmap(run_dir / f'{name}.npy', mode='w+', dtype=np.float32, shape=(ticks,))
+        for name in TOTAL_COLUMNS
+    }
+
+    snapshot_every = int(settings.get('snapshot_every') or 0)
+    frames = None
+    if snapshot_every > 0:
+        frames = np.lib.format.open_memmap(
+            run_dir / 'frames.npy', mode='w+', dtype=np.uint8,
+            shape=(ticks // snapshot_every, sim.ROWS, sim.COLS, 3),
+        )
+
+    stop = settings.get('stop') or {}
+    infected_below = stop.get('infected_below')
+    min_ticks = int(stop.get('min_ticks', 0))
+
+    start = time.perf_counter()
+    done = 0
+    stopped_early = False
+    for tick in range(ticks):
+        sim.run_tick()
+        done = tick + 1
+        for name, total in zip(TOTAL_COLUMNS, sim.summary.totals):
+            columns[name][tick] = total
+
+        if frames is not None and done % snapshot_every == 0:
+            frames[done // snapshot_every - 1] = sim.render_rgb()
+        if infected_below is not None and done >= min_ticks:
+            if columns['infected'][tick] + columns['exposed'][tick] < infected_below:
+                stopped_early = True
+                break
+    elapsed = time.perf_counter() - start
+
+    for arr in columns.values():
+        arr.flush()
+    if frames is not None:
+        frames.flush()
+    del columns, frames
+    if stopped_early:
+        # Trim the preallocated columns to the ticks actually run.
+        for name in TOTAL_COLUMNS:
+            path = run_dir / f'{name}.npy'
+            np.save(path, np.load(path)[:done])
+        if snapshot_every > 0:
+            path = run_dir / 'frames.npy'
+            np.save(path, np.load(path)[:done // snapshot_every])
+
+    meta = {
+        'status': 'complete',
+        'params': params,
+        'settings': settings,
+        'ticks': done,
+        'stopped_early': stopped_early,
+        'seconds': elapsed,
+        'columns': list(TOTAL_COLUMNS),
+        'shape': [sim.ROWS, sim.COLS],
+    }
+    # meta.json is written last so an interrupted run is redone on resume.
+    tmp = run_dir / 'meta.json.tmp'
+    tmp.write_text(json.dumps(meta, indent=2))
+    os.replace(tmp, run_dir / 'meta.json')
+    return done, elapsed
+
+
+def is_complete(run_dir):
+    meta = Path(run_dir) / 'meta.json'
+    if not meta.exists():
+        return False
+    try:
+        return json.loads(meta.read_text()).get('status') == 'complete'
+    except ValueError:
+        return False
+
+
+def _stochastic_settings(stochastic):
+    # The replicate count is left out: it only adds scenarios, so raising it keeps the finished ones.
+    if not stochastic:
+        return None
+    return {'people': float(stochastic['people']), 'seed': int(stochastic.get('seed', 0))}
+
+
+def write_bands(out_dir, quantiles=(0.05, 0.5, 0.95)):
+    """Per-tick quantiles of every column over each scenario's replicates, in <out>/bands/<id>.npz.
+
+    Replicates that stopped early are held at their last totals. Returns
+    the index also written to <out>/bands/index.json.
+    """
+    out_dir = Path(out_dir)
+    groups = {}
+    for meta_path in sorted(out_dir.glob('*/meta.json')):
+        meta = json.loads(meta_path.read_text())
+        if meta.get('status') != 'complete':
+            continue
+        params = {k: v for k, v in meta['params'].items() if k != 'replicate'}
+        key = scenario_id(params, meta['settings'])
+        groups.setdefault(key, (params, []))[1].append(meta_path.parent)
+
+    bands_dir = out_dir / 'bands'
+    bands_dir.mkdir(exist_ok=True)
+    index = []
+    for key, (params, run_dirs) in groups.items():
+        columns = {name: [np.load(run_dir / f'{name}.npy') for run_dir in run_dirs] for name in TOTAL_COLUMNS}
+        ticks = max(len(series) for series in columns['infected'])
+        bands = {}
+        for name, runs in columns.items():
+            stacked = np.stack([np.pad(series, (0, ticks - len(series)), mode='edge') for series in runs])
+            bands[name] = np.quantile(stacked, quantiles, axis=0).astype(np.float32)
+        np.savez(bands_dir / f'{key}.npz', quantiles=np.asarray(quantiles), **bands)
+        index.append({'id': key, 'params': params, 'replicates': len(run_dirs), 'ticks': ticks})
+    (bands_dir / 'index.json').write_text(json.dumps({'quantiles': list(quantiles), 'bands': index}, indent=2))
+    return index
+
+
+def run_sweep(spec, out_dir, workers=None, ticks=None):
+    """Run every scenario of a sweep spec that is not already complete"""
+    settings = {
+        'geotiff': str(spec.get('geotiff') or os.getenv('POPULATION_TIF_PATH') or DEFAULT_GEOTIFF),
+        'downsample_factor': int(spec.get('downsample_factor', os.getenv('SIM_DOWNSAMPLE_FACTOR', '4'))),
+        'delay_queue': spec.get('delay_queue', os.getenv('SIM_DELAY_QUEUE', 'exact')),
+        'region': spec.get('region'),
+        'bbox': spec.get('bbox'),
+        'ticks': int(ticks or spec.get('ticks', 1000)),
+        'snapshot_every': int(spec.get('snapshot_every', 0)),
+        'stop': spec.get('stop') or {},
+        'stochastic': _stochastic_settings(spec.get('stochastic')),
+    }
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    pending = []
+    skipped = 0
+    for params in expand_scenarios(spec):
+        run_dir = out_dir / scenario_id(params, settings)
+        if is_complete(run_dir):
+            skipped += 1
+        else:
+            pending.append((params, run_dir))
+    print(f'{len(pending)} scenarios to run, {skipped} already complete')
+    if not pending:
+        return
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(pending)))
+    total_ticks = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_worker_init,
+        initargs=(settings['geotiff'], settings['downsample_factor'], settings['delay_queue'],
+                  settings['region'], settings['bbox']),
+    ) as pool:
+        futures = {
+            pool.submit(run_scenario, params, settings, str(run_dir)): run_dir
+            for params, run_dir in pending
+        }
+        for finished, future in enumerate(as_completed(futures), start=1):
+            run_dir = futures[future]
+            try:
+                done, _ = future.result()
+            except Exception as exc:
+                print(f'[{finished}/{len(pending)}] {run_dir.name} failed: {exc}')
+                continue
+            total_ticks += done
+            elapsed = time.perf_counter() - start
+            print(f'[{finished}/{len(pending)}] {run_dir.name} {done} ticks | '
+                  f'aggregate {total_ticks / elapsed:.1f} ticks/s')
+
+    elapsed = time.perf_counter() - start
+    print(f'Done: {total_ticks} ticks in {elapsed:.1f}s ({total_ticks / max(elapsed, 1e-9):.1f} ticks/s, '
+          f'{workers} workers)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a parameter sweep of VirusSimulation headlessly')
+    parser.add_argument('grid', help='sweep definition (.json, .yaml or .yml)')
+    parser.add_argument('--out', '-o', default='runs', help='output directory, one subdirectory per scenario')
+    parser.add_argument('--workers', '-w', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--ticks', '-t', type=int, default=None, help='override the tick limit')
+    parser.add_argument('--bands', action='store_true',
+                        help='afterwards, write quantile bands over the replicates of each scenario')
+    args = parser.parse_args(argv)
+
+    run_sweep(load_grid(args.grid), args.out, workers=args.workers, ticks=args.ticks)
+    if args.bands:
+        index = write_bands(args.out)
+        print(f'Wrote quantile bands for {len(index)} scenarios to {Path(args.out) / "bands"}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
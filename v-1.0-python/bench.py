@@ -0,0 +1,377 @@
+"""Benchmarks for the simulation core and the HTTP endpoints, on synthetic population rasters.
+
+Usage:
+    python bench.py --out bench.json                          # run everything
+    python bench.py --out bench.json --compare baseline.json  # run, then flag regressions
+    python bench.py --compare baseline.json --results bench.json
+    python bench.py --quick --factors 8                       # smoke run
+    python bench.py --backend numba --compare numpy.json      # a compute backend against a baseline
+
+No GeoTIFF is needed: a GPW-like density raster (720 x 1440 cells of
+0.25 degrees, nodata oceans, lognormal land with city peaks) is generated
+from --raster-seed and every downsample factor runs on it. Each factor
+times simulation startup (cold and warm raster cache), run_tick,
+save_frame, get_state_data and vaccinate, then serves the Flask app on
+a local port and loads /api/state, /sim_frame.png and /api/run from
+--clients concurrent clients while the live loop keeps ticking.
+
+Results are JSON: "results" maps "<benchmark>@f<factor>" to millisecond
+statistics. Comparing flags every benchmark whose median grew by more
+than --threshold (and NOISE_FLOOR_MS) and exits with status 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from sim import VirusSimulation
+
+# The GPW 15-minute grid the real raster uses.
+RASTER_SHAPE = (720, 1440)
+DEFAULT_FACTORS = (1, 2, 4, 8)
+# GPW's nodata value, so the synthetic oceans go through the same sanitizing.
+NODATA = -3.4028230607370965e+38
+DEFAULT_THRESHOLD = 0.15
+# Changes smaller than this are timer noise, whatever their share.
+NOISE_FLOOR_MS = 0.05
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def synthetic_raster(path, shape=RASTER_SHAPE, seed=0, continents=14, cities=400):
+    """Write a population density GeoTIFF shaped like GPW's: land ellipses of lognormal density plus city peaks"""
+    import rasterio
+    from rasterio.transform import Affine
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(seed)
+    rows, cols = shape
+    y = (np.arange(rows) + 0.5)[:, None] / rows
+    x = (np.arange(cols) + 0.5)[None, :] / cols
+    land = np.zeros(shape, dtype=bool)
+    for _ in range(continents):
+        cy, cx = rng.uniform(0.15, 0.8), rng.uniform(0, 1)
+        ry, rx = rng.uniform(0.04, 0.18), rng.uniform(0.04, 0.22)
+        land |= ((y - cy) / ry) ** 2 + ((x - cx) / rx) ** 2 < 1
+
+    density = rng.lognormal(mean=2.0, sigma=1.5, size=shape)
+    peaks = np.zeros(shape)
+    land_cells = np.flatnonzero(land)
+    centres = rng.choice(land_cells, size=min(cities, len(land_cells)), replace=False)
+    peaks.ravel()[centres] = rng.pareto(1.2, size=len(centres)) * 5e4
+    density += gaussian_filter(peaks, sigma=1.5)
+    density = np.where(land, density, NODATA).astype(np.float32)
+
+    profile = {
+        'driver': 'GTiff', 'width': cols, 'height': rows, 'count': 1, 'dtype': 'float32',
+        'crs': 'EPSG:4326', 'transform': Affine(360.0 / cols, 0.0, -180.0, 0.0, -180.0 / rows, 90.0),
+        'nodata': NODATA,
+    }
+    with rasterio.open(path, 'w', **profile) as dataset:
+        dataset.write(density, 1)
+    return path
+
+
+def summarize(samples_ms, **extra):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    stats = {
+        'unit': 'ms',
+        'n': int(len(samples)),
+        'median': float(np.median(samples)),
+        'mean': float(samples.mean()),
+        'p95': float(np.percentile(samples, 95)),
+        'min': float(samples.min()),
+        'max': float(samples.max()),
+    }
+    stats.update(extra)
+    return stats
+
+
+def time_calls(fn, repeat, warmup=1):
+    """Milliseconds of each of `repeat` calls of fn, after `warmup` untimed ones"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+@contextlib.contextmanager
+def _env(**values):
+    old = {name: os.environ.get(name) for name in values}
+    os.environ.update({name: str(value) for name, value in values.items()})
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _new_sim(geotiff, factor):
+    with contextlib.redirect_stdout(io.StringIO()):
+        sim = VirusSimulation(geotiff_path=str(geotiff), downsample_factor=factor)
+    sim.verbose = False
+    return sim
+
+
+def bench_core(geotiff, factor, work_dir, ticks, repeat):
+    """Startup, run_tick, save_frame, get_state_data and vaccinate for one downsample factor"""
+    import raster_cache
+
+    results = {}
+    cold, warm = [], []
+    for i in range(max(1, repeat // 3)):
+        cache = Path(work_dir) / f'cache-f{factor}-{i}'
+        with _env(SIM_RASTER_CACHE=cache):
+            start = time.perf_counter()
+            _new_sim(geotiff, factor)
+            cold.append((time.perf_counter() - start) * 1000)
+            # Forget the grids this process already mapped, so warm runs read the cache files.
+            raster_cache._loaded.clear()
+            start = time.perf_counter()
+            sim = _new_sim(geotiff, factor)
+            warm.append((time.perf_counter() - start) * 1000)
+            raster_cache._loaded.clear()
+    results['init_cold'] = summarize(cold)
+    results['init_warm'] = summarize(warm)
+
+    sim.play()
+    samples = time_calls(sim.run_tick, ticks, warmup=5)
+    results['run_tick'] = summarize(samples, ticks_per_second=1000 / np.mean(samples), grid=[sim.ROWS, sim.COLS])
+    frame = Path(work_dir) / f'frame-f{factor}.png'
+    results['save_frame'] = summarize(time_calls(lambda: sim.save_frame(str(frame)), repeat))
+    results['get_state_data'] = summarize(time_calls(sim.get_state_data, max(1, repeat // 3)))
+    results['vaccinate'] = summarize(time_calls(sim.vaccinate, repeat))
+    return results
+
+
+def _request(base_url, method, path, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base_url + path, data=data, method=method,
+                                 headers={'Content-Type': 'application/json'} if data else {})
+    with urllib.request.urlopen(req, timeout=120) as response:
+        response.read()
+        return response.status
+
+
+def load_endpoint(base_url, method, path, body, requests, clients):
+    """Latencies of `requests` calls spread over `clients` threads, plus throughput and errors"""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    remaining = iter(range(requests))
+
+    def client():
+        nonlocal errors
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                ok = _request(base_url, method, path, body) < 400
+            except OSError:
+                ok = False
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                errors += not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        for future in [pool.submit(client) for _ in range(clients)]:
+            future.result()
+    wall = time.perf_counter() - start
+    return summarize(latencies, requests_per_second=requests / wall, errors=errors, clients=clients)
+
+
+class LocalServer:
+    """backend/server.py's app on a local port, pointed at the synthetic raster"""
+
+    def __init__(self, geotiff, work_dir):
+        from werkzeug.serving import make_server
+
+        os.environ.setdefault('SIM_SNAPSHOT_DIR', str(Path(work_dir) / 'snapshots'))
+        os.environ.setdefault('SIM_HISTORY_DIR', str(Path(work_dir) / 'history'))
+        os.environ['POPULATION_TIF_PATH'] = str(geotiff)
+        backend = str(BASE_DIR / 'backend')
+        if backend not in sys.path:
+            sys.path.insert(0, backend)
+        import server
+
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        self.server = server
+        self.httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.httpd.server_port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def load(self, factor):
+        """Replace the served simulation with one at `factor`"""
+        with _env(SIM_DOWNSAMPLE_FACTOR=factor), contextlib.redirect_stdout(io.StringIO()):
+            self.server.init_simulation(force=True)
+            self.server.ensure_simulation_thread()
+        self.server.sim.verbose = False
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+def bench_http(local, factor, requests, clients, run_steps):
+    """/api/state, /sim_frame.png and /api/run under concurrent load while the live loop ticks"""
+    local.load(factor)
+    url = local.base_url
+    results = {
+        'http_state': load_endpoint(url, 'GET', '/api/state', None, requests, clients),
+        'http_frame': load_endpoint(url, 'GET', '/sim_frame.png', None, max(1, requests // 4), clients),
+        'http_run': load_endpoint(url, 'POST', '/api/run', {'steps': run_steps, 'wait': True},
+                                  max(1, requests // 10), clients),
+    }
+    results['http_run']['steps'] = run_steps
+    # Stop the live loop, so it does not tick under the next factor's core benchmarks.
+    with local.server.sim_lock:
+        local.server.sim.pause()
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_benchmarks(factors=DEFAULT_FACTORS, ticks=100, repeat=10, requests=200, clients=8, run_steps=10,
+                   http=True, raster_seed=0, work_dir=None, backend=None):
+    """Run the suite and return the results document"""
+    backend = backend or os.getenv('SIM_BACKEND', 'numpy')
+    settings = {
+        'factors': list(factors), 'ticks': ticks, 'repeat': repeat, 'requests': requests,
+        'clients': clients, 'run_steps': run_steps, 'http': http, 'raster_seed': raster_seed,
+        'raster_shape': list(RASTER_SHAPE), 'backend': backend,
+    }
+    doc = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'settings': settings,
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory(prefix='sim-bench-', dir=work_dir) as tmp:
+        geotiff = synthetic_raster(Path(tmp) / 'synthetic_population.tif', seed=raster_seed)
+        local = LocalServer(geotiff, tmp) if http else None
+        try:
+            for factor in factors:
+                with _env(SIM_RASTER_CACHE=Path(tmp) / 'cache', SIM_BACKEND=backend):
+                    results = bench_core(geotiff, factor, tmp, ticks, repeat)
+                    if local is not None:
+                        results.update(bench_http(local, factor, requests, clients, run_steps))
+                for name, stats in results.items():
+                    doc['results'][f'{name}@f{factor}'] = stats
+                    print(f'f{factor:<2} {name:<15} median {stats["median"]:10.3f} ms  p95 {stats["p95"]:10.3f} ms')
+        finally:
+            if local is not None:
+                local.close()
+    return doc
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """Rows (name, baseline ms, current ms, change) and the names that regressed, by median"""
+    rows, regressions = [], []
+    base_results, results = baseline['results'], current['results']
+    for name in sorted(set(base_results) | set(results)):
+        if name not in results or name not in base_results:
+            rows.append((name, base_results.get(name, {}).get('median'), results.get(name, {}).get('median'), None))
+            continue
+        before, after = base_results[name]['median'], results[name]['median']
+        change = (after - before) / before if before > 0 else 0.0
+        rows.append((name, before, after, change))
+        if change > threshold and after - before > NOISE_FLOOR_MS:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions, threshold):
+    def fmt(value):
+        return f'{value:10.3f}' if value is not None else f'{"-":>10}'
+
+    print(f'{"benchmark":<24} {"base ms":>10} {"now ms":>10}   change')
+    for name, before, after, change in rows:
+        if change is None:
+            note = 'new' if before is None else 'missing'
+        else:
+            note = f'{change:+7.1%}' + ('  REGRESSION' if name in regressions else '')
+        print(f'{name:<24} {fmt(before)} {fmt(after)}   {note}')
+    print(f'{len(regressions)} regressions over {threshold:.0%}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark VirusSimulation and the backend on synthetic rasters')
+    parser.add_argument('--out', '-o', help='write the results JSON here')
+    parser.add_argument('--compare', '-c', help='baseline results JSON to compare against')
+    parser.add_argument('--results', help='compare this results JSON instead of running the suite')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='median slowdown counted as a regression (default 0.15)')
+    parser.add_argument('--factors', type=int, nargs='+', default=list(DEFAULT_FACTORS), help='downsample factors')
+    parser.add_argument('--ticks', type=int, default=100, help='timed run_tick calls per factor')
+    parser.add_argument('--repeat', type=int, default=10, help='timed calls of the other core benchmarks')
+    parser.add_argument('--requests', type=int, default=200, help='/api/state requests per factor')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--no-http', action='store_true', help='skip the endpoint benchmarks')
+    parser.add_argument('--raster-seed', type=int, default=0, help='seed of the synthetic raster')
+    parser.add_argument('--quick', action='store_true', help='few repetitions, for smoke tests')
+    parser.add_argument('--backend', help='compute backend of the simulations (default: SIM_BACKEND or numpy)')
+    args = parser.parse_args(argv)
+
+    if args.results:
+        if not args.compare:
+            parser.error('--results needs --compare')
+        current = json.loads(Path(args.results).read_text())
+    else:
+        if args.quick:
+            args.ticks, args.repeat, args.requests = 10, 3, 20
+        current = run_benchmarks(args.factors, args.ticks, args.repeat, args.requests, args.clients,
+                                 http=not args.no_http, raster_seed=args.raster_seed, backend=args.backend)
+        if args.out:
+            Path(args.out).write_text(json.dumps(current, indent=2))
+            print(f'Wrote {args.out}')
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if baseline['meta'].get('settings') != current['meta'].get('settings'):
+            print('Note: the baseline was run with different settings')
+        if baseline['meta'].get('platform') != current['meta'].get('platform'):
+            print('Note: the baseline was run on a different platform')
+        rows, regressions = compare(baseline, current, args.threshold)
+        print_comparison(rows, regressions, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
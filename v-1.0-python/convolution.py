@@ -0,0 +1,286 @@
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import ndimage
+from scipy.signal import convolve2d
+import os
+import sys
+import time
+
+# Kernels up to this many cells are stepped with shifted slices.
+STENCIL_MAX_CELLS = 25
+# Kernels at least this wide (in either axis) go through the FFT path.
+FFT_MIN_SIZE = 15
+
+
+def _same_offsets(kernel_shape):
+    """Offset of the 'same' output window inside the full convolution, matching convolve2d"""
+    return tuple((k - 1) // 2 for k in kernel_shape)
+
+
+def _shift_slices(offset, length):
+    """Destination and source slices so that dst[y] reads src[y + offset] along one axis"""
+    span = max(length - abs(offset), 0)
+    if offset >= 0:
+        return slice(0, span), slice(offset, offset + span)
+    return slice(-offset, -offset + span), slice(0, span)
+
+
+class ConvolutionEngine:
+    """Zero-filled 'same'-mode 2D convolution of a fixed kernel into a reusable buffer.
+
+    shape may carry leading batch axes, e.g. (members, rows, cols); the kernel
+    is applied to the last two axes of every batch entry in one call.
+    """
+
+    name = 'base'
+
+    def __init__(self, kernel, shape, dtype=np.float32):
+        self.kernel = np.asarray(kernel, dtype=dtype)
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.out = np.empty(self.shape, dtype=dtype)
+        # Kernels without negative weights cannot produce negative sums, so
+        # roundoff below zero can be clamped away.
+        self.non_negative = bool(np.all(self.kernel >= 0))
+
+    def convolve(self, src, out=None):
+        """Convolve src with the kernel, writing into out (defaults to self.out)"""
+        raise NotImplementedError
+
+    def __call__(self, src, out=None):
+        return self.convolve(src, out)
+
+
+class DirectEngine(ConvolutionEngine):
+    """scipy.signal.convolve2d, kept as the reference implementation"""
+
+    name = 'direct'
+
+    def convolve(self, src, out=None):
+        out = self.out if out is None else out
+        for idx in np.ndindex(src.shape[:-2]):
+            out[idx] = convolve2d(src[idx], self.kernel, mode='same', boundary='fill', fillvalue=0)
+        return out
+
+
+class StencilEngine(ConvolutionEngine):
+    """Sum of shifted slices, one multiply-add per non-zero kernel weight"""
+
+    name = 'stencil'
+
+    def __init__(self, kernel, shape, dtype=np.float32):
+        super().__init__(kernel, shape, dtype)
+        self._scratch = np.empty(self.shape, dtype=dtype)
+
+        # Convolution flips the kernel, so weight (i, j) reads src shifted by
+        # (offset - i, offset - j). Slices are precomputed once.
+        rows, cols = self.shape[-2:]
+        off_r, off_c = _same_offsets(self.kernel.shape)
+        self._taps = []
+        for (i, j), weight in np.ndenumerate(self.kernel):
+            if weight == 0:
+                continue
+            dst_r, src_r = _shift_slices(off_r - i, rows)
+            dst_c, src_c = _shift_slices(off_c - j, cols)
+            self._taps.append((self.dtype(weight), (Ellipsis, dst_r, dst_c), (Ellipsis, src_r, src_c)))
+
+    def convolve(self, src, out=None):
+        out = self.out if out is None else out
+        out.fill(0)
+        scratch = self._scratch
+        for weight, dst, source in self._taps:
+            np.multiply(src[source], weight, out=scratch[dst])
+            out[dst] += scratch[dst]
+        return out
+
+
+class SeparableEngine(ConvolutionEngine):
+    """Two 1D passes for rank-1 kernels (kernel == outer(col, row))"""
+
+    name = 'separable'
+
+    def __init__(self, kernel, shape, dtype=np.float32):
+        super().__init__(kernel, shape, dtype)
+        factors = separable_factors(self.kernel)
+        if factors is None:
+            raise ValueError('kernel is not separable (rank > 1)')
+        col, row = factors
+        self._scratch = np.empty(self.shape, dtype=dtype)
+        self._tmp = np.empty(self.shape, dtype=dtype)
+
+        rows, cols = self.shape[-2:]
+        off_r, off_c = _same_offsets(self.kernel.shape)
+        self._col_taps = [
+            (dtype(w),) + _shift_slices(off_r - i, rows)
+            for i, w in enumerate(col) if w != 0
+        ]
+        self._row_taps = [
+            (dtype(w),) + _shift_slices(off_c - j, cols)
+            for j, w in enumerate(row) if w != 0
+        ]
+
+    def convolve(self, src, out=None):
+        out = self.out if out is None else out
+        tmp = self._tmp
+        scratch = self._scratch
+
+        # Column pass into tmp, then row pass into out.
+        tmp.fill(0)
+        for weight, dst, source in self._col_taps:
+            np.multiply(src[..., source, :], weight, out=scratch[..., dst, :])
+            tmp[..., dst, :] += scratch[..., dst, :]
+
+        out.fill(0)
+        for weight, dst, source in self._row_taps:
+            np.multiply(tmp[..., source], weight, out=scratch[..., dst])
+            out[..., dst] += scratch[..., dst]
+        return out
+
+
+class NdimageEngine(ConvolutionEngine):
+    """scipy.ndimage.convolve writing straight into the output buffer"""
+
+    name = 'ndimage'
+
+    def __init__(self, kernel, shape, dtype=np.float32):
+        super().__init__(kernel, shape, dtype)
+        # ndimage centres even kernels one cell later than convolve2d does.
+        # Batch axes get a length-1 kernel axis so members never mix.
+        batch = len(self.shape) - 2
+        self._kernel_nd = self.kernel.reshape((1,) * batch + self.kernel.shape)
+        self._origin = (0,) * batch + tuple(-1 if k % 2 == 0 else 0 for k in self.kernel.shape)
+
+    def convolve(self, src, out=None):
+        out = self.out if out is None else out
+        ndimage.convolve(src, self._kernel_nd, output=out, mode='constant', cval=0.0, origin=self._origin)
+        return out
+
+
+class FFTEngine(ConvolutionEngine):
+    """Real FFT convolution with the kernel spectrum computed once and cached"""
+
+    name = 'fft'
+
+    def __init__(self, kernel, shape, dtype=np.float32, workers=None):
+        super().__init__(kernel, shape, dtype)
+        kh, kw = self.kernel.shape
+        rows, cols = self.shape[-2:]
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._fft_shape = (
+            sp_fft.next_fast_len(rows + kh - 1, real=True),
+            sp_fft.next_fast_len(cols + kw - 1, real=True),
+        )
+        self._padded = np.zeros(self.shape[:-2] + self._fft_shape, dtype=dtype)
+        self._kernel_spectrum = sp_fft.rfft2(self.kernel, s=self._fft_shape, workers=self.workers)
+
+        off_r, off_c = _same_offsets(self.kernel.shape)
+        self._window = (Ellipsis, slice(off_r, off_r + rows), slice(off_c, off_c + cols))
+
+    def convolve(self, src, out=None):
+        out = self.out if out is None else out
+        rows, cols = self.shape[-2:]
+        self._padded[..., :rows, :cols] = src
+
+        spectrum = sp_fft.rfft2(self._padded, workers=self.workers)
+        spectrum *= self._kernel_spectrum
+        full = sp_fft.irfft2(spectrum, s=self._fft_shape, workers=self.workers)
+        out[...] = full[self._window]
+
+        if self.non_negative:
+            np.maximum(out, 0, out=out)
+        return out
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (DirectEngine, StencilEngine, SeparableEngine, NdimageEngine, FFTEngine)
+}
+
+
+def separable_factors(kernel, tol=1e-6):
+    """Return (col, row) with kernel == outer(col, row), or None if the kernel is not rank-1"""
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if kernel.ndim != 2 or not kernel.any():
+        return None
+    u, s, vt = np.linalg.svd(kernel)
+    if len(s) > 1 and s[1] > tol * s[0]:
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0] * scale
+
+
+def choose_engine_name(kernel):
+    """Pick a strategy from the kernel's size and rank"""
+    kernel = np.asarray(kernel)
+    if max(kernel.shape) >= FFT_MIN_SIZE:
+        return 'fft'
+    if separable_factors(kernel) is not None:
+        return 'separable'
+    if kernel.size <= STENCIL_MAX_CELLS:
+        return 'stencil'
+    return 'ndimage'
+
+
+def make_convolution_engine(kernel, shape, name='auto', dtype=np.float32):
+    """Build a convolution engine by name ('auto' picks one from the kernel)"""
+    if name == 'auto':
+        name = choose_engine_name(kernel)
+    if name not in ENGINES:
+        raise ValueError(f"Unknown convolution engine '{name}'. Options: auto, {', '.join(ENGINES)}")
+    return ENGINES[name](kernel, shape, dtype=dtype)
+
+
+def benchmark_convolution_engines(kernel, shape, repeats=20, seed=0, dtype=np.float32):
+    """Time every applicable engine on a random grid and compare it against the direct engine"""
+    rng = np.random.default_rng(seed)
+    src = rng.random(shape, dtype=dtype)
+    reference = DirectEngine(kernel, shape, dtype).convolve(src).copy()
+    scale = max(float(np.abs(reference).max()), np.finfo(dtype).eps)
+
+    results = {}
+    for name, engine_cls in ENGINES.items():
+        try:
+            engine = engine_cls(kernel, shape, dtype=dtype)
+        except ValueError as exc:
+            results[name] = {'skipped': str(exc)}
+            continue
+
+        engine.convolve(src)  # warm-up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            out = engine.convolve(src)
+        elapsed = (time.perf_counter() - start) / repeats
+
+        results[name] = {
+            'seconds_per_call': elapsed,
+            'max_rel_error': float(np.abs(out - reference).max()) / scale,
+        }
+    return results
+
+
+def gaussian_kernel(radius, sigma=None, dtype=np.float32):
+    """Square Gaussian dispersal kernel with the given radius, peak weight 1"""
+    sigma = sigma if sigma is not None else max(radius / 2.0, 1e-6)
+    axis = np.arange(-radius, radius + 1, dtype=np.float64)
+    profile = np.exp(-0.5 * (axis / sigma) ** 2)
+    return np.outer(profile, profile).astype(dtype)
+
+
+if __name__ == '__main__':
+    # Usage: python convolution.py [rows] [cols] [radius ...]
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 720
+    cols = int(sys.argv[2]) if len(sys.argv) > 2 else 1440
+    radii = [int(r) for r in sys.argv[3:]] or [1, 3, 10]
+
+    from sim import VirusSimulation
+    kernels = [('SPREAD_KERNEL', VirusSimulation.DEFAULT_SPREAD_KERNEL)]
+    kernels += [(f'gaussian r={r}', gaussian_kernel(r)) for r in radii]
+
+    for label, kernel in kernels:
+        print(f'{label} {kernel.shape} on {rows} x {cols} (auto: {choose_engine_name(kernel)})')
+        for name, result in benchmark_convolution_engines(kernel, (rows, cols)).items():
+            if 'skipped' in result:
+                print(f'  {name:10s} skipped: {result["skipped"]}')
+            else:
+                print(f'  {name:10s} {result["seconds_per_call"] * 1000:8.3f} ms   '
+                      f'rel err {result["max_rel_error"]:.2e}')
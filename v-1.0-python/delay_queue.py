@@ -0,0 +1,560 @@
+import numpy as np
+import contextlib
+import copy
+import io
+import sys
+
+
+class DelayQueue:
+    """Fixed-delay cohort queue: a cohort pushed at tick t is popped at tick t + delay.
+
+    push_pop takes ownership of the pushed array and hands back an array the
+    caller now owns, so run_tick can rotate its buffers without copying.
+    """
+
+    name = 'base'
+
+    def __init__(self, delay, shape, dtype=np.float32):
+        self.delay = max(1, int(delay))
+        self.shape = tuple(shape)
+        self.dtype = dtype
+
+    def push_pop(self, cohort):
+        """Push this tick's cohort and return the cohort that has waited `delay` ticks"""
+        raise NotImplementedError
+
+    def add_to_latest(self, values):
+        """Add mass to the most recently pushed cohort"""
+        raise NotImplementedError
+
+    def resize(self, delay):
+        """Change the delay in place, stretching the queued cohorts' remaining waits to match"""
+        raise NotImplementedError
+
+    @property
+    def depth(self):
+        """Number of queued cohorts (slots or stages)"""
+        return self.delay
+
+    def cohort(self, k, out):
+        """Copy the k-th queued cohort, in order of remaining wait (0 is popped next), into out"""
+        raise NotImplementedError
+
+    def set_cohort(self, k, values):
+        """Overwrite the k-th queued cohort, in order of remaining wait"""
+        raise NotImplementedError
+
+    def gather(self, cells):
+        """(slots, len(cells)) float64 copy of the queued mass at flat cell indices, one row per slot"""
+        raise NotImplementedError
+
+    def scatter(self, cells, values):
+        """Overwrite the queued mass at flat cell indices with a gather()-shaped block"""
+        raise NotImplementedError
+
+    def state(self):
+        """(meta, arrays) copy of the queued cohorts, for snapshots"""
+        raise NotImplementedError
+
+    def load_state(self, meta, arrays):
+        """Replace the queued cohorts with a state() result; the arrays are adopted, not copied"""
+        raise NotImplementedError
+
+    @property
+    def nbytes(self):
+        raise NotImplementedError
+
+
+class ExactQueue(DelayQueue):
+    """Ring buffer of full-precision slots, swapped by reference"""
+
+    name = 'exact'
+
+    def __init__(self, delay, shape, dtype=np.float32):
+        super().__init__(delay, shape, dtype)
+        self.slots = list(np.zeros((self.delay,) + self.shape, dtype=dtype))
+        self.idx = 0
+
+    def push_pop(self, cohort):
+        popped = self.slots[self.idx]
+        self.slots[self.idx] = cohort
+        self.idx = (self.idx + 1) % self.delay
+        return popped
+
+    def add_to_latest(self, values):
+        self.slots[(self.idx - 1) % self.delay] += values
+
+    def gather(self, cells):
+        return np.stack([slot.reshape(-1)[cells] for slot in self.slots]).astype(np.float64)
+
+    def scatter(self, cells, values):
+        for slot, row in zip(self.slots, values):
+            slot.reshape(-1)[cells] = row
+
+    def cohort(self, k, out):
+        out[...] = self.slots[(self.idx + k) % self.delay]
+
+    def set_cohort(self, k, values):
+        self.slots[(self.idx + k) % self.delay][...] = values
+
+    def resize(self, delay):
+        delay = max(1, int(delay))
+        if delay == self.delay:
+            return
+        # Cohorts in order of remaining wait; slot arrays are recycled as soon
+        # as every new slot they feed has been filled.
+        old = [self.slots[(self.idx + i) % self.delay] for i in range(self.delay)]
+        weights = remap_weights(self.delay, delay)
+        last_use = {}
+        for i, j, _ in weights:
+            last_use[i] = j
+        released = {}
+        for i, j in last_use.items():
+            released.setdefault(j, []).append(old[i])
+        free, slots = [], []
+        scratch = np.empty(self.shape, dtype=self.dtype)
+        pending = iter(weights)
+        entry = next(pending, None)
+        for j in range(delay):
+            out = free.pop() if free else np.empty(self.shape, dtype=self.dtype)
+            first = True
+            while entry is not None and entry[1] == j:
+                i, _, weight = entry
+                if first:
+                    np.multiply(old[i], weight, out=out)
+                else:
+                    np.multiply(old[i], weight, out=scratch)
+                    out += scratch
+                first = False
+                entry = next(pending, None)
+            slots.append(out)
+            free.extend(released.get(j, ()))
+        self.slots = slots
+        self.delay = delay
+        self.idx = 0
+
+    def state(self):
+        return {'idx': self.idx}, {'slots': np.stack(self.slots)}
+
+    def load_state(self, meta, arrays):
+        # Slots become views of one block; push_pop swaps them out by reference as usual.
+        self.slots = list(arrays['slots'])
+        self.idx = int(meta['idx'])
+
+    @property
+    def nbytes(self):
+        return sum(slot.nbytes for slot in self.slots)
+
+
+class _EncodedRingQueue(DelayQueue):
+    """Ring buffer whose slots are stored in a compact encoding.
+
+    The oldest slot is decoded into a spare full-precision buffer before the
+    new cohort is encoded over it; the pushed array then becomes the spare.
+    """
+
+    def __init__(self, delay, shape, dtype=np.float32):
+        super().__init__(delay, shape, dtype)
+        self.idx = 0
+        self._spare = np.zeros(self.shape, dtype=dtype)
+        self._work = np.empty(self.shape, dtype=dtype)
+
+    def _encode(self, slot, cohort):
+        raise NotImplementedError
+
+    def _decode(self, slot, out):
+        raise NotImplementedError
+
+    def push_pop(self, cohort):
+        popped = self._spare
+        self._decode(self.idx, popped)
+        self._encode(self.idx, cohort)
+        self._spare = cohort
+        self.idx = (self.idx + 1) % self.delay
+        return popped
+
+    def add_to_latest(self, values):
+        slot = (self.idx - 1) % self.delay
+        self._decode(slot, self._work)
+        self._work += values
+        self._encode(slot, self._work)
+
+    def gather(self, cells):
+        out = np.empty((self.delay, len(cells)))
+        for slot in range(self.delay):
+            self._decode(slot, self._work)
+            out[slot] = self._work.reshape(-1)[cells]
+        return out
+
+    def scatter(self, cells, values):
+        for slot in range(self.delay):
+            self._decode(slot, self._work)
+            self._work.reshape(-1)[cells] = values[slot]
+            self._encode(slot, self._work)
+
+    def cohort(self, k, out):
+        self._decode((self.idx + k) % self.delay, out)
+
+    def set_cohort(self, k, values):
+        self._encode((self.idx + k) % self.delay, values)
+
+    def _allocate(self):
+        """Fresh, empty slot storage for self.delay slots"""
+        raise NotImplementedError
+
+    def resize(self, delay):
+        delay = max(1, int(delay))
+        if delay == self.delay:
+            return
+        # The shallow copy keeps decoding the old slots while new ones are encoded.
+        old = copy.copy(self)
+        self.delay = delay
+        self.idx = 0
+        self._allocate()
+        # The spare is overwritten by the next push_pop, so it can accumulate here.
+        out, part = self._spare, self._work
+        pending = iter(remap_weights(old.delay, delay))
+        entry = next(pending, None)
+        for j in range(delay):
+            first = True
+            while entry is not None and entry[1] == j:
+                i, _, weight = entry
+                target = out if first else part
+                old._decode((old.idx + i) % old.delay, target)
+                if weight != 1:
+                    target *= weight
+                if not first:
+                    out += part
+                first = False
+                entry = next(pending, None)
+            self._encode(j, out)
+
+    def state(self):
+        return {'idx': self.idx}, {'slots': self.slots.copy()}
+
+    def load_state(self, meta, arrays):
+        self.slots = arrays['slots']
+        self.idx = int(meta['idx'])
+
+    @property
+    def _buffer_nbytes(self):
+        return self._spare.nbytes + self._work.nbytes
+
+
+class Float16Queue(_EncodedRingQueue):
+    """Slots stored as float16 (half the memory, ~3 significant digits)"""
+
+    name = 'float16'
+
+    def __init__(self, delay, shape, dtype=np.float32):
+        super().__init__(delay, shape, dtype)
+        self._allocate()
+
+    def _allocate(self):
+        self.slots = np.zeros((self.delay,) + self.shape, dtype=np.float16)
+
+    def _encode(self, slot, cohort):
+        self.slots[slot] = cohort
+
+    def _decode(self, slot, out):
+        out[...] = self.slots[slot]
+
+    def gather(self, cells):
+        return self.slots.reshape(self.delay, -1)[:, cells].astype(np.float64)
+
+    def scatter(self, cells, values):
+        self.slots.reshape(self.delay, -1)[:, cells] = values
+
+    @property
+    def nbytes(self):
+        return self.slots.nbytes + self._buffer_nbytes
+
+
+class ScaledUint16Queue(_EncodedRingQueue):
+    """Slots stored as uint16 scaled by a per-slot maximum (fixed absolute error per cohort)"""
+
+    name = 'uint16'
+    LEVELS = np.iinfo(np.uint16).max
+
+    def __init__(self, delay, shape, dtype=np.float32):
+        super().__init__(delay, shape, dtype)
+        self._allocate()
+
+    def _allocate(self):
+        self.slots = np.zeros((self.delay,) + self.shape, dtype=np.uint16)
+        self.scales = np.zeros(self.delay, dtype=self.dtype)
+
+    def _encode(self, slot, cohort):
+        peak = float(cohort.max()) if cohort.size else 0.0
+        if not peak > 0:
+            self.slots[slot] = 0
+            self.scales[slot] = 0
+            return
+
+        scale = self.dtype(peak / self.LEVELS)
+        work = self._work if cohort is not self._work else np.empty_like(cohort)
+        np.divide(cohort, scale, out=work)
+        np.rint(work, out=work)
+        np.clip(work, 0, self.LEVELS, out=work)
+        self.slots[slot] = work
+        self.scales[slot] = scale
+
+    def _decode(self, slot, out):
+        np.multiply(self.slots[slot], self.scales[slot], out=out)
+
+    def state(self):
+        return {'idx': self.idx}, {'slots': self.slots.copy(), 'scales': self.scales.copy()}
+
+    def load_state(self, meta, arrays):
+        self.slots = arrays['slots']
+        self.scales = arrays['scales']
+        self.idx = int(meta['idx'])
+
+    @property
+    def nbytes(self):
+        return self.slots.nbytes + self.scales.nbytes + self._buffer_nbytes
+
+
+class SparseQueue(_EncodedRingQueue):
+    """Slots stored as (flat index, value) pairs for cells that carried mass"""
+
+    name = 'sparse'
+
+    def __init__(self, delay, shape, dtype=np.float32, min_value=0.0):
+        super().__init__(delay, shape, dtype)
+        self.min_value = min_value
+        self._allocate()
+
+    def _allocate(self):
+        empty = (np.empty(0, dtype=np.int32), np.empty(0, dtype=self.dtype))
+        self.slots = [empty] * self.delay
+
+    def _encode(self, slot, cohort):
+        flat = cohort.ravel()
+        idx = np.flatnonzero(flat > self.min_value).astype(np.int32, copy=False)
+        self.slots[slot] = (idx, flat[idx])
+
+    def _decode(self, slot, out):
+        idx, values = self.slots[slot]
+        out.fill(0)
+        out.ravel()[idx] = values
+
+    def state(self):
+        counts = np.array([len(idx) for idx, _ in self.slots], dtype=np.int64)
+        return {'idx': self.idx}, {
+            'counts': counts,
+            'indices': np.concatenate([idx for idx, _ in self.slots]),
+            'values': np.concatenate([values for _, values in self.slots]),
+        }
+
+    def load_state(self, meta, arrays):
+        edges = np.concatenate([[0], np.cumsum(arrays['counts'])])
+        self.slots = [
+            (arrays['indices'][a:b], arrays['values'][a:b]) for a, b in zip(edges[:-1], edges[1:])
+        ]
+        self.idx = int(meta['idx'])
+
+    @property
+    def nbytes(self):
+        stored = sum(idx.nbytes + values.nbytes for idx, values in self.slots)
+        return stored + self._buffer_nbytes
+
+
+class ErlangQueue(DelayQueue):
+    """Chain of k stages with mean delay `delay` instead of `delay` exact slots.
+
+    Each tick a fraction k / delay of every stage moves to the next one, so
+    the delay is Erlang-distributed around the exact value. With k == delay
+    every stage empties each tick and the queue is exact.
+    """
+
+    name = 'erlang'
+
+    def __init__(self, delay, shape, dtype=np.float32, stages=16):
+        super().__init__(delay, shape, dtype)
+        self.max_stages = max(1, int(stages))
+        self.stages = min(self.max_stages, self.delay)
+        self.rate = self.dtype(self.stages / self.delay)
+        self.slots = np.zeros((self.stages,) + self.shape, dtype=dtype)
+        self._spare = np.zeros(self.shape, dtype=dtype)
+        self._moved = np.empty(self.shape, dtype=dtype)
+
+    def push_pop(self, cohort):
+        popped = self._spare
+        stages = self.slots
+        moved = self._moved
+
+        # Drain from the last stage backwards so each stage moves once per tick.
+        np.multiply(stages[-1], self.rate, out=popped)
+        stages[-1] -= popped
+        for i in range(self.stages - 1, 0, -1):
+            np.multiply(stages[i - 1], self.rate, out=moved)
+            stages[i - 1] -= moved
+            stages[i] += moved
+        stages[0] += cohort
+
+        self._spare = cohort
+        return popped
+
+    def add_to_latest(self, values):
+        self.slots[0] += values
+
+    def gather(self, cells):
+        return self.slots.reshape(self.stages, -1)[:, cells].astype(np.float64)
+
+    def scatter(self, cells, values):
+        self.slots.reshape(self.stages, -1)[:, cells] = values
+
+    @property
+    def depth(self):
+        return self.stages
+
+    # Cohorts enter at stage 0 and leave from the last one.
+    def cohort(self, k, out):
+        out[...] = self.slots[self.stages - 1 - k]
+
+    def set_cohort(self, k, values):
+        self.slots[self.stages - 1 - k] = values
+
+    def resize(self, delay):
+        delay = max(1, int(delay))
+        stages = min(self.max_stages, delay)
+        if stages != self.stages:
+            # Stages mark progress through the delay, so they map by position.
+            slots = np.zeros((stages,) + self.shape, dtype=self.dtype)
+            for i, j, weight in remap_weights(self.stages, stages):
+                slots[j] += self.slots[i] * self.dtype(weight)
+            self.slots = slots
+            self.stages = stages
+        self.delay = delay
+        self.rate = self.dtype(self.stages / self.delay)
+
+    def state(self):
+        return {'stages': self.stages}, {'slots': self.slots.copy()}
+
+    def load_state(self, meta, arrays):
+        if int(meta['stages']) != self.stages:
+            raise ValueError(f"Snapshot has {meta['stages']} Erlang stages, queue has {self.stages}")
+        self.slots = arrays['slots']
+
+    @property
+    def nbytes(self):
+        return self.slots.nbytes + self._spare.nbytes + self._moved.nbytes
+
+
+def remap_weights(old, new):
+    """(old slot, new slot, weight) triples that stretch `old` wait slots onto `new`, in new-slot order.
+
+    Slot i holds the cohorts with a remaining wait in (i, i + 1] of `old`
+    ticks; scaled to `new` ticks it covers (i * new / old, (i + 1) * new /
+    old], and each new slot receives the fraction of it that overlaps. The
+    weights of every old slot sum to 1, so queued mass is conserved.
+    """
+    scale = new / old
+    triples = []
+    for i in range(old):
+        lo, hi = i * scale, (i + 1) * scale
+        for j in range(int(lo), min(new, int(np.ceil(hi)))):
+            overlap = min(hi, j + 1) - max(lo, j)
+            if overlap > 1e-12:
+                triples.append((i, j, overlap / scale))
+    triples.sort(key=lambda t: (t[1], t[0]))
+    return triples
+
+
+def transfer_cohorts(old, new):
+    """Move everything queued in `old` into `new` (an empty queue of any kind), by position in the wait.
+
+    Queues of different depths (an Erlang queue's stages against slots)
+    are stretched onto each other with remap_weights, so mass is conserved
+    up to the new queue's encoding.
+    """
+    out = np.empty(old.shape, dtype=old.dtype)
+    part = np.empty(old.shape, dtype=old.dtype)
+    pending = iter(remap_weights(old.depth, new.depth))
+    entry = next(pending, None)
+    for j in range(new.depth):
+        out.fill(0)
+        while entry is not None and entry[1] == j:
+            i, _, weight = entry
+            old.cohort(i, part)
+            if weight != 1:
+                part *= weight
+            out += part
+            entry = next(pending, None)
+        new.set_cohort(j, out)
+
+
+QUEUES = {
+    queue.name: queue
+    for queue in (ExactQueue, Float16Queue, ScaledUint16Queue, SparseQueue, ErlangQueue)
+}
+
+
+def make_delay_queue(kind, delay, shape, dtype=np.float32, stages=16):
+    """Build a delay queue by name"""
+    if kind not in QUEUES:
+        raise ValueError(f"Unknown delay queue '{kind}'. Options: {', '.join(QUEUES)}")
+    if kind == 'erlang':
+        return ErlangQueue(delay, shape, dtype, stages=stages)
+    return QUEUES[kind](delay, shape, dtype)
+
+
+def estimate_footprints(geotiff_path, factors=(16, 8, 4), kinds=None, ticks=400, stages=16):
+    """Run each queue kind at each downsample factor and compare it against the exact queue.
+
+    Returns one dict per (factor, kind) with the bytes held by the three
+    delay queues, the max absolute per-cell compartment difference and the
+    max relative difference in compartment totals after `ticks`.
+    """
+    from sim import VirusSimulation
+
+    kinds = list(kinds or QUEUES)
+    results = []
+    for factor in factors:
+        finals = {}
+        for kind in ['exact'] + [k for k in kinds if k != 'exact']:
+            with contextlib.redirect_stdout(io.StringIO()):
+                sim = VirusSimulation(
+                    geotiff_path=geotiff_path,
+                    downsample_factor=factor,
+                    delay_queue=kind,
+                    erlang_stages=stages,
+                )
+                for _ in range(ticks):
+                    sim.run_tick()
+
+            finals[kind] = {c: getattr(sim, c).copy() for c in 'grbde'}
+            footprint = sim.r_history.nbytes + sim.b_history.nbytes + sim.e_history.nbytes
+            if kind not in kinds:
+                continue
+
+            delta = max(float(np.abs(finals[kind][c] - finals['exact'][c]).max()) for c in 'grbde')
+            totals_delta = max(
+                abs(float(finals[kind][c].sum()) - float(finals['exact'][c].sum()))
+                / max(float(finals['exact'][c].sum()), np.finfo(np.float32).eps)
+                for c in 'grbde'
+            )
+            results.append({
+                'factor': factor,
+                'kind': kind,
+                'shape': (sim.ROWS, sim.COLS),
+                'queue_bytes': footprint,
+                'max_abs_delta': delta,
+                'totals_rel_delta': totals_delta,
+            })
+            del sim
+    return results
+
+
+if __name__ == '__main__':
+    # Usage: python delay_queue.py [geotiff] [ticks] [factor ...]
+    geotiff = sys.argv[1] if len(sys.argv) > 1 else 'gpw_v4_population_density_rev11_2020_15_min.tif'
+    ticks = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    factors = [int(f) for f in sys.argv[3:]] or [16, 8, 4]
+
+    for row in estimate_footprints(geotiff, factors=factors, ticks=ticks):
+        rows, cols = row['shape']
+        print(f"factor {row['factor']:2d} ({rows} x {cols})  {row['kind']:8s} "
+              f"{row['queue_bytes'] / 2**20:10.1f} MiB   max |delta| {row['max_abs_delta']:.2e}   "
+              f"totals delta {row['totals_rel_delta']:.2e}")
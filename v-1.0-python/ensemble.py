@@ -0,0 +1,179 @@
+import numpy as np
+import time
+
+from convolution import choose_engine_name
+from delay_queue import make_delay_queue
+from tiled import build_bands
+from transitions import TOTAL_COLUMNS
+# Target bytes of stacked state per row band, so each band's passes stay in cache.
+BLOCK_BYTES = 4 << 20
+# Roughly how many full-grid arrays one band's transitions stream through.
+ARRAYS_PER_TICK = 12
+
+
+class VirusEnsemble:
+    """N parameter variants of VirusSimulation stepped together as stacked (N, ROWS, COLS) arrays.
+
+    Every member shares one read-only sizeGridPow, the spread kernel and the
+    delay lengths; SPREAD_RATE, FATALITY_RATE and the seed cell are per member.
+    """
+
+    def __init__(self, size_grid_pow, spread_rates, fatality_rates=892 / 1000000, seeds=None,
+                 sicken_rate=8, heal_rate=7, immunity_loss_rate=300, spread_kernel=None,
+                 conv_engine='auto', delay_queue='exact', erlang_stages=16, compact_min_delay=32):
+        from sim import VirusSimulation, default_seed_cell
+
+        self.dtype = np.float32
+        self.sizeGridPow = size_grid_pow.view()
+        self.sizeGridPow.flags.writeable = False
+        self.ROWS, self.COLS = self.sizeGridPow.shape
+
+        spread_rates, fatality_rates = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(spread_rates, dtype=self.dtype)),
+            np.atleast_1d(np.asarray(fatality_rates, dtype=self.dtype)),
+        )
+        self.N = len(spread_rates)
+        # Shaped (N, 1, 1) so they broadcast against the stacked grids.
+        self.SPREAD_RATE = spread_rates.reshape(self.N, 1, 1).copy()
+        self.FATALITY_RATE = fatality_rates.reshape(self.N, 1, 1).copy()
+
+        self.SICKEN_RATE = sicken_rate
+        self.HEAL_RATE = heal_rate
+        self.IMMUNITY_LOSS_RATE = immunity_loss_rate
+        self.SPREAD_KERNEL = np.asarray(
+            spread_kernel if spread_kernel is not None else VirusSimulation.DEFAULT_SPREAD_KERNEL,
+            dtype=self.dtype,
+        )
+        self.delay_queue = delay_queue
+        self.erlang_stages = erlang_stages
+        self.compact_min_delay = compact_min_delay
+
+        if seeds is None:
+            # A bare grid is taken to be the whole raster; from_simulation passes a window's seed.
+            seeds = [default_seed_cell(self.sizeGridPow.shape, self.sizeGridPow)] * self.N
+        if len(seeds) != self.N:
+            raise ValueError(f'Expected {self.N} seeds, got {len(seeds)}')
+        self.seeds = [tuple(int(v) for v in seed) for seed in seeds]
+
+        # The tick runs band by band over all members at once: one batched
+        # convolution per band, sized so the band's arrays stay in cache.
+        self.conv_engine = conv_engine if conv_engine != 'auto' else choose_engine_name(self.SPREAD_KERNEL)
+        stacked_bytes = ARRAYS_PER_TICK * self.N * self.ROWS * self.COLS * np.dtype(self.dtype).itemsize
+        self._bands = build_bands(self.shape, -(-stacked_bytes // BLOCK_BYTES), self.SPREAD_KERNEL,
+                                  self.conv_engine, self.dtype)
+
+        self._init_state_arrays()
+        self._seed_initial_infection()
+
+        self.iter = 0
+        self.last_time = time.time()
+
+    @classmethod
+    def from_simulation(cls, sim, spread_rates, fatality_rates=None, seeds=None, **kwargs):
+        """Build an ensemble sharing sim's population grid, kernel and delays"""
+        kwargs.setdefault('sicken_rate', sim.SICKEN_RATE)
+        kwargs.setdefault('heal_rate', sim.HEAL_RATE)
+        kwargs.setdefault('immunity_loss_rate', sim.IMMUNITY_LOSS_RATE)
+        kwargs.setdefault('spread_kernel', sim.SPREAD_KERNEL)
+        kwargs.setdefault('conv_engine', sim.conv_engine.name)
+        kwargs.setdefault('delay_queue', sim.delay_queue)
+        kwargs.setdefault('erlang_stages', sim.erlang_stages)
+        kwargs.setdefault('compact_min_delay', sim.COMPACT_QUEUE_MIN_DELAY)
+        if fatality_rates is None:
+            fatality_rates = sim.FATALITY_RATE
+        if seeds is None:
+            seeds = [sim.default_seed_cell()] * len(np.atleast_1d(spread_rates))
+        return cls(sim.sizeGridPow, spread_rates, fatality_rates, seeds, **kwargs)
+
+    @property
+    def shape(self):
+        return (self.N, self.ROWS, self.COLS)
+
+    def _make_queue(self, delay):
+        kind = self.delay_queue if delay >= self.compact_min_delay else 'exact'
+        return make_delay_queue(kind, delay, self.shape, dtype=self.dtype, stages=self.erlang_stages)
+
+    def _init_state_arrays(self):
+        shape = self.shape
+        self.r = np.zeros(shape, dtype=self.dtype)  # Infected
+        self.g = np.ones(shape, dtype=self.dtype)   # Susceptible
+        self.b = np.zeros(shape, dtype=self.dtype)  # Recovered
+        self.d = np.zeros(shape, dtype=self.dtype)  # Dead
+        self.e = np.zeros(shape, dtype=self.dtype)  # Exposed
+
+        self.r_history = self._make_queue(self.HEAL_RATE)
+        self.b_history = self._make_queue(self.IMMUNITY_LOSS_RATE)
+        self.e_history = self._make_queue(self.SICKEN_RATE)
+
+        self.sickened = np.zeros(shape, dtype=self.dtype)
+        self.healed = np.zeros(shape, dtype=self.dtype)
+        self.infected = np.zeros(shape, dtype=self.dtype)
+
+        self._spare = np.zeros(shape, dtype=self.dtype)
+        self._spread_src = np.empty(shape, dtype=self.dtype)
+
+        self.totals = np.zeros((self.N, len(TOTAL_COLUMNS)), dtype=self.dtype)
+        self._update_totals()
+
+    def _seed_initial_infection(self):
+        for member, (row, col) in enumerate(self.seeds):
+            r_min = max(row - 1, 0)
+            r_max = min(row + 2, self.ROWS)
+            c_min = max(col - 1, 0)
+            c_max = min(col + 2, self.COLS)
+            self.r[member, r_min:r_max, c_min:c_max] = 0.1
+        self._update_totals()
+
+    def restart(self):
+        """Reset every member to its initial state"""
+        self._init_state_arrays()
+        self._seed_initial_infection()
+        self.iter = 0
+        self.last_time = time.time()
+
+    def _update_totals(self):
+        for col, arr in enumerate((self.r, self.g, self.b, self.e, self.d)):
+            arr.sum(axis=(1, 2), out=self.totals[:, col])
+
+    def run_tick(self):
+        """Advance every member by one tick and return the (N, 5) totals array"""
+        self.iter += 1
+
+        sickened = self.e_history.push_pop(self.infected)
+        healed = self.r_history.push_pop(self.sickened)
+        relapsed = self.b_history.push_pop(self.healed)
+
+        infected = self._spare
+        np.multiply(self.r, self.sizeGridPow, out=self._spread_src)
+        for band in self._bands:
+            band.advance(
+                self.g, self.e, self.r, self.b, self.d, self._spread_src,
+                sickened, healed, relapsed, infected,
+                self.SPREAD_RATE, self.FATALITY_RATE,
+            )
+
+        self.infected = infected
+        self.sickened = sickened
+        self.healed = healed
+        self._spare = relapsed
+
+        self._update_totals()
+        return self.totals
+
+    def run(self, ticks):
+        """Run `ticks` ticks and return the (ticks, N, 5) totals series"""
+        series = np.empty((ticks, self.N, len(TOTAL_COLUMNS)), dtype=self.dtype)
+        for i in range(ticks):
+            series[i] = self.run_tick()
+        return series
+
+    def member_state(self, member):
+        """Compartment views for one member, keyed like VirusSimulation.get_state_data"""
+        return {
+            'susceptible': self.g[member],
+            'exposed': self.e[member],
+            'infected': self.r[member],
+            'recovered': self.b[member],
+            'dead': self.d[member],
+            'iteration': self.iter,
+        }
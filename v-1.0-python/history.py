@@ -0,0 +1,182 @@
+import numpy as np
+import math
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+
+from transitions import TICK_COLUMNS
+
+# Columns recorded per tick: compartment totals, new infections this tick,
+# and the per-tick growth rate of that incidence, ln(incidence_t / incidence_t-1).
+HISTORY_COLUMNS = ('iteration',) + TICK_COLUMNS + ('growth_rate',)
+CHUNK_TICKS = 1 << 16
+
+
+class HistoryRecorder:
+    """Per-tick time series in fixed-size columnar chunks.
+
+    The current chunk lives in memory as one (columns, CHUNK_TICKS) float64
+    array; full chunks are written to `directory` and memory-mapped for
+    queries, so memory stays bounded however long the run. Rows are keyed by
+    iteration: recording the same iteration again (a vaccination) replaces
+    the last row, and an earlier one (restart, restore) starts a new history.
+    """
+
+    def __init__(self, directory=None, chunk_ticks=CHUNK_TICKS):
+        self.chunk_ticks = int(chunk_ticks)
+        self._own_directory = directory is None
+        self.directory = Path(directory or tempfile.mkdtemp(prefix='sim-history-'))
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._buffer = np.full((len(HISTORY_COLUMNS), self.chunk_ticks), np.nan)
+        self._size = 0
+        # Chunks left by an earlier process belong to a history that is gone.
+        self.clear()
+
+    def __len__(self):
+        return len(self._chunks) * self.chunk_ticks + self._size
+
+    def _last(self, column):
+        if self._size:
+            return float(self._buffer[column, self._size - 1])
+        if self._chunks:
+            return float(self._chunks[-1][column, -1])
+        return None
+
+    @property
+    def last_iteration(self):
+        last = self._last(0)
+        return None if last is None else int(last)
+
+    def record(self, iteration, totals, incidence):
+        """Append one tick; totals in TOTAL_COLUMNS order, incidence as summed into TICK_COLUMNS"""
+        last = self.last_iteration
+        if last is not None and iteration <= last:
+            if iteration < last:
+                self.clear()
+            else:
+                # Same iteration: the state changed between ticks, replace the row.
+                if not self._size:
+                    self._unspill()
+                self._size -= 1
+
+        previous = self._last(6)
+        if previous is not None and incidence > 0 and previous > 0:
+            growth = math.log(incidence / previous)
+        else:
+            growth = math.nan
+
+        buf, i = self._buffer, self._size
+        buf[0, i] = iteration
+        buf[1:6, i] = totals
+        buf[6, i] = incidence
+        buf[7, i] = growth
+        self._size += 1
+        if self._size == self.chunk_ticks:
+            self._spill()
+
+    def _spill(self):
+        path = self.directory / f'chunk-{len(self._chunks):06d}.npy'
+        np.save(path, self._buffer)
+        with self._lock:
+            self._chunks.append(np.load(path, mmap_mode='r'))
+            self._buffer = np.full_like(self._buffer, np.nan)
+            self._size = 0
+
+    def _unspill(self):
+        # The row to replace ended the last chunk: take the chunk back as the buffer.
+        with self._lock:
+            self._buffer = np.array(self._chunks.pop())
+            self._size = self.chunk_ticks
+        (self.directory / f'chunk-{len(self._chunks):06d}.npy').unlink(missing_ok=True)
+
+    def clear(self):
+        with self._lock:
+            self._chunks = []
+            self._size = 0
+        for path in self.directory.glob('chunk-*.npy'):
+            path.unlink(missing_ok=True)
+
+    def close(self):
+        self.clear()
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _rows(self, start, end):
+        """(columns, n) array of the rows with start <= iteration <= end"""
+        with self._lock:
+            blocks = list(self._chunks) + [self._buffer[:, :self._size]]
+        pieces = []
+        for block in blocks:
+            if not block.shape[1]:
+                continue
+            iterations = block[0]
+            if iterations[-1] < start or iterations[0] > end:
+                continue
+            lo = np.searchsorted(iterations, start, side='left')
+            hi = np.searchsorted(iterations, end, side='right')
+            pieces.append(block[:, lo:hi])
+        if not pieces:
+            return np.empty((len(HISTORY_COLUMNS), 0))
+        return np.concatenate(pieces, axis=1)
+
+    def query(self, start=None, end=None, points=1000, columns=None):
+        """Rows between iterations start and end, decimated to at most `points` buckets.
+
+        Each bucket reports the min, max and mean of every column over its
+        ticks, so spikes survive decimation; `iteration` is the first
+        iteration in each bucket.
+        """
+        columns = list(columns or HISTORY_COLUMNS[1:])
+        unknown = set(columns) - set(HISTORY_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown history columns: {', '.join(sorted(unknown))}. "
+                             f"Options: {', '.join(HISTORY_COLUMNS[1:])}")
+        start = -math.inf if start is None else start
+        end = math.inf if end is None else end
+        rows = self._rows(start, end)
+        count = rows.shape[1]
+        points = max(1, int(points))
+
+        if count <= points:
+            edges = np.arange(count)
+        else:
+            edges = np.linspace(0, count, points + 1)[:-1].astype(np.int64)
+        sizes = np.diff(np.append(edges, count))
+
+        result = {
+            'count': int(count),
+            'points': int(len(edges)),
+            'decimated': bool(count > points),
+            'iteration': rows[0, edges].astype(np.int64).tolist() if count else [],
+            'columns': {},
+        }
+        for name in columns:
+            values = rows[HISTORY_COLUMNS.index(name)]
+            if not count:
+                result['columns'][name] = {'min': [], 'max': [], 'mean': []}
+                continue
+            # NaN growth rates (no incidence) are ignored within a bucket.
+            finite = np.isfinite(values)
+            filled = np.where(finite, values, 0.0)
+            n = np.add.reduceat(finite, edges, dtype=np.int64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.add.reduceat(filled, edges) / n
+            lo = np.minimum.reduceat(np.where(finite, values, np.inf), edges)
+            hi = np.maximum.reduceat(np.where(finite, values, -np.inf), edges)
+            empty = n == 0
+            mean[empty], lo[empty], hi[empty] = np.nan, np.nan, np.nan
+            result['columns'][name] = {
+                'min': _json_floats(lo),
+                'max': _json_floats(hi),
+                'mean': _json_floats(mean),
+            }
+        result['ticks_per_point'] = float(sizes.mean()) if count else 0.0
+        return result
+
+
+def _json_floats(arr):
+    # JSON has no NaN; missing values become null.
+    return [None if not math.isfinite(v) else v for v in arr.tolist()]
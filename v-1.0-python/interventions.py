@@ -0,0 +1,298 @@
+import numpy as np
+import itertools
+import threading
+
+from regions import bbox_window, resolve_bbox
+
+KINDS = ('seed', 'vaccinate', 'lockdown')
+# Boolean masks filling less than this share of their bounding box are stored as flat indices.
+DENSE_FILL = 0.25
+
+
+class Mask:
+    """A set of grid cells, stored as a bounding box (optionally weighted) or as flat indices.
+
+    get() returns the masked values of a grid (a view for boxes, a copy for
+    indices) in the mask's layout; put() writes them back. weights, when
+    set, has that layout and scales each cell's share of an intervention.
+    """
+
+    def __init__(self, shape, box=None, indices=None, weights=None):
+        self.shape = tuple(shape)
+        self.box = box
+        self.indices = indices
+        self.weights = weights
+
+    @classmethod
+    def rect(cls, shape, row0, row1, col0, col1):
+        rows, cols = shape
+        row0, row1 = max(0, int(row0)), min(rows, int(row1))
+        col0, col1 = max(0, int(col0)), min(cols, int(col1))
+        if row1 <= row0 or col1 <= col0:
+            raise ValueError('Mask does not overlap the grid')
+        return cls(shape, box=(slice(row0, row1), slice(col0, col1)))
+
+    @classmethod
+    def from_bool(cls, grid):
+        """Compact mask of the True cells of a full grid"""
+        rows = np.flatnonzero(grid.any(axis=1))
+        cols = np.flatnonzero(grid.any(axis=0))
+        if not len(rows):
+            raise ValueError('Mask is empty')
+        box = (slice(int(rows[0]), int(rows[-1]) + 1), slice(int(cols[0]), int(cols[-1]) + 1))
+        inside = grid[box]
+        if inside.all():
+            return cls(grid.shape, box=box)
+        if inside.mean() >= DENSE_FILL:
+            return cls(grid.shape, box=box, weights=inside.astype(np.float32))
+        return cls(grid.shape, indices=np.flatnonzero(grid).astype(np.int64))
+
+    @property
+    def cells(self):
+        if self.box is None:
+            return len(self.indices)
+        if self.weights is not None:
+            return int(np.count_nonzero(self.weights))
+        return (self.box[0].stop - self.box[0].start) * (self.box[1].stop - self.box[1].start)
+
+    @property
+    def nbytes(self):
+        stored = self.indices.nbytes if self.indices is not None else 0
+        return stored + (self.weights.nbytes if self.weights is not None else 0)
+
+    @property
+    def bounds(self):
+        """(row0, row1, col0, col1) covering the mask"""
+        if self.box is not None:
+            return self.box[0].start, self.box[0].stop, self.box[1].start, self.box[1].stop
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        return int(rows.min()), int(rows.max()) + 1, int(cols.min()), int(cols.max()) + 1
+
+    def get(self, arr):
+        if self.box is not None:
+            return arr[self.box]
+        return arr.reshape(-1)[self.indices]
+
+    def put(self, arr, values):
+        if self.box is not None:
+            arr[self.box] = values
+        else:
+            arr.reshape(-1)[self.indices] = values
+
+    def describe(self):
+        row0, row1, col0, col1 = self.bounds
+        return {
+            'storage': 'indices' if self.box is None else ('weighted box' if self.weights is not None else 'box'),
+            'cells': self.cells,
+            'rows': [row0, row1],
+            'cols': [col0, col1],
+        }
+
+
+def point_mask(sim, lat, lon, radius=1):
+    """Square patch of half-width `radius` cells around (lat, lon), like seed_infection's 3x3"""
+    cell = sim.latlon_to_cell(lat, lon)
+    if cell is None:
+        raise ValueError(f'({lat}, {lon}) is outside the simulated grid')
+    row, col = cell
+    radius = max(0, int(radius))
+    return Mask.rect((sim.ROWS, sim.COLS), row - radius, row + radius + 1, col - radius, col + radius + 1)
+
+
+def region_mask(sim, region=None, bbox=None):
+    """Cells of a named region or (west, south, east, north) box"""
+    bounds = resolve_bbox(region, bbox)
+    if bounds is None:
+        raise ValueError('Give a region or a bbox')
+    row0, col0, rows, cols = bbox_window(sim.transform, (sim.ROWS, sim.COLS), bounds)
+    return Mask.rect((sim.ROWS, sim.COLS), row0, row0 + rows, col0, col0 + cols)
+
+
+def label_mask(sim, region):
+    """Cells of one region of sim's label grid (see region_stats), by code or name"""
+    index = sim.region_index
+    if index is None:
+        raise ValueError('No region labels configured')
+    code = index.lookup(region)
+    if code is None:
+        raise ValueError(f"Unknown region '{region}'")
+    return Mask.from_bool(index.labels == code)
+
+
+def make_mask(sim, spec):
+    """Mask from {"lat", "lon", "radius"}, {"region"}, {"bbox"} or {"label"}"""
+    if 'lat' in spec and 'lon' in spec:
+        return point_mask(sim, float(spec['lat']), float(spec['lon']), spec.get('radius', 1))
+    if 'label' in spec:
+        return label_mask(sim, spec['label'])
+    if spec.get('region') or spec.get('bbox'):
+        return region_mask(sim, spec.get('region'), spec.get('bbox'))
+    raise ValueError('A mask needs lat/lon, region, bbox or label')
+
+
+class Intervention:
+    """One scheduled action on a mask.
+
+    seed raises the infected share of the cells to at least `value` at
+    `start`, taking it from the susceptibles. vaccinate moves `value` of
+    the susceptibles to recovered at `start`, or that share every tick
+    until `end` when an end is given. lockdown scales how much infection
+    the cells spread by `value` from `start` until `end` (open-ended
+    without one).
+    """
+
+    def __init__(self, intervention_id, kind, mask, start, end=None, value=None, label=None):
+        if kind not in KINDS:
+            raise ValueError(f"Unknown intervention '{kind}'. Options: {', '.join(KINDS)}")
+        defaults = {'seed': 0.1, 'vaccinate': 0.9, 'lockdown': 0.3}
+        self.id = intervention_id
+        self.kind = kind
+        self.mask = mask
+        self.start = int(start)
+        self.end = None if end is None else int(end)
+        self.value = float(defaults[kind] if value is None else value)
+        self.label = label
+        if not 0 <= self.value <= 1:
+            raise ValueError(f'{kind} value must be between 0 and 1')
+        if self.end is not None and self.end <= self.start:
+            raise ValueError('end must come after start')
+        # Iteration of the last one-shot application, so restarts can replay it.
+        self.applied_at = None
+
+    def active(self, iteration):
+        return self.start <= iteration and (self.end is None or iteration < self.end)
+
+    def describe(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'start': self.start,
+            'end': self.end,
+            'value': self.value,
+            'label': self.label,
+            'mask': self.mask.describe(),
+        }
+
+
+class InterventionEngine:
+    """Scheduled seeds, vaccinations and lockdowns folded into the simulation's tick.
+
+    apply() runs at the start of every tick and only touches the cells of
+    due interventions. Seeds and vaccinations write their masked cells and
+    the cohorts about to enter the delay queues, so vaccinated people lose
+    their immunity and seeded infections heal like any other. Lockdowns cost
+    nothing per tick: they scale sim.spread_weight, the private copy of
+    sizeGridPow the spread pass multiplies by, and that is only rewritten
+    over the lockdowns' bounding boxes when one starts or ends.
+    """
+
+    def __init__(self):
+        self.interventions = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._lockdowns = frozenset()
+        self._last_iteration = None
+
+    def __len__(self):
+        return len(self.interventions)
+
+    @property
+    def idle(self):
+        """True when there is nothing to apply or undo"""
+        return not self.interventions and not self._lockdowns
+
+    def add(self, kind, mask, start, end=None, value=None, label=None):
+        intervention = Intervention(next(self._ids), kind, mask, start, end, value, label)
+        with self._lock:
+            self.interventions[intervention.id] = intervention
+        return intervention
+
+    def remove(self, intervention_id):
+        with self._lock:
+            return self.interventions.pop(int(intervention_id), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self.interventions.clear()
+
+    def list(self):
+        with self._lock:
+            return [i.describe() for i in self.interventions.values()]
+
+    def apply(self, sim):
+        """Apply what is due at sim.iter (call at the start of a tick, before the queues are pushed)"""
+        iteration = sim.iter
+        with self._lock:
+            interventions = list(self.interventions.values())
+        if self._last_iteration is not None and iteration <= self._last_iteration:
+            # Restarted or restored to an earlier tick: one-shot actions may run again.
+            for intervention in interventions:
+                if intervention.applied_at is not None and intervention.applied_at >= iteration:
+                    intervention.applied_at = None
+        self._last_iteration = iteration
+
+        for intervention in interventions:
+            if not intervention.active(iteration) or intervention.kind == 'lockdown':
+                continue
+            if intervention.kind == 'seed':
+                if intervention.applied_at is None:
+                    self._seed(sim, intervention)
+                    intervention.applied_at = iteration
+            elif intervention.end is not None:
+                self._vaccinate(sim, intervention)
+            elif intervention.applied_at is None:
+                self._vaccinate(sim, intervention)
+                intervention.applied_at = iteration
+
+        lockdowns = frozenset(i for i in interventions if i.kind == 'lockdown' and i.active(iteration))
+        if lockdowns != self._lockdowns or (lockdowns and sim.spread_weight is sim.sizeGridPow):
+            self._update_spread_weight(sim, self._lockdowns | lockdowns, lockdowns)
+            self._lockdowns = lockdowns
+
+    def _seed(self, sim, intervention):
+        mask = intervention.mask
+        r = mask.get(sim.r)
+        g = mask.get(sim.g)
+        target = intervention.value if mask.weights is None else intervention.value * mask.weights
+        # Infect susceptibles, so the cells' compartments still sum to one.
+        added = np.clip(target - r, 0, g).astype(sim.dtype)
+        mask.put(sim.g, g - added)
+        mask.put(sim.r, r + added)
+        # The new infections enter the healing queue with this tick's cohort.
+        mask.put(sim.sickened, mask.get(sim.sickened) + added)
+
+    def _vaccinate(self, sim, intervention):
+        mask = intervention.mask
+        g = mask.get(sim.g)
+        b = mask.get(sim.b)
+        share = intervention.value if mask.weights is None else intervention.value * mask.weights
+        # Capped at the room left in b, so the mass taken from g is exactly what b and the queue receive.
+        vaccinated = np.clip(g * share, 0, np.maximum(1 - b, 0)).astype(sim.dtype)
+        mask.put(sim.g, g - vaccinated)
+        mask.put(sim.b, b + vaccinated)
+        # The cohort entering the immunity-loss queue this tick.
+        mask.put(sim.healed, mask.get(sim.healed) + vaccinated)
+
+    def _update_spread_weight(self, sim, touched, active):
+        if sim.spread_weight is sim.sizeGridPow:
+            if not active:
+                return
+            sim.spread_weight = np.array(sim.sizeGridPow)
+        weight = sim.spread_weight
+        # Reset every box a lockdown covered or covers, then apply the active ones.
+        for intervention in touched:
+            row0, row1, col0, col1 = intervention.mask.bounds
+            weight[row0:row1, col0:col1] = sim.sizeGridPow[row0:row1, col0:col1]
+        for intervention in sorted(active, key=lambda i: i.id):
+            mask = intervention.mask
+            factor = intervention.value
+            if mask.weights is not None:
+                factor = 1 - (1 - factor) * mask.weights
+            mask.put(weight, mask.get(weight) * np.asarray(factor, dtype=sim.dtype))
+
+    def describe(self):
+        return {
+            'interventions': len(self.interventions),
+            'active_lockdowns': len(self._lockdowns),
+            'bytes': sum(i.mask.nbytes for i in list(self.interventions.values())),
+        }
@@ -0,0 +1,316 @@
+import numpy as np
+import bisect
+from pathlib import Path
+
+from scipy import sparse
+
+from regions import resolve_bbox
+
+
+def cell_centres(transform, cells, cols):
+    """(lon, lat) of the centres of flat cell indices on a grid with `cols` columns"""
+    a, _, c, _, e, f = transform[:6]
+    rows, cols = np.divmod(np.asarray(cells), cols)
+    return c + (cols + 0.5) * a, f + (rows + 0.5) * e
+
+
+def lonlat_cells(transform, shape, lon, lat):
+    """Flat indices of the cells holding each (lon, lat); ValueError for points off the grid"""
+    a, _, c, _, e, f = transform[:6]
+    rows, cols = shape
+    col = np.floor((np.asarray(lon, dtype=np.float64) - c) / a).astype(np.int64)
+    row = np.floor((np.asarray(lat, dtype=np.float64) - f) / e).astype(np.int64)
+    outside = (row < 0) | (row >= rows) | (col < 0) | (col >= cols)
+    if outside.any():
+        raise ValueError(f'{int(outside.sum())} mobility nodes lie outside the simulation grid')
+    return row * cols + col
+
+
+class MobilityNetwork:
+    """Long-range travel between grid cells, mixed into the infected and exposed compartments.
+
+    flows[i, j] is the fraction of node i's population that travels to node
+    j per tick; nodes are flat cell indices (hubs sharing a cell are merged).
+    The matrix is stored transposed as CSR, so each tick the arriving mass
+    of every node comes from one sparse product, and departures are the
+    cached out-fractions. Travellers take their share of every cohort
+    still waiting in the exposed and infected delay queues along, so they
+    keep their remaining delay, and each one trades places with a
+    susceptible at the other end, so every cell still sums to one.
+
+    The flows are multiplied by `scale`, by the last `schedule` entry
+    (iteration, factor) reached, and per node by node_scale, applied at
+    both ends of every edge so a factor of 0 closes a node to travel.
+    """
+
+    def __init__(self, cells, flows, population, transform=None, scale=1.0, schedule=None):
+        population = np.asarray(population, dtype=np.float64)
+        # Grid geometry, for selecting nodes by bounding box.
+        self.transform = transform
+        self.cols = population.shape[-1]
+        cells = np.asarray(cells, dtype=np.int64)
+        flows = sparse.csr_matrix(flows, dtype=np.float64)
+        if flows.shape != (len(cells), len(cells)):
+            raise ValueError(f'Flow matrix is {flows.shape}; expected {(len(cells), len(cells))} for the nodes')
+        # Merge hubs in the same cell and drop travel within a cell.
+        self.cells, inverse = np.unique(cells, return_inverse=True)
+        merge = sparse.csr_matrix(
+            (np.ones(len(cells)), (np.arange(len(cells)), inverse.ravel())), shape=(len(cells), len(self.cells)))
+        flows = (merge.T @ flows @ merge).tocsr()
+        flows.setdiag(0)
+        flows.eliminate_zeros()
+
+        population = population.ravel()[self.cells]
+        if (population <= 0).any():
+            raise ValueError('Mobility nodes must have a population')
+        out = np.asarray(flows.sum(axis=1)).ravel()
+        if (out > 1).any():
+            raise ValueError('A node cannot send more than its whole population per tick')
+        self.population = population
+        self._base = flows.T.tocsr()
+        self._base.sort_indices()
+        self.node_scale = np.ones(len(self.cells))
+        self.scale = float(scale)
+        self.schedule = []
+        self.set_schedule(schedule)
+        self._rebuild()
+
+    @property
+    def nodes(self):
+        return len(self.cells)
+
+    @property
+    def edges(self):
+        return self._base.nnz
+
+    @property
+    def nbytes(self):
+        base = self._base
+        # The scaled copy shares the base's index arrays.
+        csr = 2 * base.data.nbytes + base.indices.nbytes + base.indptr.nbytes
+        return csr + self.cells.nbytes + 3 * len(self.cells) * 8
+
+    def set_schedule(self, schedule):
+        """Time-varying flow factors: (iteration, factor) pairs, each holding until the next"""
+        schedule = sorted((int(it), float(f)) for it, f in (schedule or []))
+        if any(f < 0 for _, f in schedule):
+            raise ValueError('Mobility factors must be non-negative')
+        self.schedule = schedule
+        self._schedule_iterations = [it for it, _ in schedule]
+
+    def scale_at(self, iteration):
+        """Overall flow factor at an iteration"""
+        i = bisect.bisect_right(self._schedule_iterations, iteration)
+        return self.scale * (self.schedule[i - 1][1] if i else 1.0)
+
+    def set_node_scale(self, factors):
+        """Per-node factors (0 closes a node; one value sets them all) on departures and arrivals"""
+        factors = np.asarray(factors, dtype=np.float64)
+        if factors.shape not in ((), self.node_scale.shape) or (factors < 0).any():
+            raise ValueError(f'Node factors must be one or {len(self.cells)} non-negative values')
+        self.node_scale = np.broadcast_to(factors, self.node_scale.shape).copy()
+        self._rebuild()
+
+    def scale_bbox(self, factor, region=None, bbox=None):
+        """Set the factor of every node inside a named region or bbox (a travel ban at 0); returns the count"""
+        if self.transform is None:
+            raise ValueError('This network has no grid transform to locate its nodes')
+        bounds = resolve_bbox(region, bbox)
+        if bounds is None:
+            raise ValueError('Give a region or a bbox')
+        west, south, east, north = bounds
+        lon, lat = cell_centres(self.transform, self.cells, self.cols)
+        inside = (lon >= west) & (lon < east) & (lat >= south) & (lat < north)
+        factors = self.node_scale.copy()
+        factors[inside] = float(factor)
+        self.set_node_scale(factors)
+        return int(inside.sum())
+
+    def _rebuild(self):
+        # Scaled copy of the transposed flows: row = destination, column = origin.
+        base = self._base
+        dest = np.repeat(np.arange(base.shape[0]), np.diff(base.indptr))
+        self._flows = sparse.csr_matrix(
+            (base.data * self.node_scale[dest] * self.node_scale[base.indices], base.indices, base.indptr),
+            shape=base.shape)
+        self._out = np.bincount(base.indices, weights=self._flows.data, minlength=base.shape[1])
+
+    def apply(self, sim):
+        """Move travelling infected and exposed mass for sim.iter; returns the arriving mass"""
+        scale = self.scale_at(sim.iter)
+        if scale <= 0 or not self.edges:
+            return 0.0
+        cells = self.cells
+        # Rows: the compartments, the cohorts about to enter the queues, then
+        # every queued cohort, so travellers keep their place in the delays.
+        grids = (sim.r, sim.e, sim.sickened, sim.infected)
+        queues = (sim.r_history, sim.e_history)
+        queued = [queue.gather(cells) for queue in queues]
+        mass = np.concatenate([np.stack([grid.reshape(-1)[cells] for grid in grids])] + queued)
+        # Mass per node arriving from all origins, in one sparse product over
+        # the rows any node carries.
+        active = np.flatnonzero(mass.any(axis=1))
+        arriving = np.zeros_like(mass)
+        arriving[active] = (self._flows @ np.ascontiguousarray((mass[active] * self.population).T)).T
+        arriving *= scale
+        moved = float(arriving[:2].sum())
+        arriving /= self.population
+        leaving = np.minimum(self._out * scale, 1.0)
+        # Net infected and exposed travellers per node, replaced by (or replacing) susceptibles.
+        traded = arriving[:2].sum(axis=0) - mass[:2].sum(axis=0) * leaving
+        mass *= 1 - leaving
+        mass += arriving
+
+        for grid, row in zip(grids, mass):
+            grid.reshape(-1)[cells] = row
+        start = len(grids)
+        for queue, block in zip(queues, queued):
+            queue.scatter(cells, mass[start:start + len(block)])
+            start += len(block)
+        # Susceptibles take the travellers' places, so each cell keeps its people.
+        g = sim.g.reshape(-1)
+        g[cells] = np.clip(g[cells] - traded, 0, 1)
+        return moved
+
+    def describe(self):
+        return {
+            'nodes': self.nodes,
+            'edges': self.edges,
+            'scale': self.scale,
+            'schedule': [list(step) for step in self.schedule],
+            'closed_nodes': int((self.node_scale == 0).sum()),
+            'scaled_nodes': int((self.node_scale != 1).sum()),
+            'mean_out_fraction': float(self._out.mean()) if len(self._out) else 0.0,
+            'bytes': self.nbytes,
+        }
+
+    def save(self, path):
+        """Write the network (unscaled flows) as an .npz load_network reads back"""
+        flows = self._base.T.tocsr()
+        np.savez(path, cells=self.cells, data=flows.data, indices=flows.indices, indptr=flows.indptr)
+
+
+def load_network(path, sim):
+    """MobilityNetwork from an .npz of a CSR origin->destination matrix.
+
+    Nodes are flat cell indices (`cells`) or hub coordinates (`lon`, `lat`);
+    the matrix is `data`, `indices`, `indptr` with origins as rows, each
+    value the fraction of the origin's population travelling per tick.
+    """
+    with np.load(Path(path)) as npz:
+        if 'cells' in npz:
+            cells = npz['cells']
+        else:
+            cells = lonlat_cells(sim.transform, (sim.ROWS, sim.COLS), npz['lon'], npz['lat'])
+        flows = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=(len(cells), len(cells)))
+    return MobilityNetwork(cells, flows, cell_population(sim), sim.transform)
+
+
+def cell_population(sim):
+    """Relative population of every cell (sizeGrid is the square root of density)"""
+    return np.square(sim.sizeGrid, dtype=np.float64)
+
+
+def synthetic_network(sim, hubs=200, edges_per_hub=16, travel_fraction=1e-3, distance_decay=1.0, seed=0):
+    """Gravity-model network between `hubs` populated cells, for tests and demos without travel data.
+
+    Hubs are drawn with probability proportional to population; each sends
+    travel_fraction of its population per tick to up to `edges_per_hub`
+    destinations, drawn with weight about pop_j / distance**distance_decay
+    and sharing the flow in that proportion.
+    """
+    rng = np.random.default_rng(seed)
+    grid = cell_population(sim)
+    population = grid.ravel()
+    populated = np.flatnonzero(population > 0)
+    hubs = min(int(hubs), len(populated))
+    if hubs < 2:
+        raise ValueError('A mobility network needs at least two populated cells')
+    weights = population[populated] / population[populated].sum()
+    cells = rng.choice(populated, size=hubs, replace=False, p=weights)
+    lon, lat = cell_centres(sim.transform, cells, sim.COLS)
+    pop = population[cells]
+    k = min(int(edges_per_hub), hubs - 1)
+
+    # Candidates are drawn by population, then k kept by distance with Gumbel
+    # top-k, so generation costs O(hubs * k) rather than O(hubs ** 2).
+    cumulative = np.cumsum(pop)
+    candidates = 4 * k
+    rows, cols, vals = [], [], []
+    block = max(1, (1 << 20) // candidates)
+    for start in range(0, hubs, block):
+        origins = np.arange(start, min(start + block, hubs))
+        cand = np.searchsorted(cumulative, rng.random((len(origins), candidates)) * cumulative[-1], side='right')
+        cand = np.minimum(cand, hubs - 1)
+        dist = np.hypot(lon[cand] - lon[origins, None], lat[cand] - lat[origins, None])
+        log_decay = -distance_decay * np.log(np.maximum(dist, 1e-6))
+        log_decay[cand == origins[:, None]] = -np.inf
+        keys = log_decay + rng.gumbel(size=cand.shape)
+        pick = np.argpartition(-keys, k - 1, axis=1)[:, :k]
+        dest = np.take_along_axis(cand, pick, axis=1)
+        gravity = pop[dest] * np.exp(np.take_along_axis(log_decay, pick, axis=1))
+        # An origin whose candidates were all itself sends nothing.
+        total = gravity.sum(axis=1, keepdims=True)
+        share = np.divide(gravity, total, out=np.zeros_like(gravity), where=total > 0)
+        rows.append(np.repeat(origins, k))
+        cols.append(dest.ravel())
+        vals.append((share * travel_fraction).ravel())
+    flows = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                              shape=(hubs, hubs))
+    return MobilityNetwork(cells, flows, grid, sim.transform)
+
+
+def make_network(spec, sim):
+    """Network for SIM_MOBILITY: 'synthetic[:hubs[:edges_per_hub]]' or the path of an .npz"""
+    spec = str(spec)
+    if spec.split(':')[0] == 'synthetic':
+        parts = [int(v) for v in spec.split(':')[1:]]
+        return synthetic_network(sim, *parts[:2])
+    return load_network(spec, sim)
+
+
+def check_conservation(sim, flow=0.5, seed=0.1, travel_ticks=2):
+    """(people infected, people recovered) after seeding the most populous cell and draining the queues.
+
+    Spread and deaths are switched off and the state is reset, so the two
+    should match whatever travel did in between: `flow` of the seeded cell
+    travels to the next most populous one for `travel_ticks` ticks.
+    """
+    sim._init_state_arrays()
+    sim.SPREAD_RATE = 0.0
+    sim.FATALITY_RATE = 0.0
+    population = cell_population(sim).ravel()
+    dest, origin = np.argsort(population)[-2:]
+    flows = sparse.csr_matrix(np.array([[0.0, flow], [0.0, 0.0]]))
+    sim.mobility = MobilityNetwork([origin, dest], flows, cell_population(sim), sim.transform,
+                                   schedule=[(sim.iter + travel_ticks + 1, 0.0)])
+    # Seed like an intervention: from the susceptibles, into this tick's healing cohort.
+    for grid, change in ((sim.g, -seed), (sim.r, seed), (sim.sickened, seed)):
+        grid.reshape(-1)[origin] += change
+    sim.play()
+    for _ in range(travel_ticks + sim.SICKEN_RATE + sim.HEAL_RATE + 2):
+        sim.run_tick()
+    recovered = float(np.dot(sim.b.reshape(-1).astype(np.float64), population))
+    return seed * population[origin], recovered
+
+
+if __name__ == '__main__':
+    # Usage: python mobility.py [downsample factor] -- travel conservation check on a synthetic raster
+    import contextlib
+    import io
+    import sys
+    import tempfile
+
+    from bench import _env, synthetic_raster
+    from sim import VirusSimulation
+
+    factor = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    with tempfile.TemporaryDirectory(prefix='sim-mobility-') as tmp:
+        geotiff = synthetic_raster(Path(tmp) / 'synthetic_population.tif')
+        with _env(SIM_RASTER_CACHE=Path(tmp) / 'cache'), contextlib.redirect_stdout(io.StringIO()):
+            sim = VirusSimulation(geotiff_path=str(geotiff), downsample_factor=factor)
+        sim.verbose = False
+        infected, recovered = check_conservation(sim)
+    ok = np.isclose(recovered, infected, rtol=1e-5)
+    print(f'people infected {infected:.6g}, recovered {recovered:.6g} (densest cell = 1): {"ok" if ok else "FAIL"}')
+    sys.exit(0 if ok else 1)
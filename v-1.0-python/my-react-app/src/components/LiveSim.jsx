@@ -30,6 +30,152 @@ async function postApi(endpoint, body = null) {
     return await res.json();
 }
 
+// Map the 0-1 virus sliders onto the backend's parameters (/api/params).
+// The defaults in VirusControls land on the simulation's own defaults;
+// the *_RATE delays are in ticks, so a faster rate means a shorter delay.
+function virusParams(values) {
+    const delay = (scale, v, max) => Math.max(1, Math.min(max, Math.round(scale / Math.max(v, 0.01))));
+    return {
+        SPREAD_RATE: values.spread * 2,
+        SICKEN_RATE: delay(4, values.sicken, 60),
+        HEAL_RATE: delay(1.4, values.recovery, 100),
+        IMMUNITY_LOSS_RATE: delay(60, values.immunityLoss, 3000),
+        FATALITY_RATE: values.fatality * 0.00892,
+    };
+}
+
+// Binary frame stream (/api/frames/stream): each packet is a 24-byte little-endian header
+// (magic "SIMF", version u32, iteration u32, rows u16, cols u16, channels u8, encoding u8,
+// tile size u16, payload length u32) followed by row-major RGB bytes, raw (0) or
+// zlib-compressed (1), or a zlib-compressed delta of changed tiles (2).
+const FRAME_HEADER_BYTES = 24;
+const FRAME_MAGIC = 0x464d4953; // "SIMF" read as little-endian u32
+const STREAM_FPS = 15;
+// Delta streams: how often we tell the backend which frame we hold.
+const ACK_INTERVAL_MS = 250;
+
+// The simulated grid's (west, south, east, north) in degrees: the whole world unless the
+// backend runs a regional window (SIM_REGION / SIM_BBOX), which /api/state reports.
+const WORLD_BOUNDS = [-180, -90, 180, 90];
+// Largest render grid; the world fills it exactly at a quarter degree per pixel.
+const MAX_W = 1440;
+const MAX_H = 720;
+
+// Render grid for the given bounds: square pixels in degrees, as large as fits in MAX_W x MAX_H.
+function renderGrid(bounds) {
+    const [west, south, east, north] = bounds;
+    const scale = Math.min(MAX_W / (east - west), MAX_H / (north - south));
+    return {
+        bounds,
+        w: Math.max(1, Math.round((east - west) * scale)),
+        h: Math.max(1, Math.round((north - south) * scale)),
+    };
+}
+
+async function fetchGridBounds() {
+    const res = await fetch(`${resolveApiBase()}/api/state`);
+    if (!res.ok) {
+        throw new Error(`GET /api/state failed (${res.status})`);
+    }
+    const state = await res.json();
+    return state.grid?.bounds || WORLD_BOUNDS;
+}
+
+async function inflate(bytes) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+// Rebuild a frame from a delta: base version u32, tile count u32, then (tile row u16, tile col u16)
+// per changed tile, then each tile's pixels (edge tiles are clipped to the grid).
+function applyDelta(held, body, rows, cols, tile) {
+    const view = new DataView(body.buffer, body.byteOffset, body.byteLength);
+    const base = view.getUint32(0, true);
+    const count = view.getUint32(4, true);
+    const src = held.get(base);
+    if (!src) throw new Error(`delta base ${base} not held`);
+
+    // The backend never goes back to an older base, so older frames can go.
+    for (const version of held.keys()) {
+        if (version < base) held.delete(version);
+    }
+
+    const out = src.slice();
+    let off = 8 + count * 4;
+    for (let i = 0; i < count; i++) {
+        const y0 = view.getUint16(8 + i * 4, true) * tile;
+        const x0 = view.getUint16(10 + i * 4, true) * tile;
+        const h = Math.min(tile, rows - y0);
+        const rowBytes = Math.min(tile, cols - x0) * 3;
+        for (let y = 0; y < h; y++) {
+            out.set(body.subarray(off, off + rowBytes), ((y0 + y) * cols + x0) * 3);
+            off += rowBytes;
+        }
+    }
+    return out;
+}
+
+// Reads packets off the stream and calls onFrame(rgb, rows, cols, iteration) for each one.
+async function readFrameStream(apiBase, signal, onFrame) {
+    const encoding = typeof DecompressionStream !== "undefined" ? "delta" : "raw";
+    const res = await fetch(`${apiBase}/api/frames/stream?fps=${STREAM_FPS}&encoding=${encoding}`, { signal });
+    if (!res.ok || !res.body) {
+        throw new Error(`frame stream unavailable (${res.status})`);
+    }
+
+    const client = res.headers.get("X-Client-Id");
+    const held = new Map(); // frames we acked, by version: possible delta bases
+    let lastAck = 0;
+
+    const reader = res.body.getReader();
+    let buf = new Uint8Array(0);
+    for (;;) {
+        const { value, done } = await reader.read();
+        if (done) return;
+
+        const joined = new Uint8Array(buf.length + value.length);
+        joined.set(buf);
+        joined.set(value, buf.length);
+        buf = joined;
+
+        while (buf.length >= FRAME_HEADER_BYTES) {
+            const view = new DataView(buf.buffer, buf.byteOffset, buf.byteLength);
+            if (view.getUint32(0, true) !== FRAME_MAGIC) {
+                throw new Error("frame stream out of sync");
+            }
+            const version = view.getUint32(4, true);
+            const iteration = view.getUint32(8, true);
+            const rows = view.getUint16(12, true);
+            const cols = view.getUint16(14, true);
+            const kind = view.getUint8(17);
+            const tile = view.getUint16(18, true);
+            const length = view.getUint32(20, true);
+            if (buf.length < FRAME_HEADER_BYTES + length) break;
+
+            const payload = buf.slice(FRAME_HEADER_BYTES, FRAME_HEADER_BYTES + length);
+            buf = buf.slice(FRAME_HEADER_BYTES + length);
+
+            let rgb = payload;
+            if (kind === 1) rgb = await inflate(payload);
+            if (kind === 2) rgb = applyDelta(held, await inflate(payload), rows, cols, tile);
+            onFrame(rgb, rows, cols, iteration);
+
+            // Keyframes are acked at once so deltas can start from them.
+            const now = Date.now();
+            if (encoding === "delta" && client && !held.has(version) && (kind === 1 || now - lastAck >= ACK_INTERVAL_MS)) {
+                held.set(version, rgb);
+                lastAck = now;
+                fetch(`${apiBase}/api/frames/ack`, {
+                    method: "POST",
+                    headers: { "Content-Type": "application/json" },
+                    body: JSON.stringify({ client, version }),
+                    signal,
+                }).catch(() => {});
+            }
+        }
+    }
+}
+
 // LiveSimNew: variant of LiveSim that uses PNG frames instead of binary frames
 // - Takes the population geotiff file and turns it into a visual (dots are multiplied by population to get size).
 // - Polls a PNG frame (backend_2.0/sim_frame.png) and decodes it to access pixel data
@@ -62,8 +208,8 @@ export default function LiveSim() {
     // Hidden canvas for PNG decoding
     const decoderCanvasRef = useRef(null);
 
-    const BASE_W = 1440;
-    const BASE_H = 720;
+    // Render grid (size and geographic bounds) that canvas pixels, frames and clicks map through.
+    const gridRef = useRef(renderGrid(WORLD_BOUNDS));
 
     const [loading, setLoading] = useState(true);
     const [error, setError] = useState(null);
@@ -82,19 +228,30 @@ export default function LiveSim() {
     });
 
     const [virusValues, setVirusValues] = useState(() => VIRUS_DEFAULTS);
+    const virusSyncedRef = useRef(false);
 
     const togglePanel = (p) => {
         setOpenPanel((v) => (v === p ? null : p));
     };
 
     // Load & resample population
-    // I fetch a GeoTIFF and use it in it the fixed BASE_W x BASE_H grid used for rendering.
+    // I fetch a GeoTIFF and resample it onto the render grid of the simulated bounds.
     // This simplifies mapping between population values and canvas pixels so sizing remains predictable.
     useEffect(() => {
         let alive = true;
 
         const load = async () => {
             try {
+                let bounds = WORLD_BOUNDS;
+                try {
+                    bounds = await fetchGridBounds();
+                } catch (e) {
+                    console.warn("Grid bounds unavailable, assuming the world grid:", e);
+                }
+                const grid = renderGrid(bounds);
+                const { w: gridW, h: gridH } = grid;
+                const [west, south, east, north] = bounds;
+
                 const tiff = await fromUrl("/population.tif");
                 const img = await tiff.getImage();
                 const w = img.getWidth();
@@ -106,16 +263,28 @@ export default function LiveSim() {
                 const raw = new Float32Array(w * h);
                 for (let i = 0; i < w * h; i++) raw[i] = ras[i * spp] || 0;
 
-                // simple nearest-neighbor downsample to our base sim grid
-                const resized = new Float32Array(BASE_W * BASE_H);
-                for (let y = 0; y < BASE_H; y++) {
-                    const sy = Math.floor((y / BASE_H) * h);
-                    for (let x = 0; x < BASE_W; x++) {
-                        const sx = Math.floor((x / BASE_W) * w);
-                        resized[y * BASE_W + x] = raw[sy * w + sx] || 0;
+                // simple nearest-neighbor resample of the raster's cells under each render pixel
+                let box = WORLD_BOUNDS;
+                try {
+                    box = img.getBoundingBox();
+                } catch (e) {
+                    console.warn("population.tif has no georeferencing, assuming it covers the world:", e);
+                }
+                const [bx0, by0, bx1, by1] = box;
+                const resized = new Float32Array(gridW * gridH);
+                for (let y = 0; y < gridH; y++) {
+                    const lat = north - ((y + 0.5) / gridH) * (north - south);
+                    const sy = Math.floor(((by1 - lat) / (by1 - by0)) * h);
+                    if (sy < 0 || sy >= h) continue;
+                    for (let x = 0; x < gridW; x++) {
+                        const lon = west + ((x + 0.5) / gridW) * (east - west);
+                        const sx = Math.floor(((lon - bx0) / (bx1 - bx0)) * w);
+                        if (sx < 0 || sx >= w) continue;
+                        resized[y * gridW + x] = raw[sy * w + sx] || 0;
                     }
                 }
 
+                gridRef.current = grid;
                 popResRef.current = resized;
 
                 // compute a percentile-based max for nicer radius scaling
@@ -147,15 +316,19 @@ export default function LiveSim() {
         const canvas = canvasRef.current;
         const ctx = canvas.getContext("2d");
 
-        canvas.width = BASE_W;
-        canvas.height = BASE_H;
-
         const draw = () => {
             const sim = simBufRef.current;
             const pop = popResRef.current;
+            const { w: gridW, h: gridH } = gridRef.current;
+
+            // The canvas follows the render grid, whose aspect is that of the simulated bounds.
+            if (canvas.width !== gridW || canvas.height !== gridH) {
+                canvas.width = gridW;
+                canvas.height = gridH;
+            }
 
-            if (sim && pop) {
-                ctx.clearRect(0, 0, BASE_W, BASE_H);
+            if (sim && pop && pop.length === gridW * gridH) {
+                ctx.clearRect(0, 0, gridW, gridH);
 
                 // apply zoom and offset so zoom is anchored to user interactions
                 const z = zoomRef.current;
@@ -169,9 +342,9 @@ export default function LiveSim() {
                 const exp = compressExpRef.current;
 
                 // iterate over the downsampled grid and draw a colored circle where population exists
-                for (let y = 0; y < BASE_H; y += step) {
-                    for (let x = 0; x < BASE_W; x += step) {
-                        const idx = y * BASE_W + x;
+                for (let y = 0; y < gridH; y += step) {
+                    for (let x = 0; x < gridW; x += step) {
+                        const idx = y * gridW + x;
                         const p = pop[idx];
                         if (!p) continue;
 
@@ -206,26 +379,34 @@ export default function LiveSim() {
         };
     }, []);
 
-    // Poll the backend for the latest simulation frame (PNG image)
-    // Decode PNG to get pixel data similar to fetch_frame.js
-    // Only poll when receiver is not active - otherwise we get data from WebRTC
+    // Receive frames from the backend: the binary stream when it is available, otherwise
+    // poll the latest PNG frame and decode it to access pixel data similar to fetch_frame.js
+    // Only runs when receiver is not active - otherwise we get data from WebRTC
     useEffect(() => {
         // Create hidden decoder canvas once
         if (!decoderCanvasRef.current) {
-            const decoderCanvas = document.createElement('canvas');
-            decoderCanvas.width = BASE_W;
-            decoderCanvas.height = BASE_H;
-            decoderCanvasRef.current = decoderCanvas;
+            decoderCanvasRef.current = document.createElement('canvas');
         }
 
+        // Decoder context sized to the current render grid
+        const decoderContext = () => {
+            const decoderCanvas = decoderCanvasRef.current;
+            const { w: gridW, h: gridH } = gridRef.current;
+            if (decoderCanvas.width !== gridW || decoderCanvas.height !== gridH) {
+                decoderCanvas.width = gridW;
+                decoderCanvas.height = gridH;
+            }
+            return decoderCanvas.getContext("2d", { willReadFrequently: true });
+        };
+
         const poll = async () => {
             if (pollAbortRef.current) pollAbortRef.current.abort();
             const ac = new AbortController();
             pollAbortRef.current = ac;
 
             try {
-                // Fetch directly from the middleware serving the backend file
-                const frameUrl = `${API_BASE_URL}/sim_frame.png?cb=${Date.now()}`;
+                // The backend renders frames in memory; there is no file to serve directly
+                const frameUrl = `${resolveApiBase()}/sim_frame.png?cb=${Date.now()}`;
                 const r = await fetch(frameUrl, {
                     signal: ac.signal,
                 });
@@ -245,16 +426,16 @@ export default function LiveSim() {
                 const img = new Image();
 
                 img.onload = () => {
-                    const decoderCanvas = decoderCanvasRef.current;
-                    const decoderCtx = decoderCanvas.getContext("2d", { willReadFrequently: true });
+                    const decoderCtx = decoderContext();
+                    const { w: gridW, h: gridH } = gridRef.current;
 
-                    // Draw image to hidden canvas, scaling to BASE dimensions
-                    decoderCtx.drawImage(img, 0, 0, BASE_W, BASE_H);
+                    // Draw image to hidden canvas, scaling to the render grid
+                    decoderCtx.drawImage(img, 0, 0, gridW, gridH);
 
 
 
                     // Get pixel data - this gives us RGBA (4 bytes per pixel)
-                    const imageData = decoderCtx.getImageData(0, 0, BASE_W, BASE_H);
+                    const imageData = decoderCtx.getImageData(0, 0, gridW, gridH);
 
                     // Store the RGBA data (we'll use R, G, B and ignore A)
                     simBufRef.current = imageData.data;
@@ -277,13 +458,48 @@ export default function LiveSim() {
         };
 
 
-        // Only start polling if receiver is not active
-        if (!receiverActive) {
+        // Scale a streamed RGB frame of the sim's resolution up to the render grid as RGBA
+        const showStreamFrame = (rgb, rows, cols) => {
+            const frameCanvas = document.createElement("canvas");
+            frameCanvas.width = cols;
+            frameCanvas.height = rows;
+            const frame = frameCanvas.getContext("2d").createImageData(cols, rows);
+            for (let i = 0, o = 0; i < rgb.length; i += 3, o += 4) {
+                frame.data[o] = rgb[i];
+                frame.data[o + 1] = rgb[i + 1];
+                frame.data[o + 2] = rgb[i + 2];
+                frame.data[o + 3] = 255;
+            }
+            frameCanvas.getContext("2d").putImageData(frame, 0, 0);
+
+            const decoderCtx = decoderContext();
+            const { w: gridW, h: gridH } = gridRef.current;
+            decoderCtx.imageSmoothingEnabled = false;
+            decoderCtx.drawImage(frameCanvas, 0, 0, gridW, gridH);
+            simBufRef.current = decoderCtx.getImageData(0, 0, gridW, gridH).data;
+        };
+
+        const streamAbort = new AbortController();
+        const startPolling = () => {
+            if (streamAbort.signal.aborted || pollIntervalRef.current) return;
             poll();
             pollIntervalRef.current = setInterval(poll, 250);
+        };
+
+        // Only start receiving if receiver is not active
+        if (!receiverActive) {
+            readFrameStream(resolveApiBase(), streamAbort.signal, (rgb, rows, cols) => {
+                setConnectionError(false);
+                showStreamFrame(rgb, rows, cols);
+            })
+                .catch((e) => {
+                    if (e.name !== "AbortError") console.warn("Frame stream failed, polling PNG frames:", e);
+                })
+                .finally(startPolling);
         }
 
         return () => {
+            streamAbort.abort();
             clearInterval(pollIntervalRef.current);
             pollIntervalRef.current = null;
             if (pollAbortRef.current) pollAbortRef.current.abort();
@@ -299,8 +515,9 @@ export default function LiveSim() {
         const onWheel = (e) => {
             e.preventDefault();
             const rect = canvas.getBoundingClientRect();
-            const mx = e.clientX - rect.left;
-            const my = e.clientY - rect.top;
+            // Canvas pixels under the cursor (CSS scales the canvas to its wrapper).
+            const mx = (e.clientX - rect.left) * (canvas.width / rect.width);
+            const my = (e.clientY - rect.top) * (canvas.height / rect.height);
 
             const prev = zoomRef.current;
             const next = Math.min(20, Math.max(1, prev * Math.exp(-e.deltaY * 0.001)));
@@ -312,11 +529,36 @@ export default function LiveSim() {
             zoomRef.current = next;
         };
 
+        // Shift-click seeds an outbreak and alt-click vaccinates around the
+        // clicked point (/api/interventions, applied on the next tick).
+        const onClick = (e) => {
+            if (!e.shiftKey && !e.altKey) return;
+            const rect = canvas.getBoundingClientRect();
+            const z = zoomRef.current;
+            const { w: gridW, h: gridH, bounds } = gridRef.current;
+            const [west, south, east, north] = bounds;
+            // Client pixels to canvas pixels (CSS may scale the canvas), then undo the zoom.
+            const x = ((e.clientX - rect.left) * (canvas.width / rect.width) - offsetRef.current.x) / z;
+            const y = ((e.clientY - rect.top) * (canvas.height / rect.height) - offsetRef.current.y) / z;
+            if (x < 0 || y < 0 || x >= gridW || y >= gridH) return;
+            const body = {
+                kind: e.shiftKey ? "seed" : "vaccinate",
+                lat: north - (y / gridH) * (north - south),
+                lon: west + (x / gridW) * (east - west),
+                radius: e.shiftKey ? 1 : 8,
+            };
+            postApi("/api/interventions", body).catch((err) => {
+                console.error("Failed to schedule intervention:", err);
+            });
+        };
+
         canvas.addEventListener("wheel", onWheel, { passive: false });
+        canvas.addEventListener("click", onClick);
         listenersAddedRef.current = true;
 
         return () => {
             canvas.removeEventListener("wheel", onWheel);
+            canvas.removeEventListener("click", onClick);
             listenersAddedRef.current = false;
         };
     }, []);
@@ -387,10 +629,26 @@ export default function LiveSim() {
         setVirusValues(VIRUS_DEFAULTS);
     };
 
+    // Send slider changes to the running simulation, debounced while dragging.
+    // The first render is skipped so opening the page keeps the server's parameters.
+    useEffect(() => {
+        if (!virusSyncedRef.current) {
+            virusSyncedRef.current = true;
+            return undefined;
+        }
+        const timer = setTimeout(() => {
+            postApi("/api/params", virusParams(virusValues)).catch((err) => {
+                console.error("Failed to update virus parameters:", err);
+            });
+        }, 250);
+        return () => clearTimeout(timer);
+    }, [virusValues]);
+
     // Handle data received from EarthDataReceiver via WebRTC
     const handleEarthDataReceived = (uint8Array, frameNum) => {
-        // Validate size matches expected dimensions (1440 × 720 × 3)
-        if (uint8Array.length === BASE_W * BASE_H * 3) {
+        // Validate size matches the render grid (gridW × gridH × 3)
+        const { w: gridW, h: gridH } = gridRef.current;
+        if (uint8Array.length === gridW * gridH * 3) {
             simBufRef.current = uint8Array;
         } else {
             console.warn(`Received frame ${frameNum} with unexpected size: ${uint8Array.length}`);
@@ -8,9 +8,8 @@ export const DEFAULTS = {
   immunityLoss: 0.2,
   fatality: 0.1,
   contagiousness: 0.5,
-  // these are the variables for controlling the virus. Arbitrary values right now that will be fine tuned.
-  //These have to be sent back to the back end when updated but that's gonna be done in the future
-  //For now, these change how the virus looks
+  // these are the variables for controlling the virus. LiveSim sends them to /api/params
+  // (see virusParams there); contagiousness only changes how the virus looks for now
 };
 
 export default function VirusControls(props) {
@@ -0,0 +1,99 @@
+"""Runs compute backends side by side from the same start and reports how far they drift apart.
+
+Usage:
+    python parity.py                                     # numpy against numba (or the plain-Python loop)
+    python parity.py --backends numpy python --factors 16 --ticks 5
+    python parity.py --geotiff gpw.tif --factors 4 --ticks 300 --kernel-radius 4
+
+Every backend gets its own simulation of the same raster; after each tick
+the compartments and published totals of every backend are compared with
+the first one. Backends differ in float32 roundoff only (the fused loop
+sums in float64), so the largest cell difference should stay near 1e-6.
+Exits with status 1 when it exceeds --atol. Without --geotiff the
+synthetic raster of bench.py is used.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from backends import numba_available
+from bench import _env, synthetic_raster
+from convolution import gaussian_kernel
+from sim import VirusSimulation
+
+COMPARTMENTS = ('g', 'e', 'r', 'b', 'd')
+DEFAULT_ATOL = 1e-5
+
+
+def _new_sim(geotiff, factor, backend, kernel=None):
+    with _env(SIM_BACKEND=backend), contextlib.redirect_stdout(io.StringIO()):
+        sim = VirusSimulation(geotiff_path=str(geotiff), downsample_factor=factor)
+    sim.verbose = False
+    if kernel is not None:
+        sim.SPREAD_KERNEL = kernel
+        sim.set_convolution_engine('auto')
+    sim.play()
+    return sim
+
+
+def compare_backends(geotiff, factor, backends, ticks=60, kernel=None):
+    """Tick one simulation per backend and return the worst differences from the first backend"""
+    sims = [_new_sim(geotiff, factor, backend, kernel) for backend in backends]
+    reference = sims[0]
+    worst = {backend: {'cell': 0.0, 'total': 0.0, 'tick': 0} for backend in backends[1:]}
+    for tick in range(1, ticks + 1):
+        for sim in sims:
+            sim.run_tick()
+        for backend, sim in zip(backends[1:], sims[1:]):
+            cell = max(float(np.abs(getattr(sim, name) - getattr(reference, name)).max()) for name in COMPARTMENTS)
+            totals = np.subtract(sim.summary.totals, reference.summary.totals)
+            total = float(np.abs(totals).max() / max(reference.ROWS * reference.COLS, 1))
+            if cell > worst[backend]['cell']:
+                worst[backend].update(cell=cell, tick=tick)
+            worst[backend]['total'] = max(worst[backend]['total'], total)
+    return {'grid': [reference.ROWS, reference.COLS], 'engine': reference.conv_engine.name, 'worst': worst}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that compute backends tick the simulation alike')
+    parser.add_argument('--backends', nargs='+',
+                        default=['numpy', 'numba' if numba_available() else 'python'],
+                        help='backends to compare; the first is the reference')
+    parser.add_argument('--geotiff', help='population raster (default: a synthetic one)')
+    parser.add_argument('--factors', type=int, nargs='+', default=[8], help='downsample factors')
+    parser.add_argument('--ticks', type=int, default=60, help='ticks per comparison')
+    parser.add_argument('--kernel-radius', type=int, nargs='*', default=[],
+                        help='also compare with Gaussian spread kernels of these radii')
+    parser.add_argument('--atol', type=float, default=DEFAULT_ATOL,
+                        help='largest cell difference that still passes (default 1e-5)')
+    args = parser.parse_args(argv)
+    if len(args.backends) < 2:
+        parser.error('--backends needs at least two backends')
+
+    kernels = [('default', None)] + [(f'gaussian r={r}', gaussian_kernel(r)) for r in args.kernel_radius]
+    failed = False
+    with tempfile.TemporaryDirectory(prefix='sim-parity-') as tmp:
+        geotiff = args.geotiff or synthetic_raster(Path(tmp) / 'synthetic_population.tif')
+        with _env(SIM_RASTER_CACHE=os.getenv('SIM_RASTER_CACHE') or Path(tmp) / 'cache'):
+            for factor in args.factors:
+                for label, kernel in kernels:
+                    result = compare_backends(geotiff, factor, args.backends, args.ticks, kernel)
+                    rows, cols = result['grid']
+                    print(f'f{factor} {rows}x{cols} kernel {label} ({result["engine"]}), {args.ticks} ticks')
+                    for backend, worst in result['worst'].items():
+                        ok = worst['cell'] <= args.atol
+                        failed |= not ok
+                        print(f'  {backend:8s} vs {args.backends[0]}: max cell diff {worst["cell"]:.2e} '
+                              f'(tick {worst["tick"]}), max total diff per cell {worst["total"]:.2e}  '
+                              f'{"ok" if ok else "FAIL"}')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,195 @@
+import bisect
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Upper bounds, in seconds, of the buckets every timing histogram counts into.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+
+
+class Histogram:
+    """Durations in seconds counted into fixed buckets, with their sum (the Prometheus histogram layout)"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf overflow.
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += seconds
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return _Timed(self)
+
+    def snapshot(self):
+        """(cumulative counts per bucket bound, +Inf last; sum; count)"""
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative, running = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, total, running
+
+
+class _Timed:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class PhaseTimer:
+    """One histogram per named phase of a sequence, timed from one mark() to the next.
+
+    start() opens the sequence and each mark(phase) records the time since
+    the previous mark, so a tick costs one clock read per phase. Holders
+    keep None instead of a timer to turn the timing off entirely.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.phases = {}
+        self._last = 0.0
+
+    def _histogram(self, phase):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases.setdefault(phase, Histogram(self.buckets))
+        return histogram
+
+    def start(self):
+        self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self._histogram(phase).observe(now - self._last)
+        self._last = now
+
+    def time(self, phase):
+        """Context manager timing a block as `phase`, outside the start/mark sequence"""
+        return _Timed(self._histogram(phase))
+
+    def snapshot(self):
+        return {phase: histogram.snapshot() for phase, histogram in list(self.phases.items())}
+
+
+class SamplingProfiler:
+    """Samples the Python stacks of other threads every `interval` seconds while running.
+
+    folded() gives the stacks in collapsed form (root;...;leaf count),
+    ready for flamegraph tools. Nothing runs, and nothing is measured, while it is
+    stopped. thread_names, if given, limits sampling to threads whose name
+    starts with one of them.
+    """
+
+    def __init__(self, interval=0.005, thread_names=None, max_depth=64):
+        self.interval = float(interval)
+        self.thread_names = tuple(thread_names or ())
+        self.max_depth = int(max_depth)
+        self.stacks = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.stopped_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=None, thread_names=None):
+        """Start sampling afresh (clears the previous profile)"""
+        self.stop()
+        if interval is not None:
+            self.interval = max(0.0005, float(interval))
+        if thread_names is not None:
+            self.thread_names = tuple(thread_names)
+        with self._lock:
+            self.stacks = Counter()
+            self.samples = 0
+        self.started_at, self.stopped_at = time.time(), None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sim-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            self.stopped_at = time.time()
+
+    def _sampled_threads(self):
+        own = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            if self.thread_names and not names.get(ident, '').startswith(self.thread_names):
+                continue
+            yield frame
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stacks = []
+            for frame in self._sampled_threads():
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append((code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stacks.append(tuple(reversed(stack)))
+            with self._lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def folded(self):
+        """The profile as 'root;...;leaf count' lines"""
+        with self._lock:
+            stacks = self.stacks.most_common()
+        return ''.join(
+            ';'.join(f'{name} ({filename}:{line})' for name, filename, line in stack) + f' {count}\n'
+            for stack, count in stacks
+        )
+
+    def top(self, limit=20):
+        """Functions by samples spent in them (self) and under them (total)"""
+        with self._lock:
+            stacks = list(self.stacks.items())
+        own, total = Counter(), Counter()
+        for stack, count in stacks:
+            name, filename, _ = stack[-1]
+            own[f'{name} ({filename})'] += count
+            for function in {f'{name} ({filename})' for name, filename, _ in stack}:
+                total[function] += count
+        return [
+            {'function': function, 'self': own.get(function, 0), 'total': count}
+            for function, count in total.most_common(limit)
+        ]
+
+    def describe(self):
+        return {
+            'running': self.running,
+            'interval_ms': self.interval * 1000,
+            'threads': list(self.thread_names),
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'started_at': self.started_at,
+            'stopped_at': self.stopped_at,
+        }
@@ -0,0 +1,291 @@
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+# Bump when the preprocessing changes so stale caches are rebuilt, not reused.
+CACHE_VERSION = 1
+DEFAULT_FACTORS = (1, 2, 4, 8, 16)
+SIZE_GRID_EXPONENT = 1.2
+# Full-resolution rows per read when scanning the whole raster for its maximum.
+SCAN_ROWS = 256
+
+# Grids already loaded by this process, shared read-only by every simulation on them.
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def default_cache_root(geotiff_path):
+    """SIM_RASTER_CACHE, or a raster_cache directory next to the GeoTIFF"""
+    root = os.getenv('SIM_RASTER_CACHE')
+    if root:
+        return Path(root)
+    return Path(geotiff_path).resolve().parent / 'raster_cache'
+
+
+def file_checksum(path, memo_root=None):
+    """sha256 of a file, remembered per (path, size, mtime) under memo_root so restarts skip the rehash"""
+    path = Path(path).resolve()
+    stat = path.stat()
+    stamp = [stat.st_size, stat.st_mtime_ns]
+
+    memo_path = Path(memo_root) / 'checksums.json' if memo_root else None
+    memo = {}
+    if memo_path is not None and memo_path.exists():
+        try:
+            memo = json.loads(memo_path.read_text())
+        except ValueError:
+            memo = {}
+        entry = memo.get(str(path))
+        if entry and entry.get('stamp') == stamp:
+            return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(chunk)
+    checksum = digest.hexdigest()
+
+    if memo_path is not None:
+        memo[str(path)] = {'stamp': stamp, 'sha256': checksum}
+        try:
+            _atomic_write(memo_path, json.dumps(memo, indent=2).encode())
+        except OSError:
+            pass
+    return checksum
+
+
+def raster_geometry(geotiff_path):
+    """(affine as a 6-tuple, (rows, cols)) of the GeoTIFF, without reading pixels"""
+    with rasterio.open(geotiff_path) as dataset:
+        t = dataset.transform
+        return (t.a, t.b, t.c, t.d, t.e, t.f), dataset.shape
+
+
+def _sanitize(data, dtype):
+    data = np.nan_to_num(data.astype(dtype, copy=False), nan=0.0, posinf=0.0, neginf=0.0)
+    return np.maximum(data.astype(dtype, copy=False), 0)
+
+
+def read_density(geotiff_path, dtype=np.float32, window=None):
+    """Band 1 of the GeoTIFF with non-finite values and negative nodata sentinels set to 0.
+
+    window is an optional full-resolution (row_off, col_off, rows, cols);
+    only that part of the raster is read.
+    """
+    with rasterio.open(geotiff_path) as dataset:
+        if window is None:
+            data = dataset.read(1)
+        else:
+            row_off, col_off, rows, cols = window
+            data = dataset.read(1, window=Window(col_off, row_off, cols, rows))
+    return _sanitize(data, dtype)
+
+
+def size_grid_max(geotiff_path, factor, dtype=np.float32):
+    """Maximum of the whole-raster sizeGrid before scaling, read in strips of whole blocks"""
+    factor = max(1, int(factor))
+    strip = factor * max(1, SCAN_ROWS // factor)
+    peak = 0.0
+    with rasterio.open(geotiff_path) as dataset:
+        rows, cols = dataset.shape
+        for row_off in range(0, rows, strip):
+            height = min(strip, rows - row_off)
+            data = _sanitize(dataset.read(1, window=Window(0, row_off, cols, height)), dtype)
+            peak = max(peak, float(np.sqrt(block_aggregate(data, factor)).astype(dtype, copy=False).max()))
+    return peak
+
+
+def block_aggregate(data, factor):
+    """Mean of each factor x factor block; edge blocks average only the cells they cover.
+
+    The raster holds densities over (near) equal-area cells, so the block
+    mean keeps the total population of every block, unlike striding, which
+    keeps one cell and drops the rest.
+    """
+    if factor <= 1:
+        return data
+    rows, cols = data.shape
+    out_rows, out_cols = -(-rows // factor), -(-cols // factor)
+    padded = np.zeros((out_rows * factor, out_cols * factor), dtype=np.float64)
+    padded[:rows, :cols] = data
+    sums = padded.reshape(out_rows, factor, out_cols, factor).sum(axis=(1, 3))
+
+    row_counts = np.full(out_rows, factor)
+    row_counts[-1] = rows - (out_rows - 1) * factor
+    col_counts = np.full(out_cols, factor)
+    col_counts[-1] = cols - (out_cols - 1) * factor
+    return (sums / np.outer(row_counts, col_counts)).astype(data.dtype)
+
+
+def size_grids_from_density(density, dtype=np.float32, grid_max=None):
+    """sizeGrid (sqrt density scaled to a max of 1) and sizeGridPow, as VirusSimulation uses them.
+
+    grid_max overrides the scale, so a window can share the whole raster's.
+    """
+    size_grid = np.sqrt(density).astype(dtype, copy=False)
+    if grid_max is None:
+        grid_max = float(np.max(size_grid)) if size_grid.size else 0.0
+    if grid_max > 0:
+        size_grid = size_grid / grid_max
+    size_grid_pow = np.power(size_grid, SIZE_GRID_EXPONENT).astype(dtype, copy=False)
+    return size_grid.astype(dtype, copy=False), size_grid_pow
+
+
+def cache_dir(geotiff_path, root=None):
+    root = Path(root) if root else default_cache_root(geotiff_path)
+    return root / f'v{CACHE_VERSION}-{file_checksum(geotiff_path, root)[:16]}'
+
+
+def _atomic_write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _save_npy(path, arr):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            np.save(fh, arr)
+        # Other users' server processes map the same files.
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _grid_paths(directory, factor, window=None):
+    suffix = f'_f{factor}'
+    if window is not None:
+        suffix += '_w{}_{}_{}x{}'.format(*window)
+    return directory / f'sizeGrid{suffix}.npy', directory / f'sizeGridPow{suffix}.npy'
+
+
+def build_cache(geotiff_path, factors=DEFAULT_FACTORS, root=None, dtype=np.float32, density=None, window=None):
+    """Write sizeGrid/sizeGridPow .npy files for each downsample factor and return the cache directory.
+
+    With a window only that part of the raster is preprocessed, scaled by
+    the whole raster's maximum so the result is a slice of the full grid.
+    """
+    directory = cache_dir(geotiff_path, root)
+    if density is None:
+        density = read_density(geotiff_path, dtype, window)
+
+    manifest_path = directory / 'manifest.json'
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': str(Path(geotiff_path).resolve()),
+        'sha256': file_checksum(geotiff_path, directory.parent),
+        'shape': list(raster_geometry(geotiff_path)[1]),
+        'factors': {},
+        'windows': {},
+    }
+    if manifest_path.exists():
+        try:
+            previous = json.loads(manifest_path.read_text())
+            manifest['factors'] = previous.get('factors', {})
+            manifest['windows'] = previous.get('windows', {})
+        except ValueError:
+            pass
+
+    for factor in factors:
+        factor = max(1, int(factor))
+        aggregated = block_aggregate(density, factor)
+        if window is None:
+            size_max = float(np.max(np.sqrt(aggregated).astype(dtype, copy=False))) if aggregated.size else 0.0
+        else:
+            size_max = manifest['factors'].get(str(factor), {}).get('size_max')
+            if size_max is None:
+                size_max = size_grid_max(geotiff_path, factor, dtype)
+        size_grid, size_grid_pow = size_grids_from_density(aggregated, dtype, size_max)
+
+        grid_path, pow_path = _grid_paths(directory, factor, window)
+        _save_npy(grid_path, size_grid)
+        _save_npy(pow_path, size_grid_pow)
+        entry = {'shape': list(size_grid.shape), 'dtype': np.dtype(dtype).str, 'size_max': size_max}
+        if window is None:
+            manifest['factors'][str(factor)] = entry
+        else:
+            manifest['windows'][grid_path.stem[len('sizeGrid_'):]] = dict(entry, window=list(window))
+
+    _atomic_write(manifest_path, json.dumps(manifest, indent=2).encode())
+    return directory
+
+
+def _compute_size_grids(geotiff_path, factor, dtype, window):
+    grid_max = size_grid_max(geotiff_path, factor, dtype) if window is not None else None
+    density = block_aggregate(read_density(geotiff_path, dtype, window), factor)
+    return size_grids_from_density(density, dtype, grid_max)
+
+
+def load_size_grids(geotiff_path, factor, dtype=np.float32, root=None, window=None):
+    """sizeGrid and sizeGridPow for one downsample factor, memory-mapped read-only from the cache.
+
+    window optionally restricts the grids to a full-resolution
+    (row_off, col_off, rows, cols) aligned to the factor (see
+    regions.bbox_window). A missing entry is built and written on first
+    use. With SIM_RASTER_CACHE=off, or when the cache cannot be written,
+    the grids are computed in memory the same way. Repeated calls in one
+    process return the same read-only arrays.
+    """
+    factor = max(1, int(factor))
+    window = tuple(int(v) for v in window) if window is not None else None
+    path = Path(geotiff_path).resolve()
+    key = (str(path), path.stat().st_mtime_ns, factor, np.dtype(dtype).str,
+           str(root or os.getenv('SIM_RASTER_CACHE') or ''), window)
+    with _loaded_lock:
+        if key not in _loaded:
+            grids = _load_size_grids(geotiff_path, factor, dtype, root, window)
+            for grid in grids:
+                grid.flags.writeable = False
+            _loaded[key] = grids
+        return _loaded[key]
+
+
+def _load_size_grids(geotiff_path, factor, dtype, root, window):
+    if (root or os.getenv('SIM_RASTER_CACHE')) == 'off':
+        return _compute_size_grids(geotiff_path, factor, dtype, window)
+
+    try:
+        directory = cache_dir(geotiff_path, root)
+        grid_path, pow_path = _grid_paths(directory, factor, window)
+        if not (grid_path.exists() and pow_path.exists()):
+            build_cache(geotiff_path, [factor], root, dtype, window=window)
+    except OSError as exc:
+        print(f"Raster cache unavailable ({exc}); preprocessing in memory")
+        return _compute_size_grids(geotiff_path, factor, dtype, window)
+
+    size_grid = np.load(grid_path, mmap_mode='r')
+    size_grid_pow = np.load(pow_path, mmap_mode='r')
+    if size_grid.dtype != dtype:
+        size_grid, size_grid_pow = size_grid.astype(dtype), size_grid_pow.astype(dtype)
+    return size_grid, size_grid_pow
+
+
+if __name__ == '__main__':
+    # Usage: python raster_cache.py [geotiff] [factor ...]
+    geotiff = sys.argv[1] if len(sys.argv) > 1 else 'gpw_v4_population_density_rev11_2020_15_min.tif'
+    factors = [int(f) for f in sys.argv[2:]] or list(DEFAULT_FACTORS)
+
+    directory = build_cache(geotiff, factors)
+    print(f'Cache written to {directory}')
+    for factor in factors:
+        grid_path, pow_path = _grid_paths(directory, factor)
+        shape = np.load(grid_path, mmap_mode='r').shape
+        print(f'  factor {factor:2d}: {shape[0]} x {shape[1]}')
@@ -0,0 +1,257 @@
+import numpy as np
+import hashlib
+import json
+import threading
+from pathlib import Path
+
+import rasterio
+
+from raster_cache import _atomic_write, _save_npy, default_cache_root, file_checksum
+from regions import REGIONS
+from transitions import TOTAL_COLUMNS
+
+# Label value of cells that belong to no region.
+NO_REGION = 0
+# Shapefile attributes tried, in order, for region names.
+NAME_FIELDS = ('NAME', 'NAME_EN', 'ADMIN', 'name', 'NAME_1', 'NAME_0')
+
+
+def labels_from_boxes(sim, boxes=None):
+    """Label grid from named (west, south, east, north) boxes, REGIONS by default; later boxes win"""
+    boxes = REGIONS if boxes is None else boxes
+    a, _, c, _, e, f = sim.transform
+    lon = c + (np.arange(sim.COLS) + 0.5) * a
+    lat = f + (np.arange(sim.ROWS) + 0.5) * e
+    labels = np.zeros((sim.ROWS, sim.COLS), dtype=np.int32)
+    names = {}
+    for code, (name, (west, south, east, north)) in enumerate(boxes.items(), start=1):
+        rows = (lat >= south) & (lat < north)
+        cols = (lon >= west) & (lon < east)
+        labels[np.ix_(rows, cols)] = code
+        names[code] = name
+    return labels, names
+
+
+def _labels_from_raster(path, sim):
+    """Labels of an integer GeoTIFF aligned with the population raster, sampled at each block centre"""
+    factor = sim.downsample_factor
+    with rasterio.open(path) as dataset:
+        if tuple(dataset.shape) != tuple(sim.raster_shape):
+            raise ValueError(f'Label raster {path} is {dataset.shape}; the population raster is '
+                             f'{tuple(sim.raster_shape)}')
+        row_off, col_off, rows, cols = sim.window or (0, 0) + tuple(sim.raster_shape)
+        row_idx = np.minimum(row_off + np.arange(sim.ROWS) * factor + factor // 2, row_off + rows - 1)
+        col_idx = np.minimum(col_off + np.arange(sim.COLS) * factor + factor // 2, col_off + cols - 1)
+        window = rasterio.windows.Window(col_off, row_off, cols, rows)
+        data = dataset.read(1, window=window)
+        nodata = dataset.nodata
+    labels = data[np.ix_(row_idx - row_off, col_idx - col_off)].astype(np.int32)
+    if nodata is not None:
+        labels[data[np.ix_(row_idx - row_off, col_idx - col_off)] == nodata] = NO_REGION
+    labels[labels < 0] = NO_REGION
+    names_path = Path(path).with_suffix('.json')
+    names = {int(k): v for k, v in json.loads(names_path.read_text()).items()} if names_path.exists() else {}
+    return labels, names
+
+
+def _labels_from_shapes(path, sim, field=None):
+    """Rasterize a shapefile (or any vector file fiona reads) onto the simulation grid"""
+    try:
+        import fiona
+    except ImportError:
+        raise ImportError('Reading region shapes needs fiona (pip install fiona)') from None
+    from rasterio import features
+
+    shapes, names = [], {}
+    with fiona.open(path) as source:
+        for code, feature in enumerate(source, start=1):
+            props = dict(feature['properties'])
+            keys = [field] if field else [k for k in NAME_FIELDS if k in props]
+            names[code] = str(props[keys[0]]) if keys else str(code)
+            shapes.append((feature['geometry'], code))
+    labels = features.rasterize(
+        shapes,
+        out_shape=(sim.ROWS, sim.COLS),
+        transform=rasterio.Affine(*sim.transform),
+        fill=NO_REGION,
+        dtype='int32',
+    )
+    return labels, names
+
+
+def load_labels(path, sim, field=None, cache_root=None):
+    """(label grid matching sim's grid, {label: name}) from a label file.
+
+    path is 'continents' for the built-in REGIONS boxes, a .npy grid at the
+    simulation resolution (names in a .json beside it), an integer GeoTIFF
+    aligned with the population raster, or a vector file such as a
+    shapefile. Rasterized shapes are cached next to the raster cache.
+    """
+    if str(path) == 'continents':
+        return labels_from_boxes(sim)
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == '.npy':
+        labels = np.load(path).astype(np.int32)
+        if labels.shape != (sim.ROWS, sim.COLS):
+            raise ValueError(f'Label grid {path} is {labels.shape}; the simulation is {(sim.ROWS, sim.COLS)}')
+        names_path = path.with_suffix('.json')
+        names = {int(k): v for k, v in json.loads(names_path.read_text()).items()} if names_path.exists() else {}
+        return labels, names
+    if suffix in ('.tif', '.tiff'):
+        return _labels_from_raster(path, sim)
+
+    root = Path(cache_root) if cache_root else default_cache_root(sim.geotiff_path) / 'labels'
+    key = hashlib.sha256(json.dumps(
+        [file_checksum(path), list(sim.transform), [sim.ROWS, sim.COLS], field]
+    ).encode()).hexdigest()[:16]
+    grid_path, names_path = root / f'{path.stem}-{key}.npy', root / f'{path.stem}-{key}.json'
+    if grid_path.exists() and names_path.exists():
+        names = {int(k): v for k, v in json.loads(names_path.read_text()).items()}
+        return np.load(grid_path), names
+
+    labels, names = _labels_from_shapes(path, sim, field)
+    try:
+        _save_npy(grid_path, labels)
+        _atomic_write(names_path, json.dumps(names).encode())
+    except OSError as exc:
+        print(f'Unable to cache rasterized regions ({exc})')
+    return labels, names
+
+
+class RegionIndex:
+    """Per-region compartment totals from a label grid, computed in one vectorized pass per tick.
+
+    Region labels are spatially coherent, so each grid row splits into a few
+    runs of equal label. The run starts are found once; every update sums
+    the runs with np.add.reduceat over the contiguous grids and folds the
+    run sums into (compartment, region) bins with a single np.bincount,
+    instead of masking the grid once per region. The last `history`
+    updates are kept for per-region series.
+    """
+
+    def __init__(self, labels, names=None, history=2000):
+        labels = np.asarray(labels)
+        # Kept for masks over a region (interventions.label_mask).
+        self.labels = labels
+        rows, cols = labels.shape
+        flat = labels.ravel()
+        labelled = flat != NO_REGION
+        self.codes = np.unique(flat[labelled])
+        self.names = {int(code): (names or {}).get(int(code), str(int(code))) for code in self.codes}
+        self.K = len(self.codes)
+        self.cell_counts = np.bincount(np.searchsorted(self.codes, flat[labelled]), minlength=self.K)
+
+        # Runs start wherever the label changes and at every row, which keeps
+        # each float32 run sum short.
+        change = np.empty(flat.shape, dtype=bool)
+        change[0] = True
+        np.not_equal(flat[1:], flat[:-1], out=change[1:])
+        change[::cols] = True
+        self.starts = np.flatnonzero(change)
+        run_labels = flat[self.starts]
+        # Unlabelled runs go to an extra bin K that is dropped.
+        run_ids = np.where(run_labels != NO_REGION, np.searchsorted(self.codes, run_labels), self.K)
+        ncols = len(TOTAL_COLUMNS)
+        # Bin of every run sum: compartment-major, then region.
+        self._bins = (np.arange(ncols)[:, None] * (self.K + 1) + run_ids[None, :]).ravel()
+        # Run sums, allocated in the dtype of the grids on first update.
+        self._runs = np.empty((ncols, 0))
+
+        self.history = int(history)
+        self._series = np.zeros((self.history, self.K, ncols), dtype=np.float32)
+        self._iterations = np.full(self.history, -1, dtype=np.int64)
+        self._count = 0
+        self._lock = threading.Lock()
+        # (iteration, (K, columns) totals): replaced on every update, never mutated.
+        self.latest = None
+
+    @property
+    def nbytes(self):
+        return self.starts.nbytes + self._bins.nbytes + self._runs.nbytes + self._series.nbytes
+
+    def update(self, iteration, arrays):
+        """Reduce (r, g, b, e, d) to per-region totals and record them for `iteration`"""
+        if self._runs.dtype != arrays[0].dtype or self._runs.shape[1] != len(self.starts):
+            self._runs = np.empty((len(arrays), len(self.starts)), dtype=arrays[0].dtype)
+        for row, arr in zip(self._runs, arrays):
+            np.add.reduceat(arr.ravel(), self.starts, out=row)
+        totals = np.bincount(self._bins, weights=self._runs.ravel(), minlength=len(arrays) * (self.K + 1))
+        totals = totals.reshape(len(arrays), self.K + 1)[:, :self.K].T
+
+        with self._lock:
+            last = self._iterations[(self._count - 1) % self.history] if self._count else None
+            if last is not None and iteration < last:
+                self._count = 0
+            elif last is not None and iteration == last:
+                self._count -= 1
+            slot = self._count % self.history
+            self._series[slot] = totals
+            self._iterations[slot] = iteration
+            self._count += 1
+            self.latest = (iteration, totals)
+
+    def lookup(self, region):
+        """Region code for a code or name, or None"""
+        for code, name in self.names.items():
+            if str(region) == str(code) or str(region).lower() == name.lower():
+                return code
+        return None
+
+    def top(self, k=10, column='infected', share=False):
+        """The k regions with the largest total (or mean per cell with share) of one column"""
+        if column not in TOTAL_COLUMNS:
+            raise ValueError(f"Unknown column '{column}'. Options: {', '.join(TOTAL_COLUMNS)}")
+        if self.latest is None:
+            return None, []
+        iteration, totals = self.latest
+        values = totals[:, TOTAL_COLUMNS.index(column)]
+        if share:
+            values = values / np.maximum(self.cell_counts, 1)
+        order = np.argsort(values)[::-1][:max(1, int(k))]
+        return iteration, [self._describe(i, totals) for i in order]
+
+    def _describe(self, i, totals):
+        code = int(self.codes[i])
+        cells = int(self.cell_counts[i])
+        return {
+            'code': code,
+            'name': self.names[code],
+            'cells': cells,
+            'totals': {name: float(totals[i, c]) for c, name in enumerate(TOTAL_COLUMNS)},
+            'share': {name: float(totals[i, c]) / max(cells, 1) for c, name in enumerate(TOTAL_COLUMNS)},
+        }
+
+    def series(self, code, points=None):
+        """Recorded totals of one region, oldest first, optionally mean-decimated to `points`"""
+        code = int(code)
+        i = int(np.searchsorted(self.codes, code))
+        if i == len(self.codes) or self.codes[i] != code:
+            raise ValueError(f"No region with code {code}")
+        with self._lock:
+            count = min(self._count, self.history)
+            slots = (np.arange(self._count - count, self._count)) % self.history
+            iterations = self._iterations[slots]
+            values = self._series[slots, i, :].astype(np.float64)
+        if points and count > points:
+            edges = np.linspace(0, count, int(points) + 1)[:-1].astype(np.int64)
+            sizes = np.diff(np.append(edges, count))[:, None]
+            values = np.add.reduceat(values, edges, axis=0) / sizes
+            iterations = iterations[edges]
+        return {
+            'code': int(code),
+            'name': self.names[int(code)],
+            'cells': int(self.cell_counts[i]),
+            'iteration': iterations.tolist(),
+            'columns': {name: values[:, c].tolist() for c, name in enumerate(TOTAL_COLUMNS)},
+        }
+
+    def describe(self):
+        return {
+            'regions': self.K,
+            'labelled_cells': int(self.cell_counts.sum()),
+            'runs': int(len(self.starts)),
+            'history': self.history,
+            'recorded': int(min(self._count, self.history)),
+            'names': {str(code): name for code, name in self.names.items()},
+        }
@@ -0,0 +1,76 @@
+import math
+
+# Named bounding boxes as (west, south, east, north) in degrees.
+REGIONS = {
+    'africa': (-26.0, -38.0, 64.0, 38.0),
+    'asia': (25.0, -12.0, 180.0, 82.0),
+    'europe': (-32.0, 34.0, 45.0, 72.0),
+    'middle_east': (24.0, 10.0, 64.0, 44.0),
+    'north_america': (-170.0, 5.0, -50.0, 84.0),
+    'oceania': (110.0, -50.0, 180.0, 0.0),
+    'south_america': (-93.0, -57.0, -32.0, 15.0),
+}
+
+
+def parse_bbox(text):
+    """'west,south,east,north' in degrees -> tuple of floats"""
+    parts = [float(v) for v in str(text).split(',')]
+    if len(parts) != 4:
+        raise ValueError(f"Bounding box needs west,south,east,north; got '{text}'")
+    return tuple(parts)
+
+
+def resolve_bbox(region=None, bbox=None):
+    """Bounding box for a named region or an explicit bbox (string or 4-tuple); None for the whole raster"""
+    if bbox is not None:
+        west, south, east, north = parse_bbox(bbox) if isinstance(bbox, str) else tuple(float(v) for v in bbox)
+    elif region:
+        key = region.lower().replace('-', '_').replace(' ', '_')
+        if key not in REGIONS:
+            raise ValueError(f"Unknown region '{region}'. Options: {', '.join(REGIONS)}")
+        west, south, east, north = REGIONS[key]
+    else:
+        return None
+    if not (west < east and south < north):
+        raise ValueError(f'Empty bounding box: {(west, south, east, north)}')
+    return west, south, east, north
+
+
+def bbox_window(transform, shape, bbox, factor=1):
+    """Full-resolution (row_off, col_off, rows, cols) covering bbox, aligned to whole downsample blocks.
+
+    transform is the raster's affine (a, b, c, d, e, f) for a north-up grid.
+    Aligning to the factor keeps every block of the window identical to the
+    matching block of the whole-raster grid.
+    """
+    a, _, c, _, e, f = transform[:6]
+    rows, cols = shape
+    west, south, east, north = bbox
+
+    # Rounding first keeps float noise in the transform from adding a row or column.
+    col_start = math.floor(round((west - c) / a, 6))
+    col_stop = math.ceil(round((east - c) / a, 6))
+    row_start = math.floor(round((north - f) / e, 6))
+    row_stop = math.ceil(round((south - f) / e, 6))
+
+    col_start = max(0, (col_start // factor) * factor)
+    row_start = max(0, (row_start // factor) * factor)
+    col_stop = min(cols, -(-col_stop // factor) * factor)
+    row_stop = min(rows, -(-row_stop // factor) * factor)
+    if row_stop <= row_start or col_stop <= col_start:
+        raise ValueError(f'Bounding box {bbox} does not overlap the raster')
+    return row_start, col_start, row_stop - row_start, col_stop - col_start
+
+
+def window_transform(transform, window, factor=1):
+    """Affine of the downsampled grid that starts at the window's corner"""
+    a, b, c, d, e, f = transform[:6]
+    row_off, col_off = (window[0], window[1]) if window else (0, 0)
+    return (a * factor, b, c + col_off * a, d, e * factor, f + row_off * e)
+
+
+def grid_bounds(transform, shape):
+    """(west, south, east, north) of a north-up grid"""
+    a, _, c, _, e, f = transform[:6]
+    rows, cols = shape
+    return c, f + rows * e, c + cols * a, f
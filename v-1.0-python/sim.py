@@ -1,56 +1,159 @@
 import numpy as np
-from scipy.signal import convolve2d
 from PIL import Image
-import rasterio
 import time
 import os
+import tracemalloc
+from collections import namedtuple
+
+from backends import make_backend
+from convolution import make_convolution_engine
+from delay_queue import make_delay_queue, transfer_cohorts
+from interventions import InterventionEngine
+from mobility import make_network
+from profiling import PhaseTimer
+from raster_cache import load_size_grids, raster_geometry
+from regions import bbox_window, grid_bounds, resolve_bbox, window_transform
+import region_stats
+import snapshot
+from stochastic import StochasticStepper
+from tiled import make_stepper
+from transitions import TICK_COLUMNS
+
+# Published after every tick and replaced, never mutated, so readers need no lock.
+# totals is a tuple in TOTAL_COLUMNS order, incidence the new infections of the
+# tick and tps the achieved ticks per second.
+StateSummary = namedtuple('StateSummary', 'iteration totals incidence tps published_at')
+# Seconds between tick-rate measurements.
+TPS_WINDOW = 0.5
+
+
+def rgb_frame(r, g, b):
+    """Combine three compartments into a uint8 RGB image, min-max normalized together"""
+    # Combine RGB channels
+    rgb_data = np.stack([r, g, b], axis=2)
+
+    # Normalize to 0-255
+    rgb_min = rgb_data.min()
+    rgb_max = rgb_data.max()
+    if rgb_max > rgb_min:
+        rgb_normalized = (rgb_data - rgb_min) / (rgb_max - rgb_min)
+    else:
+        rgb_normalized = rgb_data
+
+    rgb_normalized = np.nan_to_num(rgb_normalized, nan=0.0, posinf=1.0, neginf=0.0)
+    return (rgb_normalized * 255).astype(np.uint8)
+
+
+def default_seed_cell(raster_shape, size_grid, factor=1, window=None):
+    """Cell of size_grid for the default outbreak: where the original 720 x 1440 grid seeded it.
+
+    raster_shape is the full raster's; size_grid is the simulated grid at
+    downsample `factor`, a window of the raster when `window` is given.
+    Regional grids seed the same cell when the region contains it,
+    otherwise the region's most densely populated cell.
+    """
+    world_rows = -(-raster_shape[0] // factor)
+    world_cols = -(-raster_shape[1] // factor)
+    row = int((226 / 720) * max(world_rows - 1, 1))
+    col = int((863 / 1440) * max(world_cols - 1, 1))
+    if window is None:
+        return row, col
+
+    rows, cols = size_grid.shape
+    row -= window[0] // factor
+    col -= window[1] // factor
+    if 0 <= row < rows and 0 <= col < cols:
+        return row, col
+    return tuple(int(v) for v in np.unravel_index(np.argmax(size_grid), size_grid.shape))
+
 
 class VirusSimulation:
-    def __init__(self, geotiff_path='../gpw_v4_population_density_rev11_2020_15_min.tif'):
+    DEFAULT_SPREAD_KERNEL = np.array([
+        [0.2, 0.5, 0.2],
+        [0.5, 1.0, 0.5],
+        [0.2, 0.5, 0.2]
+    ], dtype=np.float32)
+
+    # Queues shorter than this always stay exact: they are small and carry the
+    # infection front, where reduced precision changes the outcome.
+    COMPACT_QUEUE_MIN_DELAY = 32
+
+    def __init__(self, geotiff_path='../gpw_v4_population_density_rev11_2020_15_min.tif',
+                 downsample_factor=None, delay_queue=None, erlang_stages=None, region=None, bbox=None):
         # Virus Modifiers
         self.SPREAD_RATE = 1.0
         self.SICKEN_RATE = 8
         self.HEAL_RATE = 7
         self.IMMUNITY_LOSS_RATE = 300
         self.FATALITY_RATE = 892 / 1000000
-        self.SPREAD_KERNEL = np.array([
-            [0.2, 0.5, 0.2],
-            [0.5, 1.0, 0.5],
-            [0.2, 0.5, 0.2]
-        ], dtype=np.float32)
+        self.SPREAD_KERNEL = self.DEFAULT_SPREAD_KERNEL.copy()
 
         self.dtype = np.float32
-        self.downsample_factor = max(1, int(os.getenv('SIM_DOWNSAMPLE_FACTOR', '4')))
+        # Progress prints from run_tick; batch runs switch this off.
+        self.verbose = True
+        if downsample_factor is None:
+            downsample_factor = os.getenv('SIM_DOWNSAMPLE_FACTOR', '4')
+        self.downsample_factor = max(1, int(downsample_factor))
+
+        # Representation of the long delay queues: exact, float16, uint16, sparse or erlang
+        self.delay_queue = delay_queue or os.getenv('SIM_DELAY_QUEUE', 'exact')
+        if erlang_stages is None:
+            erlang_stages = os.getenv('SIM_ERLANG_STAGES', '16')
+        self.erlang_stages = max(1, int(erlang_stages))
         
-        # Load GeoTIFF data
-        print("Loading GeoTIFF data...")
-        with rasterio.open(geotiff_path) as dataset:
-            data = dataset.read(1).astype(self.dtype, copy=False)  # Read first band
+        # Optional regional window: a named region (SIM_REGION) or a
+        # west,south,east,north bounding box in degrees (SIM_BBOX).
+        self.geotiff_path = geotiff_path
+        self.region = region or os.getenv('SIM_REGION') or None
+        self.bbox = resolve_bbox(self.region, bbox or os.getenv('SIM_BBOX') or None)
+        raster_transform, raster_shape = raster_geometry(geotiff_path)
+        self.raster_shape = raster_shape
+        self.window = None
+        if self.bbox is not None:
+            self.window = bbox_window(raster_transform, raster_shape, self.bbox, self.downsample_factor)
+        # Affine (a, b, c, d, e, f) of the simulation grid: lon = c + col * a, lat = f + row * e
+        self.transform = window_transform(raster_transform, self.window, self.downsample_factor)
 
+        # Population grids, memory-mapped from the preprocessed raster cache
+        # (built on first use; see raster_cache.py).
+        print("Loading GeoTIFF data...")
+        self.sizeGrid, self.sizeGridPow = load_size_grids(
+            geotiff_path, self.downsample_factor, self.dtype, window=self.window)
         if self.downsample_factor > 1:
-            data = data[::self.downsample_factor, ::self.downsample_factor]
             print(f"Downsample factor: {self.downsample_factor}")
-        
-        self.ROWS, self.COLS = data.shape
+
+        self.ROWS, self.COLS = self.sizeGrid.shape
+        # What the spread pass multiplies infection by: sizeGridPow itself, or
+        # a private copy once lockdowns scale parts of it (see interventions.py).
+        self.spread_weight = self.sizeGridPow
+        if self.window is not None:
+            print(f"Region {self.region or self.bbox}: rows {self.window[0]}+, cols {self.window[1]}+ of the raster")
         print(f"Data shape: {self.ROWS} x {self.COLS}")
-        
-        # Sanitize raster values: remove non-finite values and clamp negatives.
-        # Some GeoTIFFs use negative nodata sentinels, which would produce NaN in sqrt.
-        data_clean = np.nan_to_num(
-            data,
-            nan=0.0,
-            posinf=0.0,
-            neginf=0.0,
-        ).astype(self.dtype, copy=False)
-        data_clean = np.maximum(data_clean, 0)
-        
-        # Create sizeGrid
-        size_grid = np.sqrt(data_clean).astype(self.dtype, copy=False)
-        grid_max = float(np.max(size_grid))
-        if grid_max > 0:
-            size_grid = size_grid / grid_max
-        self.sizeGrid = size_grid
-        self.sizeGridPow = np.power(self.sizeGrid, 1.2).astype(self.dtype, copy=False)
+
+        # Spread convolution backend: auto, direct, stencil, separable, ndimage or fft
+        self.set_convolution_engine(os.getenv('SIM_CONV_ENGINE', 'auto'))
+        # Compute backend of the serial tick: numpy (the reference), numba (fused
+        # and compiled; needs numba) or auto (numba when it is installed)
+        self.backend = None
+        self.set_backend(os.getenv('SIM_BACKEND', 'numpy'))
+
+        # Tiled multi-core stepping: SIM_PARALLEL=threads|processes, SIM_WORKERS=n
+        self.set_parallel(
+            os.getenv('SIM_PARALLEL') or None,
+            workers=int(os.getenv('SIM_WORKERS', '0')) or None,
+        )
+        # Stochastic mode draws transitions for whole people: SIM_STOCHASTIC_PEOPLE is
+        # the head count of the densest cell (0 keeps the deterministic model) and
+        # SIM_STOCHASTIC_SEED fixes the random streams.
+        self.stochastic = None
+        self.set_stochastic(
+            float(os.getenv('SIM_STOCHASTIC_PEOPLE', '0')) or None,
+            seed=os.getenv('SIM_STOCHASTIC_SEED') or None,
+            workers=int(os.getenv('SIM_WORKERS', '0')) or None,
+        )
+        # Per-phase tick timings, off (None) unless SIM_PHASE_TIMING=1 or set_phase_timer(True).
+        self.phase_timer = None
+        self.set_phase_timer(os.getenv('SIM_PHASE_TIMING', '0') == '1')
         
         # Initialize simulation state
         self._init_state_arrays()
@@ -58,7 +161,21 @@ class VirusSimulation:
 
         self.iter = 0
         self.last_time = time.time()
-        
+        self._tps = 0.0
+        self._tps_mark = (time.perf_counter(), 0)
+        # Optional history.HistoryRecorder that receives every published summary.
+        self.recorder = None
+        # Optional mobility.MobilityNetwork mixing infection along travel routes:
+        # SIM_MOBILITY=synthetic[:hubs[:edges_per_hub]] or an .npz flow matrix.
+        spec = os.getenv('SIM_MOBILITY')
+        self.mobility = make_network(spec, self) if spec else None
+        # Scheduled seeds, vaccinations and lockdowns applied at the start of each tick.
+        self.interventions = InterventionEngine()
+        # Optional region_stats.RegionIndex updated every region_stats_every ticks.
+        self.region_index = None
+        self.region_stats_every = 1
+        self.publish_summary()
+
         print("Simulation initialized!")
 
     def _init_state_arrays(self):
@@ -69,29 +186,120 @@ class VirusSimulation:
         self.d = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)  # Dead
         self.e = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)  # Exposed
 
-        # Ring buffers: shape is (delay, rows, cols)
-        self.r_history = np.zeros((self.HEAL_RATE, self.ROWS, self.COLS), dtype=self.dtype)
-        self.b_history = np.zeros((self.IMMUNITY_LOSS_RATE, self.ROWS, self.COLS), dtype=self.dtype)
-        self.e_history = np.zeros((self.SICKEN_RATE, self.ROWS, self.COLS), dtype=self.dtype)
-        self.r_hist_idx = 0
-        self.b_hist_idx = 0
-        self.e_hist_idx = 0
+        # Delay queues for exposed -> infected -> recovered -> susceptible
+        self.r_history = self._make_queue(self.HEAL_RATE)
+        self.b_history = self._make_queue(self.IMMUNITY_LOSS_RATE)
+        self.e_history = self._make_queue(self.SICKEN_RATE)
 
         # Temporary variables compatible with API/logic
         self.sickened = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)
         self.healed = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)
         self.infected = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)
 
+        # Preallocated work buffers for run_tick. The spare buffer receives the
+        # next infected cohort and is refilled with the relapsed slot each tick.
+        self._spare = np.zeros((self.ROWS, self.COLS), dtype=self.dtype)
+        self._spread_src = np.empty((self.ROWS, self.COLS), dtype=self.dtype)
+        self._neighbor_sum = np.empty((self.ROWS, self.COLS), dtype=self.dtype)
+        self._dead = np.empty((self.ROWS, self.COLS), dtype=self.dtype)
+        self._work = np.empty((self.ROWS, self.COLS), dtype=self.dtype)
+        self._mask = np.empty((self.ROWS, self.COLS), dtype=bool)
+        # Compartment totals and incidence, filled by each tick's normalization pass.
+        self._totals = np.zeros(len(TICK_COLUMNS))
+
+    def _queue_kind(self, delay):
+        return self.delay_queue if delay >= self.COMPACT_QUEUE_MIN_DELAY else 'exact'
+
+    def _make_queue(self, delay, kind=None):
+        return make_delay_queue(
+            kind or self._queue_kind(delay),
+            delay,
+            (self.ROWS, self.COLS),
+            dtype=self.dtype,
+            stages=self.erlang_stages,
+        )
+
+    def _resize_queue(self, name, delay):
+        """Give a delay queue a new delay, rebuilt as the other kind when it crosses COMPACT_QUEUE_MIN_DELAY"""
+        queue = getattr(self, name)
+        kind = self._queue_kind(delay)
+        if kind == queue.name:
+            queue.resize(delay)
+            return
+        # Only the shorter side is resized in the old kind, so a long exact queue is never built.
+        if delay < queue.delay:
+            queue.resize(delay)
+        rebuilt = self._make_queue(queue.delay, kind)
+        transfer_cohorts(queue, rebuilt)
+        rebuilt.resize(delay)
+        setattr(self, name, rebuilt)
+
+    @property
+    def bounds(self):
+        """(west, south, east, north) of the simulated grid in degrees"""
+        return grid_bounds(self.transform, (self.ROWS, self.COLS))
+
+    def latlon_to_cell(self, lat, lon):
+        """Grid cell containing (lat, lon), or None if it lies outside the grid"""
+        a, _, c, _, e, f = self.transform
+        row = int(np.floor((lat - f) / e))
+        col = int(np.floor((lon - c) / a))
+        if 0 <= row < self.ROWS and 0 <= col < self.COLS:
+            return row, col
+        return None
+
+    def cell_to_latlon(self, row, col):
+        """(lat, lon) of a grid cell's centre"""
+        a, _, c, _, e, f = self.transform
+        return f + (row + 0.5) * e, c + (col + 0.5) * a
+
+    def default_seed_cell(self):
+        """Grid cell of the default outbreak, in the same region as the original 720 x 1440 grid"""
+        return default_seed_cell(self.raster_shape, self.sizeGrid, self.downsample_factor, self.window)
+
     def _seed_initial_infection(self):
         # Seed in approximately the same geographic region as the original grid.
-        rand_row = int((226 / 720) * max(self.ROWS - 1, 1))
-        rand_col = int((863 / 1440) * max(self.COLS - 1, 1))
-        r_min = max(rand_row - 1, 0)
-        r_max = min(rand_row + 2, self.ROWS)
-        c_min = max(rand_col - 1, 0)
-        c_max = min(rand_col + 2, self.COLS)
-        self.r[r_min:r_max, c_min:c_max] = 0.1
+        self.seed_infection(*self.default_seed_cell())
+
+    def seed_infection(self, row, col, value=0.1):
+        """Set the infected fraction of the 3x3 patch around (row, col)"""
+        r_min = max(row - 1, 0)
+        r_max = min(row + 2, self.ROWS)
+        c_min = max(col - 1, 0)
+        c_max = min(col + 2, self.COLS)
+        self.r[r_min:r_max, c_min:c_max] = value
     
+    def set_convolution_engine(self, name='auto'):
+        """Select the backend that convolves SPREAD_KERNEL each tick (call again after changing the kernel)"""
+        self.conv_engine = make_convolution_engine(self.SPREAD_KERNEL, (self.ROWS, self.COLS), name, self.dtype)
+        return self.conv_engine.name
+
+    def set_backend(self, name='numpy'):
+        """Select the backend that runs the per-cell part of serial ticks; returns its name"""
+        if self.backend is not None:
+            self.backend.close()
+        self.backend = make_backend(name)
+        return self.backend.name
+
+    def set_parallel(self, mode=None, workers=None, tiles=None):
+        """Step ticks on row-band tiles with 'threads' or 'processes'; None for the serial path"""
+        if getattr(self, 'stepper', None) is not None:
+            self.stepper.close()
+        self.stepper = make_stepper(self, mode, workers=workers, tiles=tiles) if mode else None
+        return self.stepper
+
+    def set_stochastic(self, people=None, seed=None, workers=None, tile_rows=None):
+        """Draw transitions for whole people, `people` in the densest cell; None for the deterministic model"""
+        if self.stochastic is not None:
+            self.stochastic.close()
+        self.stochastic = StochasticStepper(people, seed, workers, tile_rows) if people else None
+        return self.stochastic
+
+    def set_phase_timer(self, enabled=True):
+        """Time each phase of run_tick (and save_frame) into histograms; False turns it off"""
+        self.phase_timer = PhaseTimer() if enabled else None
+        return self.phase_timer
+
     def pause(self):
         self.paused = True
     
@@ -101,86 +309,108 @@ class VirusSimulation:
     def vaccinate(self):
         """Vaccinate 90% of susceptible population"""
         vaccinated = 0.9 * self.g
-        self.b = np.maximum(0, np.minimum(self.b + vaccinated, 1))
-        self.g = np.maximum(0, np.minimum(self.g - vaccinated, 1))
+        self.b += vaccinated
+        np.clip(self.b, 0, 1, out=self.b)
+        self.g -= vaccinated
+        np.clip(self.g, 0, 1, out=self.g)
 
         # Add vaccinated cohort into immunity-loss queue.
-        target_idx = (self.b_hist_idx - 1) % self.IMMUNITY_LOSS_RATE
-        self.b_history[target_idx] += vaccinated
+        self.b_history.add_to_latest(vaccinated)
+        self.publish_summary()
     
     def restart(self):
         """Reset simulation to initial state"""
         self._init_state_arrays()
         self._seed_initial_infection()
+        if self.stochastic is not None:
+            self.stochastic.reset()
 
         self.iter = 0
         self.paused = True
         self.last_time = time.time()
+        self._tps_mark = (time.perf_counter(), 0)
+        self.publish_summary()
     
+    def snapshot(self):
+        """Copy of the full state, delay queues included, for snapshot.save or restore()"""
+        return snapshot.capture(self)
+
+    def restore(self, state, params=None):
+        """Resume from snapshot() or a saved snapshot path; params overrides rates for a what-if branch"""
+        if not isinstance(state, snapshot.SimulationState):
+            state = snapshot.load(state)
+        return snapshot.restore(self, state, params)
+
+    def update_params(self, **params):
+        """Change rates between ticks; new delays resize their queues, keeping queued cohorts.
+
+        Takes any of snapshot.PARAMS and returns all of their current values.
+        """
+        # Everything is validated before anything changes.
+        values = snapshot.check_params(params)
+        for name, value in values.items():
+            if name in snapshot.DELAY_PARAMS:
+                self._resize_queue(snapshot.DELAY_PARAMS[name], value)
+            setattr(self, name, value)
+        return {name: getattr(self, name) for name in snapshot.PARAMS}
+
     def run_tick(self):
         """Run one iteration of the simulation"""
         if self.paused:
             return
         
         self.iter += 1
+        timer = self.phase_timer
+        if timer is not None:
+            timer.start()
 
-        # Queue logic with ring buffers: pop delayed cohorts and push previous tick cohorts.
-        sickened = self.e_history[self.e_hist_idx].copy()
-        self.e_history[self.e_hist_idx] = self.infected
-        self.e_hist_idx = (self.e_hist_idx + 1) % self.SICKEN_RATE
+        # Long-range travel moves infected and exposed mass (and this tick's
+        # queue cohorts) between cells before local spread.
+        if self.mobility is not None:
+            self.mobility.apply(self)
+        if not self.interventions.idle:
+            self.interventions.apply(self)
+        if timer is not None:
+            timer.mark('events')
 
-        healed = self.r_history[self.r_hist_idx].copy()
-        self.r_history[self.r_hist_idx] = self.sickened
-        self.r_hist_idx = (self.r_hist_idx + 1) % self.HEAL_RATE
+        # Queue logic: pop delayed cohorts and push previous tick cohorts. Each
+        # queue takes the pushed buffer and hands back one the tick now owns.
+        sickened = self.e_history.push_pop(self.infected)
+        healed = self.r_history.push_pop(self.sickened)
+        relapsed = self.b_history.push_pop(self.healed)
+        if timer is not None:
+            timer.mark('queues')
 
-        relapsed = self.b_history[self.b_hist_idx].copy()
-        self.b_history[self.b_hist_idx] = self.healed
-        self.b_hist_idx = (self.b_hist_idx + 1) % self.IMMUNITY_LOSS_RATE
-        
-        # Compute neighbor contributions
-        neighbor_sum = convolve2d(
-            self.r * self.sizeGridPow,
-            self.SPREAD_KERNEL,
-            mode='same',
-            boundary='fill',
-            fillvalue=0
-        ).astype(self.dtype, copy=False)
-        neighbor_sum = np.nan_to_num(
-            neighbor_sum,
-            nan=0.0,
-            posinf=np.finfo(self.dtype).max,
-            neginf=0.0,
-        )
-        
-        # Calculate transitions
-        infected = self.SPREAD_RATE * neighbor_sum / (1 + 3 * neighbor_sum) * self.g
-        dead = self.FATALITY_RATE * healed
-        infected = np.nan_to_num(infected, nan=0.0, posinf=0.0, neginf=0.0)
-        dead = np.nan_to_num(dead, nan=0.0, posinf=0.0, neginf=0.0)
-        
-        # Update compartments
-        self.g = np.maximum(np.minimum(self.g - infected + relapsed, 1), 0)
-        self.e = np.maximum(np.minimum(self.e + infected - sickened, 1), 0)
-        self.r = np.maximum(np.minimum(self.r + sickened - healed, 1), 0)
-        self.b = np.maximum(np.minimum(self.b + healed - dead - relapsed, 1), 0)
-        self.d = np.maximum(np.minimum(self.d + dead, 1), 0)
-
-        # Store transitions for next tick queue push.
+        infected = self._spare
+        stepper = self.stochastic or self.stepper
+        if stepper is not None:
+            sickened, healed, relapsed, infected = stepper.advance(
+                self, sickened, healed, relapsed, infected, self._totals)
+            if timer is not None:
+                timer.mark('advance')
+        else:
+            # Neighbor contributions, then transitions for the whole grid
+            sickened, healed, relapsed, infected = self.backend.advance(
+                self, sickened, healed, relapsed, infected, self._totals, timer)
+
+        # Store transitions for next tick queue push. The relapsed slot has left
+        # the queues, so it becomes the buffer for the next infected cohort.
         self.infected = infected
         self.sickened = sickened
         self.healed = healed
-        
-        # Normalize to ensure sum = 1
-        total = self.g + self.r + self.b + self.d + self.e
-        total = np.maximum(total, np.finfo(self.dtype).eps)
-        self.g = self.g / total
-        self.r = self.r / total
-        self.b = self.b / total
-        self.d = self.d / total
-        self.e = self.e / total
-        
+        self._spare = relapsed
+
+        now = time.perf_counter()
+        mark_time, mark_iter = self._tps_mark
+        if now - mark_time >= TPS_WINDOW:
+            self._tps = (self.iter - mark_iter) / (now - mark_time)
+            self._tps_mark = (now, self.iter)
+        self._publish()
+        if timer is not None:
+            timer.mark('publish')
+
         # Monitor iterations per second
-        if self.iter % 10 == 0:
+        if self.verbose and self.iter % 10 == 0:
             current_time = time.time()
             elapsed = current_time - self.last_time
             if elapsed > 0:
@@ -188,34 +418,73 @@ class VirusSimulation:
             self.last_time = current_time
             
             # Print totals
-            totals = np.array([
-                np.sum(self.r),
-                np.sum(self.g),
-                np.sum(self.b),
-                np.sum(self.e),
-                np.sum(self.d)
-            ]) * 100
+            totals = self._totals * 100
             print(f"R: {totals[0]:.1f}   G: {totals[1]:.1f}   B: {totals[2]:.1f}   E: {totals[3]:.1f}   D: {totals[4]:.1f}")
     
+    def publish_summary(self):
+        """Recompute the totals from the grids and publish them (after changes outside run_tick)"""
+        for col, arr in enumerate((self.r, self.g, self.b, self.e, self.d, self.infected)):
+            self._totals[col] = arr.sum()
+        return self._publish()
+
+    def _publish(self):
+        values = self._totals.tolist()
+        self.summary = StateSummary(self.iter, tuple(values[:-1]), values[-1], self._tps, time.time())
+        if self.recorder is not None:
+            self.recorder.record(self.iter, values[:-1], values[-1])
+        index = self.region_index
+        if index is not None and self.iter % self.region_stats_every == 0:
+            index.update(self.iter, (self.r, self.g, self.b, self.e, self.d))
+        return self.summary
+
+    def set_region_labels(self, labels, names=None, every=None, history=None):
+        """Track per-region totals for a label grid of this simulation's shape (None stops tracking)"""
+        if labels is None:
+            self.region_index = None
+            return None
+        if labels.shape != (self.ROWS, self.COLS):
+            raise ValueError(f'Region labels are {labels.shape}; the simulation is {(self.ROWS, self.COLS)}')
+        if every is None:
+            every = os.getenv('SIM_REGION_STATS_EVERY', '1')
+        if history is None:
+            history = os.getenv('SIM_REGION_HISTORY', '2000')
+        self.region_stats_every = max(1, int(every))
+        index = region_stats.RegionIndex(labels, names, history=int(history))
+        index.update(self.iter, (self.r, self.g, self.b, self.e, self.d))
+        self.region_index = index
+        return index
+
+    def measure_tick_allocations(self, ticks=10):
+        """Run ticks under tracemalloc and return the average peak bytes allocated per tick"""
+        was_tracing = tracemalloc.is_tracing()
+        if not was_tracing:
+            tracemalloc.start()
+
+        try:
+            total = 0
+            for _ in range(ticks):
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                self.run_tick()
+                total += tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+
+        return total / max(ticks, 1)
+
+    def render_rgb(self):
+        """Current state as a (ROWS, COLS, 3) uint8 image with R/G/B = infected/susceptible/recovered"""
+        return rgb_frame(self.r, self.g, self.b)
+
     def save_frame(self, output_path='sim_frame.png'):
         """Save current state as PNG"""
-        # Combine RGB channels
-        rgb_data = np.stack([self.r, self.g, self.b], axis=2)
-        
-        # Normalize to 0-255
-        rgb_min = rgb_data.min()
-        rgb_max = rgb_data.max()
-        if rgb_max > rgb_min:
-            rgb_normalized = (rgb_data - rgb_min) / (rgb_max - rgb_min)
+        img = Image.fromarray(self.render_rgb(), 'RGB')
+        if self.phase_timer is None:
+            img.save(output_path, 'PNG')
         else:
-            rgb_normalized = rgb_data
-        
-        rgb_normalized = np.nan_to_num(rgb_normalized, nan=0.0, posinf=1.0, neginf=0.0)
-        rgb_uint8 = (rgb_normalized * 255).astype(np.uint8)
-        
-        # Create and save image
-        img = Image.fromarray(rgb_uint8, 'RGB')
-        img.save(output_path, 'PNG')
+            with self.phase_timer.time('save_frame'):
+                img.save(output_path, 'PNG')
         
         return output_path
     
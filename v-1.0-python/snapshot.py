@@ -0,0 +1,398 @@
+import numpy as np
+import json
+import os
+import queue
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from delay_queue import make_delay_queue
+
+# Snapshot file layout:
+#   magic, then one block per array (64-byte aligned; raw bytes, or zlib
+#   chunks that compress and decompress in parallel), then a JSON index of
+#   the arrays and simulation metadata, then a footer holding the index
+#   offset and the magic again.
+SNAPSHOT_MAGIC = b'SIMSNAP1'
+SNAPSHOT_FORMAT = 1
+FOOTER = struct.Struct('<Q8s')
+ALIGN = 64
+# Uncompressed bytes per zlib chunk.
+CHUNK_BYTES = 4 << 20
+
+# Compartments and the cohorts run_tick pushes into the queues next tick.
+STATE_ARRAYS = ('g', 'e', 'r', 'b', 'd', 'infected', 'sickened', 'healed')
+QUEUES = ('e_history', 'r_history', 'b_history')
+PARAMS = ('SPREAD_RATE', 'FATALITY_RATE', 'SICKEN_RATE', 'HEAL_RATE', 'IMMUNITY_LOSS_RATE')
+# Parameters that are delays, and the queue whose length each one sets.
+DELAY_PARAMS = {'SICKEN_RATE': 'e_history', 'HEAL_RATE': 'r_history', 'IMMUNITY_LOSS_RATE': 'b_history'}
+
+
+def check_params(params):
+    """Validated copies of parameter overrides: delays as ints of at least 1, rates as non-negative floats"""
+    unknown = set(params) - set(PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}. Options: {', '.join(PARAMS)}")
+    values = {}
+    for name, value in params.items():
+        try:
+            values[name] = int(value) if name in DELAY_PARAMS else float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} must be a number, not {value!r}') from None
+        if name in DELAY_PARAMS:
+            if values[name] < 1:
+                raise ValueError(f'{name} is a delay in ticks and must be at least 1')
+        elif not 0 <= values[name] < float('inf'):
+            raise ValueError(f'{name} must be a non-negative number')
+    if values.get('FATALITY_RATE', 0) > 1:
+        raise ValueError('FATALITY_RATE is a fraction and cannot exceed 1')
+    return values
+
+
+class SimulationState:
+    """Detached copy of a simulation's state: JSON-able meta plus named arrays"""
+
+    def __init__(self, meta, arrays):
+        self.meta = meta
+        self.arrays = arrays
+
+    @property
+    def iteration(self):
+        return self.meta['iter']
+
+    @property
+    def nbytes(self):
+        return sum(arr.nbytes for arr in self.arrays.values())
+
+
+def capture(sim):
+    """Copy sim's state (call with the simulation lock held; this is the only part that blocks ticks)"""
+    arrays = {name: np.array(getattr(sim, name)) for name in STATE_ARRAYS}
+    arrays['SPREAD_KERNEL'] = np.array(sim.SPREAD_KERNEL)
+    queues = {}
+    for name in QUEUES:
+        q = getattr(sim, name)
+        q_meta, q_arrays = q.state()
+        queues[name] = dict(q_meta, kind=q.name, delay=q.delay)
+        for key, arr in q_arrays.items():
+            arrays[f'{name}.{key}'] = arr
+
+    meta = {
+        'iter': int(sim.iter),
+        'paused': bool(sim.paused),
+        'shape': [int(sim.ROWS), int(sim.COLS)],
+        'dtype': np.dtype(sim.dtype).str,
+        'downsample_factor': sim.downsample_factor,
+        'region': sim.region,
+        'bbox': list(sim.bbox) if sim.bbox is not None else None,
+        'delay_queue': sim.delay_queue,
+        'erlang_stages': sim.erlang_stages,
+        'params': {name: np.asarray(getattr(sim, name)).item() for name in PARAMS},
+        'queues': queues,
+        # Stochastic runs also keep their random streams, so a restore or fork draws the same again.
+        'stochastic': sim.stochastic.state() if sim.stochastic is not None else None,
+        'captured_at': time.time(),
+    }
+    return SimulationState(meta, arrays)
+
+
+def restore(sim, state, params=None):
+    """Load a captured or saved state into sim, optionally overriding parameters (a what-if branch).
+
+    The state's arrays are adopted, not copied, so a state should only be
+    restored once; load it again to restore the same snapshot twice.
+    """
+    meta, arrays = state.meta, state.arrays
+    if tuple(meta['shape']) != (sim.ROWS, sim.COLS):
+        raise ValueError(f"Snapshot grid {tuple(meta['shape'])} does not match the simulation's "
+                         f"{(sim.ROWS, sim.COLS)}")
+    values = dict(meta['params'], **check_params(params or {}))
+
+    queues = {}
+    for name in QUEUES:
+        q_meta = meta['queues'][name]
+        q = make_delay_queue(q_meta['kind'], q_meta['delay'], (sim.ROWS, sim.COLS), sim.dtype,
+                             stages=meta['erlang_stages'])
+        prefix = f'{name}.'
+        q.load_state(q_meta, {key[len(prefix):]: arr for key, arr in arrays.items() if key.startswith(prefix)})
+        queues[name] = q
+
+    sim.delay_queue = meta['delay_queue']
+    sim.erlang_stages = meta['erlang_stages']
+    for name in QUEUES:
+        setattr(sim, name, queues[name])
+    # A branch with other delays stretches the queued cohorts to the new lengths
+    # (and switches queue kind when a delay crosses COMPACT_QUEUE_MIN_DELAY).
+    for name, queue_name in DELAY_PARAMS.items():
+        sim._resize_queue(queue_name, values[name])
+    for name in STATE_ARRAYS:
+        setattr(sim, name, arrays[name])
+    # Work buffers keep their contents per tick only; the spare is overwritten first thing.
+    sim._spare = np.zeros((sim.ROWS, sim.COLS), dtype=sim.dtype)
+
+    for name in PARAMS:
+        setattr(sim, name, values[name])
+    kernel = np.asarray(arrays['SPREAD_KERNEL'], dtype=np.float32)
+    if not np.array_equal(kernel, sim.SPREAD_KERNEL):
+        sim.SPREAD_KERNEL = kernel
+        sim.set_convolution_engine(sim.conv_engine.name)
+
+    # Snapshots from before stochastic mode leave the sim's mode as it is.
+    if 'stochastic' in meta:
+        stochastic = meta['stochastic']
+        if stochastic is None:
+            sim.set_stochastic(None)
+        else:
+            current = sim.stochastic
+            sim.set_stochastic(stochastic['people'], stochastic['seed'],
+                               current.workers if current is not None else None, stochastic['tile_rows'])
+            sim.stochastic.load_state(sim, stochastic)
+
+    sim.iter = int(meta['iter'])
+    sim.paused = bool(meta['paused'])
+    sim.last_time = time.time()
+    sim._tps_mark = (time.perf_counter(), sim.iter)
+    sim.publish_summary()
+    return sim
+
+
+def save(state, path, compress=True, workers=None):
+    """Write a state to path atomically; compress=False writes raw blocks that load() can memory-map"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    index = {'format': SNAPSHOT_FORMAT, 'meta': state.meta, 'arrays': {}}
+
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh, ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+            fh.write(SNAPSHOT_MAGIC)
+            for name, arr in state.arrays.items():
+                arr = np.ascontiguousarray(arr)
+                fh.write(b'\0' * (-fh.tell() % ALIGN))
+                entry = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': fh.tell(),
+                         'nbytes': arr.nbytes}
+                data = memoryview(arr.reshape(-1).view(np.uint8))
+                if compress:
+                    pieces = [data[i:i + CHUNK_BYTES] for i in range(0, len(data), CHUNK_BYTES)]
+                    # zlib releases the GIL, so chunks compress on all cores.
+                    entry['chunks'] = []
+                    for chunk in pool.map(lambda piece: zlib.compress(piece, 1), pieces):
+                        entry['chunks'].append(len(chunk))
+                        fh.write(chunk)
+                else:
+                    fh.write(data)
+                index['arrays'][name] = entry
+
+            index_offset = fh.tell()
+            fh.write(json.dumps(index).encode())
+            fh.write(FOOTER.pack(index_offset, SNAPSHOT_MAGIC))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return path
+
+
+def read_index(path):
+    """The JSON index of a snapshot file, without reading its arrays"""
+    with open(path, 'rb') as fh:
+        fh.seek(-FOOTER.size, os.SEEK_END)
+        index_offset, magic = FOOTER.unpack(fh.read(FOOTER.size))
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a simulation snapshot')
+        end = fh.tell() - FOOTER.size
+        fh.seek(index_offset)
+        index = json.loads(fh.read(end - index_offset))
+    if index.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format {index.get('format')}")
+    return index
+
+
+def load(path, mmap=True, workers=None):
+    """Read a snapshot file into a SimulationState.
+
+    Raw blocks are memory-mapped copy-on-write when mmap is true, so loading
+    is near-instant and pages are read as the simulation touches them.
+    Compressed blocks are decompressed chunk by chunk on a thread pool.
+    """
+    index = read_index(path)
+    arrays = {}
+    with open(path, 'rb') as fh, ThreadPoolExecutor(workers or os.cpu_count() or 1) as pool:
+        for name, entry in index['arrays'].items():
+            dtype, shape, offset = np.dtype(entry['dtype']), tuple(entry['shape']), entry['offset']
+            if 'chunks' not in entry:
+                if mmap and entry['nbytes']:
+                    arr = np.memmap(path, dtype=dtype, mode='c', offset=offset, shape=shape)
+                    arrays[name] = arr.view(np.ndarray)
+                else:
+                    fh.seek(offset)
+                    arrays[name] = np.fromfile(fh, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                continue
+
+            arr = np.empty(shape, dtype=dtype)
+            out = arr.reshape(-1).view(np.uint8)
+            fh.seek(offset)
+            pieces = [fh.read(length) for length in entry['chunks']]
+
+            def inflate(i, name=name):
+                try:
+                    data = zlib.decompress(pieces[i])
+                except zlib.error as exc:
+                    raise ValueError(f'{path}: {name} is truncated or corrupt ({exc})') from None
+                out[i * CHUNK_BYTES:i * CHUNK_BYTES + len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+            list(pool.map(inflate, range(len(pieces))))
+            arrays[name] = arr
+    return SimulationState(index['meta'], arrays)
+
+
+def fork(state, geotiff_path, params=None):
+    """New VirusSimulation on the snapshot's grid, restored from state (a path or SimulationState)"""
+    from sim import VirusSimulation
+
+    if not isinstance(state, SimulationState):
+        state = load(state)
+    meta = state.meta
+    sim = VirusSimulation(
+        geotiff_path=geotiff_path,
+        downsample_factor=meta['downsample_factor'],
+        delay_queue=meta['delay_queue'],
+        erlang_stages=meta['erlang_stages'],
+        region=meta['region'],
+        bbox=meta['bbox'],
+    )
+    return restore(sim, state, params)
+
+
+class SnapshotWriter:
+    """Writes captured states to a directory on a background thread.
+
+    submit() only queues an already captured state, so callers hold the
+    simulation lock for the capture copy and never for compression or I/O.
+    """
+
+    SUFFIX = '.simsnap'
+
+    def __init__(self, directory, compress=True, keep=None):
+        self.directory = Path(directory)
+        self.compress = compress
+        # Autosaves beyond this many are deleted, oldest first.
+        self.keep = keep
+        self.jobs = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def path(self, name):
+        name = Path(str(name)).name
+        if not name or name.startswith('.'):
+            raise ValueError(f"Invalid snapshot name '{name}'")
+        return self.directory / (name if name.endswith(self.SUFFIX) else name + self.SUFFIX)
+
+    def submit(self, state, name=None, autosave=False):
+        """Queue a captured state for writing; returns the snapshot name"""
+        if name is None:
+            prefix = 'autosave' if autosave else 'snapshot'
+            name = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{state.iteration}"
+        path = self.path(name)
+        with self._lock:
+            self.jobs[path.stem] = {'status': 'pending', 'iteration': state.iteration}
+        self._queue.put((path, state, autosave))
+        self._ensure_thread()
+        return path.stem
+
+    def status(self, name):
+        with self._lock:
+            job = self.jobs.get(self.path(name).stem)
+            return dict(job) if job else None
+
+    def list(self):
+        """Saved snapshots (newest first) plus any still being written"""
+        with self._lock:
+            entries = {name: dict(job, name=name) for name, job in self.jobs.items() if job['status'] != 'done'}
+        if self.directory.exists():
+            for path in self.directory.glob('*' + self.SUFFIX):
+                try:
+                    meta = read_index(path)['meta']
+                except (OSError, ValueError):
+                    continue
+                stat = path.stat()
+                entries[path.stem] = {
+                    'name': path.stem,
+                    'status': 'done',
+                    'iteration': meta['iter'],
+                    'captured_at': meta['captured_at'],
+                    'bytes': stat.st_size,
+                    'shape': meta['shape'],
+                    'region': meta['region'],
+                }
+        return sorted(entries.values(), key=lambda e: e.get('captured_at', float('inf')), reverse=True)
+
+    def latest(self, autosave_only=False):
+        for entry in self.list():
+            if entry['status'] == 'done' and (not autosave_only or entry['name'].startswith('autosave-')):
+                return entry['name']
+        return None
+
+    def delete(self, name):
+        path = self.path(name)
+        if not path.exists():
+            return False
+        path.unlink()
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until every queued state has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='sim-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            path, state, autosave = self._queue.get()
+            try:
+                with self._lock:
+                    self.jobs[path.stem]['status'] = 'writing'
+                start = time.perf_counter()
+                save(state, path, compress=self.compress)
+                with self._lock:
+                    self.jobs[path.stem].update(status='done', write_ms=(time.perf_counter() - start) * 1000)
+                if autosave and self.keep:
+                    self._prune()
+            except Exception as exc:
+                print(f'Error writing snapshot {path.name}: {exc}')
+                with self._lock:
+                    self.jobs[path.stem].update(status='failed', error=str(exc))
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        autosaves = sorted(self.directory.glob('autosave-*' + self.SUFFIX), key=lambda p: p.stat().st_mtime)
+        for path in autosaves[:-self.keep]:
+            path.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    # Usage: python snapshot.py <snapshot file>
+    index = read_index(sys.argv[1])
+    meta = index['meta']
+    print(f"iteration {meta['iter']}, grid {meta['shape'][0]} x {meta['shape'][1]}, "
+          f"factor {meta['downsample_factor']}, region {meta['region'] or 'world'}")
+    for name, entry in index['arrays'].items():
+        stored = sum(entry['chunks']) if 'chunks' in entry else entry['nbytes']
+        print(f"  {name:24s} {str(tuple(entry['shape'])):20s} {entry['nbytes'] / 2**20:9.2f} MiB "
+              f"-> {stored / 2**20:9.2f} MiB")
@@ -0,0 +1,204 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from tiled import Band, TiledStepper
+from transitions import TICK_COLUMNS, apply_transitions, sanitize
+
+# Rows per random stream. Fixed, so the draws do not depend on the worker count.
+TILE_ROWS = 32
+# Float32 fractions of whole head counts drift by about this much (absolute, and
+# relative to the cell's people), so smaller offsets round to the nearest person.
+COUNT_ATOL = 1e-3
+COUNT_RTOL = 2.5e-7
+
+
+def head_counts(size_grid, people):
+    """Whole people per cell: sizeGrid squared (density relative to the densest cell) times `people`"""
+    return np.rint(np.square(size_grid, dtype=np.float64) * float(people))
+
+
+class StochasticBand(Band):
+    """Row band whose transitions are binomial draws on head counts, from its own random stream.
+
+    The compartments stay fractions of each cell's people, but every cohort
+    is kept to whole people: fractional ones (from interventions, travel,
+    compact queues or the initial seed) are rounded up or down at random
+    with the odds of their fraction, so a lone part of a person in an
+    almost empty cell either becomes one infection or dies out.
+    """
+
+    def __init__(self, start, stop, shape, kernel, engine_name, dtype, people, rng):
+        super().__init__(start, stop, shape, kernel, engine_name, dtype)
+        cols = shape[-1]
+        # Offsets of the band in the flattened grids.
+        self.flat = slice(start * cols, stop * cols)
+        self.people = people[start:stop].ravel()
+        self.inv_people = np.divide(1.0, self.people, out=np.zeros_like(self.people), where=self.people > 0)
+        self.rng = rng
+
+    def _whole(self, arr, cells=None):
+        """Round the band's cells of arr to whole people in place; returns (cells, counts) of the non-empty ones"""
+        flat = arr.reshape(-1)[self.flat]
+        if cells is None:
+            cells = np.flatnonzero(flat)
+        x = flat[cells] * self.people[cells]
+        counts = np.rint(x)
+        fractional = np.abs(x - counts) > COUNT_ATOL + COUNT_RTOL * self.people[cells]
+        if fractional.any():
+            x = x[fractional]
+            low = np.floor(x)
+            counts[fractional] = low + (self.rng.random(len(x)) < x - low)
+        flat[cells] = counts * self.inv_people[cells]
+        keep = counts > 0
+        return cells[keep], counts[keep]
+
+    def snap(self, g, e, r):
+        """Round the infectious compartments to whole people, trading the difference with the susceptibles"""
+        g_flat = g.reshape(-1)[self.flat]
+        for arr in (r, e):
+            flat = arr.reshape(-1)[self.flat]
+            cells = np.flatnonzero(flat)
+            before = flat[cells]
+            self._whole(arr, cells)
+            g_flat[cells] = np.clip(g_flat[cells] - (flat[cells] - before), 0, 1)
+
+    def advance(self, g, e, r, b, d, spread_src, sickened, healed, relapsed, infected,
+                spread_rate, fatality_rate, totals=None):
+        neighbor_sum = self.engine.convolve(spread_src[self.halo])[self.inner]
+        sanitize(neighbor_sum, self.mask, posinf=np.finfo(g.dtype).max)
+        # Chance a susceptible is infected this tick: the deterministic model's rate.
+        chance = self.work
+        np.multiply(neighbor_sum, 3, out=chance)
+        chance += 1
+        np.divide(neighbor_sum, chance, out=chance)
+        chance *= spread_rate
+        np.clip(chance, 0, 1, out=chance)
+
+        self._whole(sickened)
+        heal_cells, heal_counts = self._whole(healed)
+        self._whole(relapsed)
+
+        people, inv_people = self.people, self.inv_people
+        cells = np.flatnonzero(chance)
+        cells = cells[people[cells] > 0]
+        susceptible = np.rint(g.reshape(-1)[self.flat][cells] * people[cells]).astype(np.int64)
+        new = self.rng.binomial(susceptible, chance.reshape(-1)[cells])
+        out = infected.reshape(-1)[self.flat]
+        out.fill(0)
+        out[cells] = new * inv_people[cells]
+
+        dead = self.dead.reshape(-1)
+        dead.fill(0)
+        dead[heal_cells] = self.rng.binomial(heal_counts.astype(np.int64), fatality_rate) * inv_people[heal_cells]
+
+        rows = self.rows
+        apply_transitions(
+            g[rows], e[rows], r[rows], b[rows], d[rows],
+            sickened[rows], healed[rows], relapsed[rows], infected[rows],
+            self.dead, self.work, totals,
+        )
+
+
+class StochasticStepper(TiledStepper):
+    """Ticks that draw every transition for whole people (binomial infections and deaths).
+
+    `people` is the head count of the densest cell; the others scale with
+    sizeGrid squared. Every band of TILE_ROWS rows has its own Generator,
+    spawned from one SeedSequence, and draws only for its own cells, so a
+    run is the same for a given seed on any number of threads. The phases
+    are those of the ThreadStepper, plus rounding the infectious
+    compartments to whole people before the spread.
+    """
+
+    mode = 'stochastic'
+
+    def __init__(self, people, seed=None, workers=None, tile_rows=None):
+        super().__init__(workers)
+        self.people = float(people)
+        if not self.people > 0:
+            raise ValueError('Stochastic mode needs a positive head count for the densest cell')
+        self.tile_rows = max(1, int(tile_rows or TILE_ROWS))
+        # Entropy of the run's SeedSequence (an int or a list of them): pass it back as seed to repeat the run.
+        self.seed = np.random.SeedSequence(int(seed) if isinstance(seed, str) else seed).entropy
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sim-stochastic')
+
+    def _layout(self, sim):
+        key = (sim.ROWS, sim.COLS, sim.SPREAD_KERNEL.tobytes(), sim.conv_engine.name)
+        if key != self._layout_key:
+            people = head_counts(sim.sizeGrid, self.people)
+            starts = range(0, sim.ROWS, self.tile_rows)
+            streams = np.random.SeedSequence(self.seed).spawn(len(starts))
+            self._bands = [
+                StochasticBand(start, min(start + self.tile_rows, sim.ROWS), (sim.ROWS, sim.COLS),
+                               sim.SPREAD_KERNEL, sim.conv_engine.name, sim.dtype, people,
+                               np.random.default_rng(stream))
+                for start, stream in zip(starts, streams)
+            ]
+            self._layout_key = key
+        return self._bands
+
+    def reset(self):
+        """Restart every random stream from the seed (with VirusSimulation.restart)"""
+        self._layout_key = None
+
+    def state(self):
+        """JSON-able settings and stream positions, for snapshot.capture"""
+        seed = self.seed
+        return {
+            'people': self.people,
+            'seed': [int(s) for s in seed] if isinstance(seed, (list, tuple, np.ndarray)) else int(seed),
+            'tile_rows': self.tile_rows,
+            # None until the first tick has spawned the streams.
+            'streams': None if self._layout_key is None else [band.rng.bit_generator.state for band in self._bands],
+        }
+
+    def load_state(self, sim, state):
+        """Lay out the bands for sim and move every random stream to the position in state()"""
+        self.reset()
+        if state['streams'] is None:
+            return
+        bands = self._layout(sim)
+        if len(bands) != len(state['streams']):
+            raise ValueError(f"Snapshot has {len(state['streams'])} random streams, the grid {len(bands)} bands")
+        for band, stream in zip(bands, state['streams']):
+            band.rng.bit_generator.state = stream
+
+    @property
+    def population(self):
+        """People on the grid, once the first tick has laid out the bands"""
+        if self._bands is None:
+            return None
+        return float(sum(band.people.sum() for band in self._bands))
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None):
+        bands = self._layout(sim)
+        band_totals = np.zeros((len(bands), len(TICK_COLUMNS)))
+
+        def prepare(band):
+            band.snap(sim.g, sim.e, sim.r)
+            band.spread(sim.r, sim.spread_weight, sim._spread_src)
+
+        list(self.pool.map(prepare, bands))
+        list(self.pool.map(
+            lambda i: bands[i].advance(
+                sim.g, sim.e, sim.r, sim.b, sim.d, sim._spread_src,
+                sickened, healed, relapsed, infected,
+                sim.SPREAD_RATE, sim.FATALITY_RATE, band_totals[i],
+            ),
+            range(len(bands)),
+        ))
+        if totals is not None:
+            band_totals.sum(axis=0, out=totals)
+        return sickened, healed, relapsed, infected
+
+    def describe(self):
+        return {
+            'people': self.people,
+            'population': self.population,
+            'seed': str(self.seed),
+            'tile_rows': self.tile_rows,
+            'workers': self.workers,
+        }
+
+    def close(self):
+        self.pool.shutdown(wait=True)
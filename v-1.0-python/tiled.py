@@ -0,0 +1,320 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import os
+
+from convolution import make_convolution_engine
+from delay_queue import ExactQueue
+from transitions import TICK_COLUMNS, advance_cells
+
+# Bands thinner than this are not worth a task of their own.
+MIN_BAND_ROWS = 8
+
+
+def row_bands(rows, tiles, min_rows=MIN_BAND_ROWS):
+    """Split rows into at most `tiles` contiguous (start, stop) bands"""
+    tiles = max(1, min(int(tiles), rows // max(min_rows, 1)))
+    edges = np.linspace(0, rows, tiles + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+
+def kernel_halo(kernel_shape):
+    """Rows of halo a band needs (above, below) for a 'same'-mode convolution"""
+    rows = kernel_shape[0]
+    below = (rows - 1) // 2
+    return rows - 1 - below, below
+
+
+class Band:
+    """One row band of the grid with its own convolution engine and scratch buffers"""
+
+    def __init__(self, start, stop, shape, kernel, engine_name, dtype=np.float32):
+        # shape is (rows, cols), optionally with leading batch axes (ensembles).
+        rows, cols = shape[-2:]
+        batch = tuple(shape[:-2])
+        above, below = kernel_halo(kernel.shape)
+        self.rows = (Ellipsis, slice(start, stop), slice(None))
+        # The halo is read straight from the neighbouring bands' rows of the
+        # shared spread source, which nobody writes during the advance phase.
+        halo_start = max(start - above, 0)
+        halo_stop = min(stop + below, rows)
+        self.halo = (Ellipsis, slice(halo_start, halo_stop), slice(None))
+        self.inner = (Ellipsis, slice(start - halo_start, stop - halo_start), slice(None))
+
+        self.engine = make_convolution_engine(kernel, batch + (halo_stop - halo_start, cols), engine_name, dtype)
+        band_shape = batch + (stop - start, cols)
+        self.dead = np.empty(band_shape, dtype=dtype)
+        self.work = np.empty(band_shape, dtype=dtype)
+        self.mask = np.empty(band_shape, dtype=bool)
+
+    def spread(self, r, spread_weight, spread_src):
+        rows = self.rows
+        np.multiply(r[rows], spread_weight[rows], out=spread_src[rows])
+
+    def advance(self, g, e, r, b, d, spread_src, sickened, healed, relapsed, infected,
+                spread_rate, fatality_rate, totals=None):
+        neighbor_sum = self.engine.convolve(spread_src[self.halo])[self.inner]
+        rows = self.rows
+        advance_cells(
+            g[rows], e[rows], r[rows], b[rows], d[rows],
+            neighbor_sum, sickened[rows], healed[rows], relapsed[rows], infected[rows],
+            self.dead, self.work, self.mask,
+            spread_rate, fatality_rate, totals,
+        )
+
+
+def build_bands(shape, tiles, kernel, engine_name, dtype=np.float32):
+    return [Band(start, stop, shape, kernel, engine_name, dtype) for start, stop in row_bands(shape[-2], tiles)]
+
+
+class TiledStepper:
+    """Steps the per-cell part of a tick on row bands.
+
+    Each tick runs two phases with a barrier in between: every band writes
+    its rows of the spread source, then every band convolves its rows plus
+    a halo and applies transitions and normalization to its own cells. Both
+    phases do exactly the per-cell work of the serial path, so results match.
+    """
+
+    mode = None
+
+    def __init__(self, workers=None, tiles=None):
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.tiles = max(1, int(tiles or self.workers))
+        self._bands = None
+        self._layout_key = None
+
+    def _layout(self, sim):
+        key = (sim.ROWS, sim.COLS, sim.SPREAD_KERNEL.tobytes(), sim.conv_engine.name)
+        if key != self._layout_key:
+            self._bands = build_bands((sim.ROWS, sim.COLS), self.tiles, sim.SPREAD_KERNEL,
+                                      sim.conv_engine.name, sim.dtype)
+            self._layout_key = key
+        return self._bands
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None):
+        """Step the per-cell part of the tick and return (sickened, healed, relapsed, infected).
+
+        The returned arrays hold the same data but may have been relocated.
+        If given, totals receives the grid's compartment sums (see advance_cells).
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class ThreadStepper(TiledStepper):
+    """Bands stepped on a thread pool; numpy releases the GIL inside the ufuncs"""
+
+    mode = 'threads'
+
+    def __init__(self, workers=None, tiles=None):
+        super().__init__(workers, tiles)
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sim-tile')
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None):
+        bands = self._layout(sim)
+        band_totals = np.zeros((len(bands), len(TICK_COLUMNS)))
+        list(self.pool.map(lambda band: band.spread(sim.r, sim.spread_weight, sim._spread_src), bands))
+        list(self.pool.map(
+            lambda i: bands[i].advance(
+                sim.g, sim.e, sim.r, sim.b, sim.d, sim._spread_src,
+                sickened, healed, relapsed, infected,
+                sim.SPREAD_RATE, sim.FATALITY_RATE, band_totals[i],
+            ),
+            range(len(bands)),
+        ))
+        if totals is not None:
+            band_totals.sum(axis=0, out=totals)
+        return sickened, healed, relapsed, infected
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+
+class SharedArena:
+    """One shared-memory block carved into equally shaped 2D buffers"""
+
+    def __init__(self, count, shape, dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = count
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(count * self.slot_bytes, 1))
+        self.buffers = np.ndarray((count,) + self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self._base = self.buffers.__array_interface__['data'][0]
+        self._next = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def take(self, src):
+        """Copy src into the next free buffer and return the shared view"""
+        buf = self.buffers[self._next]
+        self._next += 1
+        buf[...] = src
+        return buf
+
+    def index_of(self, arr):
+        """Buffer index of arr inside the arena, or None if it lives elsewhere"""
+        if arr.shape != self.shape or arr.dtype != self.dtype or not arr.flags.c_contiguous:
+            return None
+        idx, rem = divmod(arr.__array_interface__['data'][0] - self._base, self.slot_bytes)
+        if rem or not 0 <= idx < self.count:
+            return None
+        return int(idx)
+
+    def close(self):
+        self.buffers = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views are still referenced elsewhere; the mapping goes away with them.
+            pass
+        self.shm.unlink()
+
+
+# Per-process state for ProcessStepper workers.
+_worker = {}
+
+
+def _worker_init(arena_name, count, shape, dtype, kernel, engine_name, tiles):
+    dtype = np.dtype(dtype).type
+    shm = shared_memory.SharedMemory(name=arena_name)
+    _worker['shm'] = shm
+    _worker['buffers'] = np.ndarray((count,) + tuple(shape), dtype=dtype, buffer=shm.buf)
+    _worker['bands'] = build_bands(tuple(shape), tiles, kernel, engine_name, dtype)
+
+
+def _worker_spread(band_idx, r, spread_weight, spread_src):
+    buffers = _worker['buffers']
+    _worker['bands'][band_idx].spread(buffers[r], buffers[spread_weight], buffers[spread_src])
+
+
+def _worker_advance(band_idx, indices, spread_rate, fatality_rate):
+    buffers = _worker['buffers']
+    totals = np.zeros(len(TICK_COLUMNS))
+    _worker['bands'][band_idx].advance(*(buffers[i] for i in indices), spread_rate, fatality_rate, totals)
+    return totals
+
+
+class ProcessStepper(TiledStepper):
+    """Bands stepped on a process pool over one shared-memory arena.
+
+    On first use every state array, queue slot and work buffer the tick
+    touches is moved into the arena, so buffer rotation stays inside it and
+    workers only need buffer indices per tick. Requires exact delay queues.
+    """
+
+    mode = 'processes'
+    ARRAY_NAMES = ['g', 'e', 'r', 'b', 'd', 'infected', 'sickened', 'healed',
+                   '_spare', '_spread_src', 'spread_weight']
+
+    def __init__(self, workers=None, tiles=None):
+        super().__init__(workers, tiles)
+        self.pool = None
+        self.arena = None
+        self._sim = None
+        self._pool_key = None
+
+    def _queues(self, sim):
+        queues = (sim.e_history, sim.r_history, sim.b_history)
+        for queue in queues:
+            if not isinstance(queue, ExactQueue):
+                raise ValueError("processes mode needs exact delay queues (SIM_DELAY_QUEUE=exact)")
+        return queues
+
+    def _attach(self, sim, extras):
+        """Move the simulation's tick arrays (plus extras) into a fresh arena"""
+        queues = self._queues(sim)
+        arrays = [getattr(sim, name) for name in self.ARRAY_NAMES] + list(extras)
+        arrays += [slot for queue in queues for slot in queue.slots]
+        count = len({id(arr) for arr in arrays})
+
+        old_arena = self.arena
+        self._shutdown_pool()
+        arena = SharedArena(count, (sim.ROWS, sim.COLS), sim.dtype)
+
+        # The same buffer can be reachable twice (e.g. _spare is the infected
+        # output), so each one is moved once and every reference follows it.
+        moved = {}
+
+        def move(arr):
+            if id(arr) not in moved:
+                moved[id(arr)] = arena.take(arr)
+            return moved[id(arr)]
+
+        for name in self.ARRAY_NAMES:
+            setattr(sim, name, move(getattr(sim, name)))
+        for queue in queues:
+            queue.slots = [move(slot) for slot in queue.slots]
+        extras = [move(arr) for arr in extras]
+        if old_arena is not None:
+            old_arena.close()
+
+        self.arena = arena
+        self._sim = sim
+        self._pool_key = self._layout_key
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_worker_init,
+            initargs=(arena.name, count, arena.shape, arena.dtype.str, sim.SPREAD_KERNEL,
+                      sim.conv_engine.name, self.tiles),
+        )
+        return extras
+
+    def advance(self, sim, sickened, healed, relapsed, infected, totals=None):
+        bands = self._layout(sim)
+        arrays = [sim.g, sim.e, sim.r, sim.b, sim.d, sim._spread_src,
+                  sickened, healed, relapsed, infected, sim.spread_weight]
+        indices = [self.arena.index_of(arr) for arr in arrays] if self.arena is not None else [None]
+        if sim is not self._sim or self._pool_key != self._layout_key or None in indices:
+            # First tick, a new kernel, or restart() replaced arrays: rebuild the arena.
+            sickened, healed, relapsed, infected = self._attach(sim, [sickened, healed, relapsed, infected])
+            arrays = [sim.g, sim.e, sim.r, sim.b, sim.d, sim._spread_src,
+                      sickened, healed, relapsed, infected, sim.spread_weight]
+            indices = [self.arena.index_of(arr) for arr in arrays]
+
+        g, e, r, b, d, spread_src, sick, heal, rel, inf, spread_weight = indices
+        futures = [self.pool.submit(_worker_spread, i, r, spread_weight, spread_src) for i in range(len(bands))]
+        for future in futures:
+            future.result()
+        advance_indices = (g, e, r, b, d, spread_src, sick, heal, rel, inf)
+        futures = [
+            self.pool.submit(_worker_advance, i, advance_indices, sim.SPREAD_RATE, sim.FATALITY_RATE)
+            for i in range(len(bands))
+        ]
+        band_totals = [future.result() for future in futures]
+        if totals is not None:
+            np.sum(band_totals, axis=0, out=totals)
+        return sickened, healed, relapsed, infected
+
+    def _shutdown_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def close(self):
+        self._shutdown_pool()
+        if self.arena is None:
+            return
+        # Copy state back to private memory before releasing the arena.
+        sim = self._sim
+        for name in self.ARRAY_NAMES:
+            setattr(sim, name, np.array(getattr(sim, name)))
+        for queue in self._queues(sim):
+            queue.slots = [np.array(slot) for slot in queue.slots]
+        self.arena.close()
+        self.arena = None
+
+
+STEPPERS = {stepper.mode: stepper for stepper in (ThreadStepper, ProcessStepper)}
+
+
+def make_stepper(sim, mode, workers=None, tiles=None):
+    """Build a tiled stepper for 'threads' or 'processes'"""
+    if mode not in STEPPERS:
+        raise ValueError(f"Unknown parallel mode '{mode}'. Options: {', '.join(STEPPERS)}")
+    return STEPPERS[mode](workers=workers, tiles=tiles)
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Order of the compartment totals, matching the R/G/B/E/D progress print.
+TOTAL_COLUMNS = ('infected', 'susceptible', 'recovered', 'exposed', 'dead')
+# What advance_cells sums per tick: the totals plus the new infection cohort.
+TICK_COLUMNS = TOTAL_COLUMNS + ('incidence',)
+
+
+def sanitize(arr, mask, posinf=0.0):
+    """In-place nan_to_num (NaN and -inf to 0, +inf to posinf) using a preallocated bool mask"""
+    np.isnan(arr, out=mask)
+    np.copyto(arr, 0, where=mask)
+    if posinf != 0:
+        np.minimum(arr, posinf, out=arr)
+    np.isinf(arr, out=mask)
+    np.copyto(arr, 0, where=mask)
+
+
+def advance_cells(g, e, r, b, d, neighbor_sum, sickened, healed, relapsed,
+                  infected, dead, work, mask, spread_rate, fatality_rate, totals=None, timer=None):
+    """Apply one tick of transitions, clamps and normalization to a block of cells in place.
+
+    Every argument array covers the same block of the grid. The new infection
+    cohort is written into `infected`; dead, work and mask are scratch. If
+    given, totals (float64, TICK_COLUMNS order) is overwritten with the
+    block's compartment sums, taken while normalization has each one hot,
+    and the sum of the new cohort. A PhaseTimer, if given, is marked after
+    the transitions and after the normalization.
+    """
+    dtype = g.dtype
+    sanitize(neighbor_sum, mask, posinf=np.finfo(dtype).max)
+
+    # Calculate transitions
+    np.multiply(neighbor_sum, 3, out=work)
+    work += 1
+    np.multiply(neighbor_sum, spread_rate, out=infected)
+    infected /= work
+    infected *= g
+    np.multiply(healed, fatality_rate, out=dead)
+    sanitize(infected, mask)
+    sanitize(dead, mask)
+    apply_transitions(g, e, r, b, d, sickened, healed, relapsed, infected, dead, work, totals, timer)
+
+
+def apply_transitions(g, e, r, b, d, sickened, healed, relapsed, infected, dead, work, totals=None, timer=None):
+    """Move the tick's cohorts between compartments, clamp and normalize (see advance_cells)"""
+    dtype = g.dtype
+    # Update compartments in place, clamping each to [0, 1]
+    g -= infected
+    g += relapsed
+    np.clip(g, 0, 1, out=g)
+    e += infected
+    e -= sickened
+    np.clip(e, 0, 1, out=e)
+    r += sickened
+    r -= healed
+    np.clip(r, 0, 1, out=r)
+    b += healed
+    b -= dead
+    b -= relapsed
+    np.clip(b, 0, 1, out=b)
+    d += dead
+    np.clip(d, 0, 1, out=d)
+    if timer is not None:
+        timer.mark('transitions')
+
+    # Normalize to ensure sum = 1
+    total = work
+    np.add(g, r, out=total)
+    total += b
+    total += d
+    total += e
+    np.maximum(total, np.finfo(dtype).eps, out=total)
+    for col, arr in enumerate((r, g, b, e, d)):
+        arr /= total
+        if totals is not None:
+            totals[col] = arr.sum()
+    if totals is not None:
+        totals[len(TOTAL_COLUMNS)] = infected.sum()
+    if timer is not None:
+        timer.mark('normalization')